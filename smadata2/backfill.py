@@ -0,0 +1,173 @@
+#! /usr/bin/python3
+#
+# smadata2.backfill - Find and repair holes in downloaded history
+# Copyright (C) 2014 David Gibson <david@gibson.dropbear.id.au>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import time
+
+from .db import SAMPLE_INV_FAST, SAMPLE_INV_DAILY, WATERMARK_INGEST
+
+all = ['find_gaps', 'merge_gaps', 'plan', 'fill', 'store_window',
+       'backfill_inverter']
+
+DAY = 24 * 60 * 60
+
+# How often the inverters record each kind of sample
+STEP = {
+    SAMPLE_INV_FAST: 5 * 60,
+    SAMPLE_INV_DAILY: DAY,
+}
+
+# How far back the inverters can be asked for each kind of sample
+HORIZON = {
+    SAMPLE_INV_FAST: 30 * DAY,
+    SAMPLE_INV_DAILY: 365 * DAY,
+}
+
+# Gaps closer together than this many steps are fetched as one window.
+# Downloading a few samples we already have is cheaper than another
+# request.
+SLACK_STEPS = 12
+
+
+def find_gaps(timestamps, from_ts, to_ts, step):
+    """Find missing samples in a sorted list of timestamps
+
+    Samples are expected every step seconds in [from_ts, to_ts].  Daily
+    samples fall on local midnights, which move with daylight saving,
+    so neighbours count as consecutive unless more than 1.5 steps apart.
+
+    Returns:
+       list.  (first, last) timestamps of each hole, inclusive
+    """
+    gaps = []
+    prev = None
+    for ts in timestamps:
+        if ts < from_ts or ts > to_ts:
+            continue
+        if prev is None:
+            if ts - from_ts >= step:
+                gaps.append((from_ts, ts - 1))
+        elif 2 * (ts - prev) > 3 * step:
+            gaps.append((prev + 1, ts - 1))
+        prev = ts
+    if prev is None:
+        gaps.append((from_ts, to_ts))
+    elif to_ts - prev >= step:
+        gaps.append((prev + 1, to_ts))
+    return gaps
+
+
+def merge_gaps(gaps, slack):
+    """Combine gaps less than slack seconds apart into single windows"""
+    windows = []
+    for first, last in gaps:
+        if windows and first - windows[-1][1] <= slack:
+            windows[-1] = (windows[-1][0], max(windows[-1][1], last))
+        else:
+            windows.append((first, last))
+    return windows
+
+
+def plan(ic, db, sample_type, now=None, horizon=None, tiers=None):
+    """Work out which historic windows to request to fill an inverter's gaps
+
+    Only history between the inverter's horizon and the newest sample
+    already downloaded is considered, since the regular download picks
+    up everything after that.  Fast samples older than the youngest
+    retention tier have been thinned on purpose, so aren't gaps.
+
+    Args:
+       ic: Inverter configuration
+       db (BaseDatabase): Where the samples are stored
+       sample_type (int): SAMPLE_INV_FAST or SAMPLE_INV_DAILY
+       now (int): Current time, by default the real one
+       horizon (int): Seconds of history the inverter keeps, by default
+          from HORIZON
+       tiers (list): Retention policy, if there is one
+    Returns:
+       list.  (first, last) timestamps to pass to historic(), inclusive
+    """
+    if now is None:
+        now = int(time.time())
+    if horizon is None:
+        horizon = HORIZON[sample_type]
+    step = STEP[sample_type]
+
+    to_ts = db.get_watermark(WATERMARK_INGEST, ic.serial, sample_type)
+    if to_ts is None:
+        return []
+    from_ts = now - horizon
+    if ic.starttime is not None:
+        from_ts = max(from_ts, ic.starttime)
+    if sample_type == SAMPLE_INV_FAST and tiers:
+        from_ts = max(from_ts, now - tiers[0].age)
+    if from_ts >= to_ts:
+        return []
+
+    # The samples come from a range scan on the generation primary key
+    stamps = [ts for ts, st, y in db.get_samples(ic.serial, from_ts,
+                                                 to_ts + 1, dense=True)
+              if st == sample_type]
+    gaps = find_gaps(stamps, from_ts, to_ts, step)
+    return merge_gaps(gaps, SLACK_STEPS * step)
+
+
+def fill(ic, db, sample_type, windows, data_fn):
+    """Fetch the given windows, storing only samples we don't have
+
+    Returns:
+       list.  The new samples
+    """
+    added = []
+    for first, last in windows:
+        added.extend(store_window(ic, db, sample_type, first, last,
+                                  data_fn(first, last)))
+    return added
+
+
+def store_window(ic, db, sample_type, first, last, data):
+    """Store the samples fetched for one window which we don't have yet
+
+    Returns:
+       list.  The samples added
+    """
+    have = set(ts for ts, st, y in db.get_samples(ic.serial, first,
+                                                  last + 1, dense=True)
+               if st == sample_type)
+    data = [(ts, y) for ts, y in data
+            if first <= ts <= last and ts not in have]
+    db.add_samples(ic.serial, sample_type, data)
+    db.commit()
+    return data
+
+
+def backfill_inverter(ic, db, sma, now=None, tiers=None, horizon=HORIZON):
+    """Repair holes in an inverter's fast and daily history
+
+    Args:
+       horizon (dict): Seconds of history the inverter keeps, by
+          sample type
+    Returns:
+       tuple.  (new fast samples, new daily samples, windows requested)
+    """
+    fast = plan(ic, db, SAMPLE_INV_FAST, now, horizon[SAMPLE_INV_FAST],
+                tiers)
+    daily = plan(ic, db, SAMPLE_INV_DAILY, now, horizon[SAMPLE_INV_DAILY])
+    data = fill(ic, db, SAMPLE_INV_FAST, fast, sma.historic)
+    data_daily = fill(ic, db, SAMPLE_INV_DAILY, daily, sma.historic_daily)
+    return (data, data_daily, len(fast) + len(daily))
@@ -0,0 +1,251 @@
+#! /usr/bin/python3
+#
+# smadata2.bench - Measure uploads to a stand-in pvoutput.org
+# Copyright (C) 2014 David Gibson <david@gibson.dropbear.id.au>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import argparse
+import contextlib
+import os.path
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import dateutil.tz
+
+from . import check
+from . import pvoutputmock
+from . import pvoutputorg
+from . import pvoutputuploader
+from .db import SAMPLE_INV_FAST
+from .db.sqlite import create_or_update
+from .pipeline import trim_night, localize
+
+all = ['BACKLOGS', 'Result', 'backlog', 'bench_api', 'bench_getstatus',
+       'bench_uploader', 'run']
+
+# Days of backlog measured by default
+BACKLOGS = (1, 14, 90)
+
+SID = 1000
+SERIAL = "BENCH"
+
+
+class Result(object):
+    """How long one benchmark took to get through a backlog"""
+
+    def __init__(self, name, days):
+        self.name = name
+        self.days = days
+        self.statuses = 0
+        self.requests = 0
+        self.seconds = 0.0
+        # Of which spent in HTTP requests
+        self.server_seconds = 0.0
+        self.peak = None
+        self.notes = ""
+
+    def __str__(self):
+        rate = (self.statuses / self.seconds) if self.seconds else 0.0
+        s = ("%-10s %3d days: %6d statuses %4d requests %7.3fs"
+             " (%5.1f%% in requests) %8.0f statuses/s"
+             % (self.name, self.days, self.statuses, self.requests,
+                self.seconds, 100.0 * self.server_seconds / self.seconds
+                if self.seconds else 0.0, rate))
+        if self.peak is not None:
+            s += " peak %.1fMiB" % (self.peak / 1048576.0)
+        if self.notes:
+            s += " [%s]" % self.notes
+        return s
+
+
+class BenchSystem(object):
+    name = "Bench System"
+    pvoutput_sid = SID
+
+    class Inverter(object):
+        serial = SERIAL
+
+    def inverters(self):
+        return [self.Inverter()]
+
+    def timezone(self):
+        return dateutil.tz.tzutc()
+
+
+def backlog(days, now=None):
+    """Five minute samples for some days up to now
+
+    Each day is flat overnight and rises linearly from 7am to 7pm,
+    like check.generate_linear().
+
+    Returns:
+       list.  [(timestamp, total yield), ...]
+    """
+    if now is None:
+        now = time.time()
+    start = int(now) // 300 * 300 - days * 24 * 3600
+    samples = []
+    total = 1000
+    for d in range(days):
+        s = start + d * 24 * 3600
+        day = check.generate_linear(s, s + 7*3600, s + 19*3600,
+                                    s + 24*3600, total, 1)
+        total = day[-1][1]
+        samples.extend(day)
+    return samples
+
+
+@contextlib.contextmanager
+def mock_api(latency=0.0):
+    """An API connected to a fresh mock server"""
+    server = pvoutputmock.MockServer(latency=latency).start()
+    # A quota big enough that the limiter never waits
+    server.add_system(SID, quota=10**6)
+    pool = pvoutputorg.ConnectionPool()
+    try:
+        yield pvoutputorg.API(server.url, server.apikey, SID, pool=pool,
+                              limiter=pvoutputorg.RateLimiter())
+    finally:
+        pool.close()
+        server.stop()
+
+
+def _finish(result, api, t0):
+    result.seconds = time.monotonic() - t0
+    for stats in api.pool.stats.values():
+        if stats.script != "/service/r2/getsystem.jsp":
+            result.requests += stats.requests
+            result.server_seconds += stats.seconds
+    return result
+
+
+def bench_api(days, latency=0.0):
+    """Upload a backlog with API.addstatus_bulk()"""
+    result = Result("api", days)
+    tz = dateutil.tz.tzutc()
+    samples = backlog(days)
+    with mock_api(latency) as api:
+        t0 = time.monotonic()
+        data = [(dt, y) for ts, dt, y in localize(trim_night(samples), tz)]
+        api.addstatus_bulk(data)
+        result.statuses = len(data)
+        return _finish(result, api, t0)
+
+
+def bench_getstatus(days, latency=0.0):
+    """Read a backlog back one day at a time with API.getstatus()"""
+    result = Result("getstatus", days)
+    tz = dateutil.tz.tzutc()
+    samples = backlog(days)
+    with mock_api(latency) as api:
+        api.addstatus_bulk([(dt, y) for ts, dt, y
+                            in localize(trim_night(samples), tz)])
+        api.pool.stats.clear()
+        dates = sorted(set(dt.date() for ts, dt, y in localize(samples, tz)))
+        t0 = time.monotonic()
+        for date in dates:
+            result.statuses += len(api.getstatus(date) or [])
+        return _finish(result, api, t0)
+
+
+def bench_uploader(days, latency=0.0, memory=False):
+    """Upload a backlog from a database with PVOutputUploader
+
+    Args:
+       memory (bool): Also measure peak memory, which slows things down
+    """
+    result = Result("uploader", days)
+    tmpdir = tempfile.mkdtemp(prefix="smadata2-bench-")
+    db = None
+    try:
+        db = create_or_update(os.path.join(tmpdir, "bench.sqlite"))
+        db.add_samples(SERIAL, SAMPLE_INV_FAST, backlog(days))
+        db.commit()
+        with mock_api(latency) as api:
+            uploader = pvoutputuploader.PVOutputUploader(db, BenchSystem(),
+                                                         api)
+            if memory:
+                tracemalloc.start()
+            t0 = time.monotonic()
+            with contextlib.redirect_stdout(None):
+                uploader.upload_unuploaded_statuses()
+            _finish(result, api, t0)
+            if memory:
+                result.peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            result.statuses = uploader.pipeline["recent"]
+            result.notes = str(uploader.pipeline)
+        return result
+    finally:
+        if db is not None:
+            db.close()
+        shutil.rmtree(tmpdir)
+
+
+BENCHMARKS = {
+    "api": bench_api,
+    "getstatus": bench_getstatus,
+    "uploader": bench_uploader,
+}
+
+
+def run(names=None, backlogs=BACKLOGS, latency=0.0, memory=False,
+        out=sys.stdout):
+    """Run benchmarks at each backlog, printing results as they come
+
+    Returns:
+       list.  Result objects
+    """
+    if names is None:
+        names = sorted(BENCHMARKS)
+    results = []
+    for name in names:
+        for days in backlogs:
+            kwargs = {"memory": memory} if name == "uploader" else {}
+            result = BENCHMARKS[name](days, latency, **kwargs)
+            print(result, file=out)
+            out.flush()
+            results.append(result)
+    return results
+
+
+def main(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser(
+        description="Benchmark uploads to a stand-in pvoutput.org")
+    parser.add_argument("benchmarks", nargs="*",
+                        help="Benchmarks to run, of %s (default all)"
+                        % ", ".join(sorted(BENCHMARKS)))
+    parser.add_argument("--days", type=int, action="append",
+                        help="Days of backlog (default %s)"
+                        % ", ".join(str(d) for d in BACKLOGS))
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="Milliseconds the server takes to answer")
+    parser.add_argument("--memory", action="store_true",
+                        help="Measure the uploader's peak memory")
+    args = parser.parse_args(argv)
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error("No such benchmark: %s" % name)
+
+    run(args.benchmarks or None, args.days or BACKLOGS,
+        args.latency / 1000.0, args.memory)
+
+
+if __name__ == '__main__':
+    main()
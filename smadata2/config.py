@@ -25,8 +25,10 @@ import json
 
 from .inverter import smabluetooth
 from . import pvoutputorg
+from . import pvoutputcache
 from . import datetimeutil
 from . import db
+from .db import retention
 
 DEFAULT_CONFIG_FILE = os.path.expanduser("~/.smadata2.json")
 
@@ -36,24 +38,28 @@ class SMAData2InverterConfig(object):
         self.bdaddr = invjson["bluetooth"]
         self.serial = invjson["serial"]
         self.name = invjson.get("name", defname)
+        # Bluetooth address of the local adapter to connect through
+        self.adapter = invjson.get("adapter", None)
         if "start-time" in invjson:
             self.starttime = datetimeutil.parse_time(invjson["start-time"])
         else:
             self.starttime = None
 
     def connect(self):
-        return smabluetooth.Connection(self.bdaddr)
+        return smabluetooth.Connection(self.bdaddr, self.adapter)
 
-    def connect_and_logon(self):
+    def connect_and_logon(self, timeout=900):
         conn = self.connect()
         conn.hello()
-        conn.logon()
+        conn.logon(timeout=timeout)
         return conn
 
     def __str__(self):
         return ("\t%s:\n" % self.name +
                 "\t\tSerial number: '%s'\n" % self.serial +
-                "\t\tBluetooth address: %s\n" % self.bdaddr)
+                "\t\tBluetooth address: %s\n" % self.bdaddr +
+                ("\t\tAdapter: %s\n" % self.adapter if self.adapter
+                 else ""))
 
 
 class SMAData2SystemConfig(object):
@@ -64,6 +70,8 @@ class SMAData2SystemConfig(object):
             self.name = sysjson.get("name", "system-%04d" % index)
             self.pvoutput_sid = sysjson.get("pvoutput-sid", None)
             self.tz = sysjson.get("timezone", None)
+            self.latitude = sysjson.get("latitude", None)
+            self.longitude = sysjson.get("longitude", None)
 
             self.invs = []
             if "inverters" in sysjson:
@@ -78,12 +86,20 @@ class SMAData2SystemConfig(object):
             self.name = inv.name
             self.pvoutput_sid = invjson.get("pvoutput-sid", None)
             self.tz = invjson.get("timezone", None)
+            self.latitude = invjson.get("latitude", None)
+            self.longitude = invjson.get("longitude", None)
 
             self.invs = [inv]
 
     def inverters(self):
         return self.invs
 
+    def location(self):
+        """(latitude, longitude) in degrees, or None if not configured"""
+        if self.latitude is None or self.longitude is None:
+            return None
+        return (float(self.latitude), float(self.longitude))
+
     def timezone(self):
         if self.tz is None:
             return dateutil.tz.tzlocal()
@@ -109,16 +125,39 @@ class SMAData2Config(object):
         alljson = json.load(f)
 
         dbname = os.path.expanduser("~/.smadata2.sqlite")
+        self.archivedir = None
+        self.dbcache = None
+        self.dbpartition = None
+        self.dbcompress = False
+        self.dbpool = None
+        self.retention = []
         if "database" in alljson:
             dbjson = alljson["database"]
             if "filename" in dbjson:
                 dbname = dbjson["filename"]
+            if "archive" in dbjson:
+                self.archivedir = os.path.expanduser(dbjson["archive"])
+            if "cache" in dbjson:
+                self.dbcache = dbjson["cache"]
+            if "partition" in dbjson:
+                self.dbpartition = dbjson["partition"]
+            if "pool" in dbjson:
+                self.dbpool = dbjson["pool"]
+            if "compress" in dbjson:
+                self.dbcompress = bool(dbjson["compress"])
+            if "retention" in dbjson:
+                self.retention = retention.parse_policy(dbjson["retention"])
         self.dbname = os.path.expanduser(dbname)
 
         if "pvoutput.org" in alljson:
             pvojson = alljson["pvoutput.org"]
             self.pvoutput_server = pvojson.get("server", "pvoutput.org")
             self.pvoutput_apikey = pvojson.get("apikey", None)
+            # Responses are cached here between runs, unless it's null
+            self.pvoutput_cache = pvojson.get(
+                "cache", "~/.smadata2-pvoutput.sqlite")
+            if self.pvoutput_cache is not None:
+                self.pvoutput_cache = os.path.expanduser(self.pvoutput_cache)
 
         self.syslist = []
         if "systems" in alljson:
@@ -133,11 +172,30 @@ class SMAData2Config(object):
         return self.syslist
 
     def pvoutput_connect(self, system):
+        cache = None
+        if self.pvoutput_cache is not None:
+            cache = pvoutputcache.open_cache(self.pvoutput_cache)
         return pvoutputorg.API("http://" + self.pvoutput_server,
-                               self.pvoutput_apikey, system.pvoutput_sid)
+                               self.pvoutput_apikey, system.pvoutput_sid,
+                               cache=cache)
 
     def database(self):
-        return db.SQLiteDatabase(self.dbname)
+        if self.dbpool is not None:
+            database = db.PooledSQLiteDatabase(
+                self.dbname, self.dbpool.get("readers", 4),
+                self.dbpool.get("timeout", 30.0),
+                partition=self.dbpartition, compress=self.dbcompress)
+        else:
+            database = db.SQLiteDatabase(self.dbname, self.dbpartition,
+                                         self.dbcompress)
+        if self.archivedir is not None:
+            database = db.ArchiveDatabase(database,
+                                          db.ColumnArchive(self.archivedir))
+        if self.dbcache is not None:
+            database = db.CachedDatabase(database,
+                                         self.dbcache.get("size", 256),
+                                         self.dbcache.get("ttl", 300))
+        return database
 
 
 if __name__ == '__main__':
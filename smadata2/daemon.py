@@ -0,0 +1,169 @@
+#! /usr/bin/python3
+#
+# smadata2.daemon - Long running collector
+# Copyright (C) 2014 David Gibson <david@gibson.dropbear.id.au>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import datetime
+import threading
+import time
+
+from . import backfill
+from . import download
+from . import session
+from . import sun
+
+all = ['Collector']
+
+DAY = 24 * 60 * 60
+
+
+class InverterState(object):
+    def __init__(self, ic, system):
+        self.ic = ic
+        self.system = system
+        self.next_poll = 0
+        self.interval = None
+        self.failures = 0
+        self.last_yield = None
+
+
+class Collector(object):
+    """Repeatedly download from inverters, only while they could produce
+
+    Each inverter's logged on connection is kept between polls in
+    `sessions`, a SessionManager, which logs on again before the
+    inverter would time the logon out.  While an inverter's output is
+    rising it is polled every `interval` seconds.  When polls find
+    nothing new the interval doubles, up to `max_interval`.  Systems
+    with a configured location aren't polled at night.  Instead they
+    sleep until `margin` seconds before the next sunrise, and keep
+    polling until `margin` seconds after sunset to pick up the day's
+    last samples.  Failing inverters back off exponentially, up to
+    `max_backoff`, and get a fresh connection.  Every poll asks for
+    samples newer than the database already has.  With `fill` set, holes
+    in older history are downloaded too, but only for the first half of
+    each interval, so live data keeps landing on time.
+    """
+
+    def __init__(self, systems, db, interval=300, max_interval=1800,
+                 margin=1800, max_backoff=3600, report=None,
+                 sessions=None, fill=False, tiers=None, clock=time.time):
+        self.db = db
+        self.interval = interval
+        self.max_interval = max_interval
+        self.margin = margin
+        self.max_backoff = max_backoff
+        self.report = report
+        self.fill = fill
+        self.tiers = tiers
+        self.clock = clock
+        self.stopping = threading.Event()
+        if sessions is None:
+            sessions = session.SessionManager(clock=clock)
+        self.sessions = sessions
+
+        self.states = {}
+        for system in systems:
+            for ic in system.inverters():
+                self.states[ic.serial] = InverterState(ic, system)
+
+    def stop(self):
+        self.stopping.set()
+
+    def daylight(self, system, now):
+        """The daylight window containing or following now, or None if
+        the system has no location"""
+        location = system.location()
+        if location is None:
+            return None
+        day = datetime.datetime.fromtimestamp(now, system.timezone()).date()
+        for i in range(2):
+            times = sun.sun_times(day, *location)
+            if times is not None:
+                rise, set_ = times
+                rise -= self.margin
+                set_ += self.margin
+                if now < set_:
+                    return (rise, set_)
+            day += datetime.timedelta(days=1)
+        # Polar night, check back tomorrow
+        return (now + DAY, now + DAY)
+
+    def schedule(self, state, when):
+        """Poll an inverter at when, or at dawn if that's at night"""
+        window = self.daylight(state.system, when)
+        if window is not None and when < window[0]:
+            when = window[0]
+            # A new day starts at the fastest rate
+            state.interval = self.interval
+        state.next_poll = when
+
+    def connect(self, ic):
+        return self.sessions.connect(ic)
+
+    def update(self, dl, now):
+        state = self.states[dl.ic.serial]
+        if dl.error is not None:
+            state.failures += 1
+            # Whatever went wrong, start again with a new connection
+            self.sessions.drop(dl.ic)
+        else:
+            state.failures = 0
+            if dl.data and (state.last_yield is None
+                            or dl.data[-1][1] > state.last_yield):
+                state.interval = self.interval
+            else:
+                state.interval = min(state.interval * 2, self.max_interval)
+            if dl.data:
+                state.last_yield = dl.data[-1][1]
+
+        if state.failures:
+            delay = min(self.interval * 2 ** (state.failures - 1),
+                        self.max_backoff)
+        else:
+            delay = state.interval
+        self.schedule(state, now + delay)
+
+    def poll(self):
+        """Download from every inverter which is due
+
+        Returns:
+           float.  When the next inverter will be due
+        """
+        now = self.clock()
+        due = [s.ic for s in self.states.values() if s.next_poll <= now]
+        if due:
+            horizon = backfill.HORIZON if self.fill else None
+            for dl in download.download_all(due, self.db, self.report,
+                                            self.connect, horizon,
+                                            self.interval / 2, self.tiers):
+                self.update(dl, self.clock())
+        return min(s.next_poll for s in self.states.values())
+
+    def start(self):
+        for state in self.states.values():
+            state.interval = self.interval
+            self.schedule(state, self.clock())
+
+    def run(self):
+        self.start()
+        try:
+            while not self.stopping.is_set():
+                wake = self.poll()
+                self.stopping.wait(max(0, wake - self.clock()))
+        finally:
+            self.sessions.close()
@@ -17,11 +17,22 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
-from .base import WrongSchema
+from .base import WrongSchema, DuplicateSample
 from .base import SAMPLETYPES, SAMPLE_ADHOC, SAMPLE_INV_FAST, SAMPLE_INV_DAILY
+from .base import WATERMARK_INGEST, WATERMARK_PVOUTPUT, WATERMARK_RETENTION
+from .base import WATERMARK_PVOUTPUT_DAILY
+from .base import OUTBOX_PENDING, OUTBOX_SENDING, OUTBOX_FAILED
 
 from .sqlite import SQLiteDatabase
+from .memory import MemoryDatabase
+from .archive import ColumnArchive, ArchiveDatabase
+from .cache import CachedDatabase
+from .pool import PooledSQLiteDatabase
 
-__all__ = [WrongSchema,
+__all__ = [WrongSchema, DuplicateSample,
            SAMPLETYPES, SAMPLE_ADHOC, SAMPLE_INV_FAST, SAMPLE_INV_DAILY,
-           SQLiteDatabase]
+           WATERMARK_INGEST, WATERMARK_PVOUTPUT, WATERMARK_RETENTION,
+           WATERMARK_PVOUTPUT_DAILY,
+           OUTBOX_PENDING, OUTBOX_SENDING, OUTBOX_FAILED,
+           SQLiteDatabase, MemoryDatabase, ColumnArchive, ArchiveDatabase,
+           CachedDatabase, PooledSQLiteDatabase]
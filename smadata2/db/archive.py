@@ -0,0 +1,514 @@
+#! /usr/bin/python3
+#
+# smadata2.db.archive - Columnar cold storage for old samples
+# Copyright (C) 2014 David Gibson <david@gibson.dropbear.id.au>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Columnar archive tier for closed months of samples
+
+Samples for a closed month are moved out of the hot database into one
+file per inverter, month and sample type:
+
+    <directory>/<serial>/<YYYY-MM>.<sample_type>.col
+
+Each file is written once and never modified.  The layout is a fixed
+header followed by two delta-encoded columns, all little endian:
+
+    magic (8 bytes), version (u16), sample_type (u16), count (u32),
+    first timestamp (i64), first total_yield (i64),
+    count-1 timestamp deltas (u32),
+    count-1 total_yield deltas (i32)
+
+Version 2 files are the same but with i64 deltas in both columns.  They
+are only written when a delta doesn't fit in 32 bits, such as the jump
+to an inverter's 0xffffffff "no total" marker.
+
+Files are read back through mmap, and each column is only decoded the
+first time a query needs it.
+"""
+
+import array
+import bisect
+import collections
+import datetime
+import itertools
+import mmap
+import os
+import os.path
+import struct
+import sys
+
+import dateutil.tz
+
+from .base import BaseDatabase, Error, SAMPLE_INV_FAST, total_yield_at
+
+all = ['ColumnFile', 'ColumnArchive', 'ArchiveDatabase']
+
+MAGIC = b"SMA2COL\0"
+VERSION = 1
+VERSION_WIDE = 2
+
+# Typecodes of the (timestamp, total_yield) delta columns, by version
+_COLUMNS = {
+    VERSION: ("I", "i"),
+    VERSION_WIDE: ("q", "q"),
+}
+
+_header = struct.Struct("<8sHHIqq")
+
+
+def month_start(ts):
+    """Return the timestamp of the start of the (UTC) month containing ts"""
+    dt = datetime.datetime.fromtimestamp(ts, dateutil.tz.tzutc())
+    dt = dt.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    return int(dt.timestamp())
+
+
+def next_month(ts):
+    """Return the timestamp of the start of the (UTC) month after ts"""
+    dt = datetime.datetime.fromtimestamp(month_start(ts), dateutil.tz.tzutc())
+    if dt.month == 12:
+        dt = dt.replace(year=dt.year + 1, month=1)
+    else:
+        dt = dt.replace(month=dt.month + 1)
+    return int(dt.timestamp())
+
+
+def month_name(ts):
+    dt = datetime.datetime.fromtimestamp(ts, dateutil.tz.tzutc())
+    return dt.strftime("%Y-%m")
+
+
+def _decode_column(buf, offset, count, typecode, first):
+    """Decode a delta-encoded column into absolute values"""
+    size = struct.calcsize("<" + typecode)
+    with memoryview(buf) as view:
+        with view[offset:offset + size*count] as col:
+            if sys.byteorder == "little":
+                with col.cast(typecode) as deltas:
+                    return list(itertools.accumulate(
+                        itertools.chain((first,), deltas)))
+            # Columns are stored little endian, swap them on big
+            # endian hosts
+            deltas = array.array(typecode, col)
+            deltas.byteswap()
+            return list(itertools.accumulate(
+                itertools.chain((first,), deltas)))
+
+
+def write_column_file(filename, sample_type, samples):
+    """Write a new column file
+
+    Args:
+       filename (str): Path of the file to create, which must not exist
+       sample_type (int): Sample type of every sample in the file
+       samples (list): (timestamp, total_yield) tuples in timestamp order
+    """
+    if not samples:
+        raise ValueError("Refusing to write an empty column file")
+    if os.path.exists(filename):
+        raise Error("Column file %s already exists" % filename)
+
+    first_ts, first_yield = samples[0]
+    tdeltas = []
+    ydeltas = []
+    for (t0, y0), (t1, y1) in zip(samples, samples[1:]):
+        if t1 <= t0:
+            raise ValueError("Samples must be in increasing timestamp order")
+        tdeltas.append(t1 - t0)
+        ydeltas.append(y1 - y0)
+
+    if (max(tdeltas, default=0) < 2**32
+            and -2**31 <= min(ydeltas, default=0)
+            and max(ydeltas, default=0) < 2**31):
+        version = VERSION
+    else:
+        version = VERSION_WIDE
+    tcode, ycode = _COLUMNS[version]
+
+    tmpname = filename + ".tmp"
+    with open(tmpname, "wb") as f:
+        f.write(_header.pack(MAGIC, version, sample_type, len(samples),
+                             first_ts, first_yield))
+        f.write(struct.pack("<%d%s" % (len(tdeltas), tcode), *tdeltas))
+        f.write(struct.pack("<%d%s" % (len(ydeltas), ycode), *ydeltas))
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmpname, filename)
+
+
+class ColumnFile(object):
+    """A read-only, memory mapped column file"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, self.sample_type, self.count, \
+            self.first_ts, self.first_yield = _header.unpack_from(self.mm, 0)
+        if magic != MAGIC or version not in _COLUMNS:
+            raise Error("Bad column file %s" % filename)
+        self.tcode, self.ycode = _COLUMNS[version]
+        self.tsize = struct.calcsize("<" + self.tcode)
+        ysize = struct.calcsize("<" + self.ycode)
+        if len(self.mm) != (_header.size
+                            + (self.tsize + ysize) * (self.count - 1)):
+            raise Error("Truncated column file %s" % filename)
+
+        self._timestamps = None
+        self._yields = None
+
+    def close(self):
+        self.mm.close()
+
+    @property
+    def timestamps(self):
+        if self._timestamps is None:
+            self._timestamps = _decode_column(self.mm, _header.size,
+                                              self.count - 1, self.tcode,
+                                              self.first_ts)
+        return self._timestamps
+
+    @property
+    def yields(self):
+        if self._yields is None:
+            n = self.count - 1
+            self._yields = _decode_column(self.mm,
+                                          _header.size + self.tsize*n, n,
+                                          self.ycode, self.first_yield)
+        return self._yields
+
+    def first(self):
+        return self.first_ts
+
+    def last(self):
+        return self.timestamps[-1]
+
+    def get(self, ts):
+        i = bisect.bisect_left(self.timestamps, ts)
+        if i < self.count and self.timestamps[i] == ts:
+            return self.yields[i]
+        return None
+
+    def range(self, from_ts, to_ts):
+        """Return (timestamp, total_yield) for samples in [from_ts, to_ts)"""
+        lo = bisect.bisect_left(self.timestamps, from_ts)
+        hi = bisect.bisect_left(self.timestamps, to_ts)
+        return list(zip(self.timestamps[lo:hi], self.yields[lo:hi]))
+
+    def latest_before(self, ts):
+        """Return (total_yield, timestamp) of the newest sample before ts"""
+        i = bisect.bisect_left(self.timestamps, ts)
+        if i == 0:
+            return None
+        return (self.yields[i-1], self.timestamps[i-1])
+
+
+class ColumnArchive(object):
+    """A directory of column files"""
+
+    SUFFIX = ".col"
+    MAX_OPEN = 64
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.files = collections.OrderedDict()
+
+    def _path(self, serial, month, sample_type):
+        return os.path.join(self.directory, str(serial),
+                            "%s.%d%s" % (month_name(month), sample_type,
+                                         self.SUFFIX))
+
+    def open(self, filename):
+        # Column files are immutable once written, so recently used
+        # decoded columns can be kept around without invalidation
+        if filename in self.files:
+            self.files.move_to_end(filename)
+        else:
+            self.files[filename] = ColumnFile(filename)
+            if len(self.files) > self.MAX_OPEN:
+                name, old = self.files.popitem(last=False)
+                old.close()
+        return self.files[filename]
+
+    def close(self):
+        for cf in self.files.values():
+            cf.close()
+        self.files.clear()
+
+    def serials(self):
+        try:
+            return sorted(os.listdir(self.directory))
+        except FileNotFoundError:
+            return []
+
+    def has_month(self, serial, month):
+        mname = month_name(month)
+        return any(f.startswith(mname + ".")
+                   for f in self._listdir(serial))
+
+    def _listdir(self, serial):
+        try:
+            return os.listdir(os.path.join(self.directory, str(serial)))
+        except FileNotFoundError:
+            return []
+
+    def _months(self, serial, from_ts=None, to_ts=None):
+        """Map month name to file names for an inverter's archived months
+        which could hold samples in [from_ts, to_ts)"""
+        first = None if from_ts is None else month_name(from_ts)
+        last = None if to_ts is None else month_name(to_ts - 1)
+        months = collections.OrderedDict()
+        for f in sorted(self._listdir(serial)):
+            if not f.endswith(self.SUFFIX):
+                continue
+            mname = f.split(".", 1)[0]
+            if first is not None and mname < first:
+                continue
+            if last is not None and mname > last:
+                continue
+            path = os.path.join(self.directory, str(serial), f)
+            months.setdefault(mname, []).append(path)
+        return months
+
+    def column_files(self, serial, from_ts=None, to_ts=None):
+        """Open the column files for an inverter that could hold samples
+        in [from_ts, to_ts), in time order"""
+        return [self.open(path)
+                for paths in self._months(serial, from_ts, to_ts).values()
+                for path in paths]
+
+    def latest_before(self, serial, ts=None, sample_type=None):
+        """Return (total_yield, timestamp) of an inverter's newest archived
+        sample before ts, or None"""
+        for paths in reversed(self._months(serial, None, ts).values()):
+            best = None
+            for path in paths:
+                cf = self.open(path)
+                if sample_type is not None and cf.sample_type != sample_type:
+                    continue
+                if ts is None:
+                    cand = (cf.yields[-1], cf.last())
+                else:
+                    cand = cf.latest_before(ts)
+                if cand is not None and (best is None or cand[1] > best[1]):
+                    best = cand
+            # Months are searched newest first, so the first hit wins
+            if best is not None:
+                return best
+        return None
+
+    def add_month(self, serial, month, samples):
+        """Archive one inverter's samples for a month
+
+        Args:
+           serial: Inverter serial number
+           month (int): Timestamp of the start of the month
+           samples (list): (timestamp, sample_type, total_yield) tuples
+        """
+        bytype = {}
+        for ts, sample_type, y in samples:
+            bytype.setdefault(sample_type, []).append((ts, y))
+
+        os.makedirs(os.path.join(self.directory, str(serial)), exist_ok=True)
+        for sample_type, data in sorted(bytype.items()):
+            data.sort()
+            write_column_file(self._path(serial, month, sample_type),
+                              sample_type, data)
+
+
+class ArchiveDatabase(BaseDatabase):
+    """A hot database backed by a ColumnArchive for closed months
+
+    Writes go to the hot database.  Queries are answered from both tiers,
+    so callers don't need to care where a sample is stored.
+    """
+
+    def __init__(self, hot, archive):
+        super(ArchiveDatabase, self).__init__()
+        self.hot = hot
+        self.archive = archive
+
+    def __getattr__(self, name):
+        # Everything without an archive aware version only needs the
+        # hot tier (e.g. the pvoutput upload bookkeeping)
+        if name == "hot":
+            raise AttributeError(name)
+        return getattr(self.hot, name)
+
+    def commit(self):
+        self.hot.commit()
+
+    def add_sample(self, serial, timestamp, sample_type, total_yield):
+        self.hot.add_sample(serial, timestamp, sample_type, total_yield)
+
+    def add_samples(self, serial, sample_type, samples):
+        self.hot.add_samples(serial, sample_type, samples)
+
+    def get_watermark(self, consumer, serial, sample_type):
+        return self.hot.get_watermark(consumer, serial, sample_type)
+
+    def set_watermark(self, consumer, serial, sample_type, timestamp):
+        self.hot.set_watermark(consumer, serial, sample_type, timestamp)
+
+    def advance_watermark(self, consumer, serial, sample_type, timestamp):
+        self.hot.advance_watermark(consumer, serial, sample_type, timestamp)
+
+    def get_one_sample(self, serial, timestamp):
+        y = self.hot.get_one_sample(serial, timestamp)
+        if y is not None:
+            return y
+        for cf in self.archive.column_files(serial, timestamp, timestamp + 1):
+            y = cf.get(timestamp)
+            if y is not None:
+                return y
+        return None
+
+    def get_last_sample(self, serial, sample_type=None):
+        last = self.hot.get_last_sample(serial, sample_type)
+        cand = self.archive.latest_before(serial, sample_type=sample_type)
+        if cand is not None and (last is None or cand[1] > last):
+            last = cand[1]
+        return last
+
+    def get_first_sample(self, serial):
+        first = self.hot.get_first_sample(serial)
+        files = self.archive.column_files(serial)
+        if files:
+            afirst = min(cf.first() for cf in files)
+            if first is None or afirst < first:
+                first = afirst
+        return first
+
+    def serials(self):
+        serials = set(str(s) for s in self.hot.serials())
+        serials.update(self.archive.serials())
+        return sorted(serials)
+
+    def get_samples(self, serial, from_ts, to_ts, dense=False):
+        samples = self.hot.get_samples(serial, from_ts, to_ts, dense)
+        for cf in self.archive.column_files(serial, from_ts, to_ts):
+            samples.extend((ts, cf.sample_type, y)
+                           for ts, y in cf.range(from_ts, to_ts))
+        samples.sort()
+        return samples
+
+    def delete_samples(self, serial, from_ts, to_ts):
+        # Column files are immutable, so only the hot tier is affected
+        return self.hot.delete_samples(serial, from_ts, to_ts)
+
+    def downsample(self, serial, sample_type, from_ts, to_ts, interval):
+        # As with delete_samples(), only the hot tier is affected
+        return self.hot.downsample(serial, sample_type, from_ts, to_ts,
+                                   interval)
+
+    def get_aggregate_one_sample(self, ts, ids,
+                                 sample_type=SAMPLE_INV_FAST):
+        total = self.hot.get_aggregate_one_sample(ts, ids, sample_type)
+        for serial in ids:
+            files = self.archive.column_files(serial, ts, ts + 1)
+            if not files:
+                continue
+            hot = self._hot_samples(serial, ts, ts + 1)
+            for cf in files:
+                if sample_type is not None and cf.sample_type != sample_type:
+                    continue
+                y = cf.get(ts)
+                if y is not None and (ts, cf.sample_type) not in hot:
+                    total = y if total is None else total + y
+        return total
+
+    def get_aggregate_samples(self, from_ts, to_ts, ids, dense=False):
+        hot_totals = dict(self.hot.get_aggregate_samples(from_ts, to_ts, ids,
+                                                         dense))
+        totals = dict(hot_totals)
+        for serial in ids:
+            files = self.archive.column_files(serial, from_ts, to_ts)
+            if not files:
+                continue
+            hot = self._hot_samples(serial, from_ts, to_ts)
+            for cf in files:
+                for ts, y in cf.range(from_ts, to_ts):
+                    if (ts, cf.sample_type) in hot and ts in hot_totals:
+                        # Already counted from the hot copy
+                        continue
+                    totals[ts] = totals.get(ts, 0) + y
+        return sorted(totals.items())
+
+    def _hot_samples(self, serial, from_ts, to_ts):
+        """(timestamp, sample_type) of one inverter's hot samples
+
+        A sample can be in both tiers, e.g. when archiving was
+        interrupted before the hot copies were removed.  The hot copy
+        is the one which counts.
+        """
+        return set((ts, st) for ts, st, y
+                   in self.hot.get_samples(serial, from_ts, to_ts,
+                                           dense=True))
+
+    def get_yield_at(self, ts, ids, sample_type=SAMPLE_INV_FAST):
+        latest = self.hot.get_latest_samples_before(ts, ids)
+        for serial in ids:
+            cand = self.archive.latest_before(serial, ts)
+            cur = latest.get(str(serial))
+            if cand is not None and (cur is None or cand[1] > cur[1]):
+                latest[str(serial)] = cand
+        if not latest:
+            return None
+        assert(len(latest) == len(ids))
+        return total_yield_at(ts, latest)
+
+    def archive_before(self, cutoff):
+        """Move every month which closed before cutoff to the archive
+
+        Returns:
+           int.  The number of samples moved
+        """
+        moved = 0
+        for serial in self.hot.serials():
+            first = self.hot.get_first_sample(serial)
+            if first is None:
+                continue
+            month = month_start(first)
+            while next_month(month) <= cutoff:
+                end = next_month(month)
+                samples = self.hot.get_samples(serial, month, end,
+                                               dense=True)
+                if not samples:
+                    pass
+                elif not self.archive.has_month(serial, month):
+                    self.archive.add_month(serial, month, samples)
+                    moved += self.hot.delete_samples(serial, month, end)
+                    self.hot.commit()
+                elif self._archived(serial, month, end, samples):
+                    # A previous run was interrupted between writing the
+                    # column files and removing the hot copies
+                    self.hot.delete_samples(serial, month, end)
+                    self.hot.commit()
+                # Otherwise months are never rewritten, anything arriving
+                # late for an archived month just stays in the hot tier
+                month = end
+        return moved
+
+    def _archived(self, serial, from_ts, to_ts, samples):
+        files = dict((cf.sample_type, cf) for cf
+                     in self.archive.column_files(serial, from_ts, to_ts))
+        for ts, sample_type, y in samples:
+            cf = files.get(sample_type)
+            if cf is None or cf.get(ts) != y:
+                return False
+        return True
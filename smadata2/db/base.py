@@ -19,6 +19,8 @@
 
 import abc
 
+from .. import datetimeutil
+
 # Ad hoc samples, externally controlled
 SAMPLE_ADHOC = 0
 # Inverter recorded high(ish) frequency samples
@@ -28,10 +30,25 @@ SAMPLE_INV_DAILY = 2
 
 SAMPLETYPES = [SAMPLE_ADHOC, SAMPLE_INV_FAST, SAMPLE_INV_DAILY]
 
-all = ['Error', 'WrongSchema', 'StaleResults',
+# Watermark consumers
+WATERMARK_INGEST = "ingest"
+WATERMARK_PVOUTPUT = "pvoutput"
+WATERMARK_PVOUTPUT_DAILY = "pvoutput-daily"
+WATERMARK_RETENTION = "retention"
+
+# States of a batch in the pvoutput.org outbox.  Batches which have been
+# completely uploaded are removed.
+OUTBOX_PENDING = "pending"
+OUTBOX_SENDING = "sending"
+OUTBOX_FAILED = "failed"
+
+all = ['Error', 'WrongSchema', 'StaleResults', 'DuplicateSample',
        'STALE_SECONDS',
        'SAMPLE_ADHOC', 'SAMPLE_INV_FAST', 'SAMPLE_INV_DAILY',
-       'SAMPLETYPES']
+       'SAMPLETYPES',
+       'WATERMARK_INGEST', 'WATERMARK_PVOUTPUT', 'WATERMARK_PVOUTPUT_DAILY',
+       'WATERMARK_RETENTION',
+       'OUTBOX_PENDING', 'OUTBOX_SENDING', 'OUTBOX_FAILED', 'OutboxBatch']
 
 
 class Error(Exception):
@@ -42,6 +59,11 @@ class WrongSchema(Error):
     pass
 
 
+class DuplicateSample(Error):
+    """A sample is already stored for that inverter, type and time"""
+    pass
+
+
 # For yieldat, complain if we can't find results less than a day old
 STALE_SECONDS = 24*60*60
 
@@ -49,11 +71,100 @@ class StaleResults(Error):
     pass
 
 
+class OutboxBatch(object):
+    """Statuses queued for upload to one pvoutput.org system
+
+    Statuses are (timestamp, total yield) pairs.  Those up to sent_ts
+    are known to have reached the server.
+    """
+
+    def __init__(self, sid, statuses, state=OUTBOX_PENDING, sent_ts=None,
+                 attempts=0, error=None):
+        self.sid = str(sid)
+        self.statuses = [tuple(s) for s in statuses]
+        self.first_ts = self.statuses[0][0]
+        self.last_ts = self.statuses[-1][0]
+        self.state = state
+        self.sent_ts = sent_ts
+        self.attempts = attempts
+        self.error = error
+
+    def unsent(self):
+        if self.sent_ts is None:
+            return list(self.statuses)
+        return [s for s in self.statuses if s[0] > self.sent_ts]
+
+    def __repr__(self):
+        return ("OutboxBatch(%s, %d-%d, %s)"
+                % (self.sid, self.first_ts, self.last_ts, self.state))
+
+
+def total_yield_at(ts, latest):
+    """Sum the latest per-inverter samples preceding ts
+
+    Args:
+       ts (int): The time the total is wanted for
+       latest (dict): Maps serial to (total_yield, timestamp)
+    Raises:
+       StaleResults if any inverter's latest sample is too old
+    """
+    total = 0
+    for serial, (yield_, timestamp) in sorted(latest.items()):
+        total += yield_
+        stale = ts - timestamp
+        if stale > STALE_SECONDS:
+            msg = ("Latest data from inverter {} is at {}"
+                   " ({} days, {} hours stale)")
+            oldtime = datetimeutil.format_time(timestamp)
+            stalehours = round(stale / 60 / 60)
+            raise StaleResults(msg.format(serial, oldtime,
+                                          stalehours // 24,
+                                          stalehours % 24))
+    return total
+
+
 class BaseDatabase(object, metaclass=abc.ABCMeta):
     @abc.abstractmethod
     def add_sample(self, serial, timestamp, sample_type, total_yield):
         raise NotImplementedError()
 
+    def add_samples(self, serial, sample_type, samples):
+        """Add a batch of (timestamp, total_yield) samples for one inverter
+
+        Backends can override this with something faster than adding
+        samples one at a time.
+        """
+        for timestamp, total_yield in samples:
+            self.add_sample(serial, timestamp, sample_type, total_yield)
+
+    @abc.abstractmethod
+    def downsample(self, serial, sample_type, from_ts, to_ts, interval):
+        """Keep only the first sample in each interval of [from_ts, to_ts)
+
+        Samples are cumulative, so the survivors still give exact totals
+        at coarser resolution.  from_ts and to_ts should be multiples of
+        interval.
+
+        Returns:
+           int.  The number of samples removed
+        """
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    def get_watermark(self, consumer, serial, sample_type):
+        """Return how far consumer has processed serial's samples of
+        sample_type, or None"""
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    def set_watermark(self, consumer, serial, sample_type, timestamp):
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    def advance_watermark(self, consumer, serial, sample_type, timestamp):
+        """Like set_watermark(), but never moves a watermark backwards"""
+        raise NotImplementedError()
+
     @abc.abstractmethod
     def get_one_sample(self, serial, timestamp):
         raise NotImplementedError()
@@ -63,9 +174,15 @@ class BaseDatabase(object, metaclass=abc.ABCMeta):
         raise NotImplementedError()
 
     @abc.abstractmethod
-    def get_aggregate_one_sample(self, ts, ids):
+    def get_aggregate_one_sample(self, ts, ids,
+                                 sample_type=SAMPLE_INV_FAST):
         raise NotImplementedError()
 
     @abc.abstractmethod
-    def get_aggregate_samples(self, from_ts, to_ts, ids):
+    def get_aggregate_samples(self, from_ts, to_ts, ids, dense=False):
+        """Per-timestamp totals of several inverters' samples
+
+        Backends which compress flat runs only return every timestamp
+        within a run if dense is True.
+        """
         raise NotImplementedError()
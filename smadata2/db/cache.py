@@ -0,0 +1,232 @@
+#! /usr/bin/python3
+#
+# smadata2.db.cache - Read-through query cache
+# Copyright (C) 2014 David Gibson <david@gibson.dropbear.id.au>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import collections
+import threading
+import time
+
+from .base import BaseDatabase, SAMPLE_INV_FAST
+
+all = ['CachedDatabase']
+
+# Open ended time ranges
+_MIN_TS = float("-inf")
+_MAX_TS = float("inf")
+
+
+class _Entry(object):
+    __slots__ = ("value", "serials", "from_ts", "to_ts", "expires")
+
+    def __init__(self, value, serials, from_ts, to_ts, expires):
+        self.value = value
+        self.serials = serials
+        self.from_ts = from_ts
+        self.to_ts = to_ts
+        self.expires = expires
+
+
+class CachedDatabase(BaseDatabase):
+    """An LRU cache of query results in front of another database
+
+    Each cached result remembers which inverters and which [from, to)
+    time range it was computed from.  Adding or deleting samples only
+    drops the results whose inputs overlap the change, everything else
+    stays cached.  Results also expire after ttl seconds, to cover writes
+    made to the underlying database by someone else.
+
+    The cache can be shared between threads, as over a
+    PooledSQLiteDatabase.  Its bookkeeping is done under a lock, but
+    queries run outside it so they can still run concurrently.
+    """
+
+    def __init__(self, db, size=256, ttl=300, clock=time.monotonic):
+        super(CachedDatabase, self).__init__()
+        self.db = db
+        self.size = size
+        self.ttl = ttl
+        self.clock = clock
+
+        self.entries = collections.OrderedDict()
+        self.byserial = collections.defaultdict(set)
+        self.lock = threading.Lock()
+        # Bumped by every invalidation, so a result computed while one
+        # happened isn't cached
+        self.generation = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def __getattr__(self, name):
+        # Anything we don't cache goes straight to the real database
+        if name in ("db", "lock"):
+            raise AttributeError(name)
+        return getattr(self.db, name)
+
+    def stats(self):
+        return {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "invalidations": self.invalidations,
+        }
+
+    def __str__(self):
+        lookups = self.hits + self.misses
+        ratio = (100.0 * self.hits / lookups) if lookups else 0.0
+        return ("%d/%d entries, %d hits, %d misses (%.1f%%), %d evicted,"
+                " %d expired, %d invalidated"
+                % (len(self.entries), self.size, self.hits, self.misses,
+                   ratio, self.evictions, self.expirations,
+                   self.invalidations))
+
+    def _drop(self, key):
+        entry = self.entries.pop(key)
+        for serial in entry.serials:
+            self.byserial[serial].discard(key)
+            if not self.byserial[serial]:
+                del self.byserial[serial]
+
+    def _lookup(self, key, serials, from_ts, to_ts, fn):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if self.clock() < entry.expires:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return entry.value
+                self._drop(key)
+                self.expirations += 1
+            self.misses += 1
+            generation = self.generation
+
+        value = fn()
+
+        serials = frozenset(str(s) for s in serials)
+        with self.lock:
+            if self.generation != generation:
+                # Samples changed meanwhile, value may or may not show it
+                return value
+            if key in self.entries:
+                self._drop(key)
+            self.entries[key] = _Entry(value, serials, from_ts, to_ts,
+                                       self.clock() + self.ttl)
+            for serial in serials:
+                self.byserial[serial].add(key)
+            while len(self.entries) > self.size:
+                self._drop(next(iter(self.entries)))
+                self.evictions += 1
+        return value
+
+    def invalidate(self, serial, from_ts=_MIN_TS, to_ts=_MAX_TS):
+        """Drop cached results which depend on samples from serial in
+        [from_ts, to_ts]"""
+        with self.lock:
+            self.generation += 1
+            for key in list(self.byserial.get(str(serial), ())):
+                entry = self.entries[key]
+                if entry.from_ts <= to_ts and from_ts < entry.to_ts:
+                    self._drop(key)
+                    self.invalidations += 1
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+            self.byserial.clear()
+
+    #
+    # Writes
+    #
+    def commit(self):
+        self.db.commit()
+
+    def add_sample(self, serial, timestamp, sample_type, total_yield):
+        self.db.add_sample(serial, timestamp, sample_type, total_yield)
+        self.invalidate(serial, timestamp, timestamp)
+
+    def add_samples(self, serial, sample_type, samples):
+        samples = list(samples)
+        self.db.add_samples(serial, sample_type, samples)
+        if samples:
+            stamps = [ts for ts, y in samples]
+            self.invalidate(serial, min(stamps), max(stamps))
+
+    # Watermarks are single row lookups, so they aren't worth caching
+    def get_watermark(self, consumer, serial, sample_type):
+        return self.db.get_watermark(consumer, serial, sample_type)
+
+    def set_watermark(self, consumer, serial, sample_type, timestamp):
+        self.db.set_watermark(consumer, serial, sample_type, timestamp)
+
+    def advance_watermark(self, consumer, serial, sample_type, timestamp):
+        self.db.advance_watermark(consumer, serial, sample_type, timestamp)
+
+    def delete_samples(self, serial, from_ts, to_ts):
+        n = self.db.delete_samples(serial, from_ts, to_ts)
+        self.invalidate(serial, from_ts, to_ts - 1)
+        return n
+
+    def downsample(self, serial, sample_type, from_ts, to_ts, interval):
+        n = self.db.downsample(serial, sample_type, from_ts, to_ts, interval)
+        self.invalidate(serial, from_ts, to_ts - 1)
+        return n
+
+    #
+    # Cached queries
+    #
+    def get_one_sample(self, serial, timestamp):
+        return self._lookup(("one", str(serial), timestamp),
+                            (serial,), timestamp, timestamp + 1,
+                            lambda: self.db.get_one_sample(serial,
+                                                           timestamp))
+
+    def get_last_sample(self, serial, sample_type=None):
+        return self._lookup(("last", str(serial), sample_type),
+                            (serial,), _MIN_TS, _MAX_TS,
+                            lambda: self.db.get_last_sample(serial,
+                                                            sample_type))
+
+    def get_aggregate_one_sample(self, ts, ids,
+                                 sample_type=SAMPLE_INV_FAST):
+        ids = tuple(ids)
+        return self._lookup(("aggone", ts, ids, sample_type),
+                            ids, ts, ts + 1,
+                            lambda: self.db.get_aggregate_one_sample(
+                                ts, ids, sample_type))
+
+    def get_aggregate_samples(self, from_ts, to_ts, ids, dense=False):
+        ids = tuple(ids)
+        value = self._lookup(("agg", from_ts, to_ts, ids, dense),
+                             ids, from_ts, to_ts,
+                             lambda: tuple(self.db.get_aggregate_samples(
+                                 from_ts, to_ts, ids, dense)))
+        # Callers are allowed to trim the list they get back
+        return list(value)
+
+    def get_yield_at(self, ts, ids, sample_type=SAMPLE_INV_FAST):
+        ids = tuple(ids)
+        return self._lookup(("yieldat", ts, ids, sample_type),
+                            ids, _MIN_TS, ts,
+                            lambda: self.db.get_yield_at(ts, ids,
+                                                         sample_type))
@@ -0,0 +1,259 @@
+#! /usr/bin/python3
+#
+# smadata2.db.memory - Indexed in-memory database
+# Copyright (C) 2014 David Gibson <david@gibson.dropbear.id.au>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import bisect
+
+from .base import BaseDatabase, DuplicateSample, SAMPLE_INV_FAST
+from .base import WATERMARK_INGEST, WATERMARK_PVOUTPUT
+from .base import OutboxBatch, OUTBOX_FAILED
+from .base import total_yield_at
+
+all = ['MemoryDatabase']
+
+
+class Series(object):
+    """Samples for one (serial, sample_type), kept sorted by timestamp"""
+
+    def __init__(self):
+        self.timestamps = []
+        self.yields = []
+
+    def add(self, timestamp, total_yield):
+        i = bisect.bisect_left(self.timestamps, timestamp)
+        if i < len(self.timestamps) and self.timestamps[i] == timestamp:
+            raise DuplicateSample("Duplicate sample at %d" % timestamp)
+        self.timestamps.insert(i, timestamp)
+        self.yields.insert(i, total_yield)
+
+    def get(self, timestamp):
+        i = bisect.bisect_left(self.timestamps, timestamp)
+        if i < len(self.timestamps) and self.timestamps[i] == timestamp:
+            return self.yields[i]
+        return None
+
+    def bounds(self, from_ts, to_ts):
+        return (bisect.bisect_left(self.timestamps, from_ts),
+                bisect.bisect_left(self.timestamps, to_ts))
+
+    def range(self, from_ts, to_ts):
+        lo, hi = self.bounds(from_ts, to_ts)
+        return zip(self.timestamps[lo:hi], self.yields[lo:hi])
+
+    def delete(self, from_ts, to_ts):
+        lo, hi = self.bounds(from_ts, to_ts)
+        del self.timestamps[lo:hi]
+        del self.yields[lo:hi]
+        return hi - lo
+
+    def downsample(self, from_ts, to_ts, interval):
+        lo, hi = self.bounds(from_ts, to_ts)
+        keep = []
+        bucket = None
+        for i in range(lo, hi):
+            if self.timestamps[i] // interval != bucket:
+                bucket = self.timestamps[i] // interval
+                keep.append(i)
+        self.timestamps[lo:hi] = [self.timestamps[i] for i in keep]
+        self.yields[lo:hi] = [self.yields[i] for i in keep]
+        return (hi - lo) - len(keep)
+
+
+class MemoryDatabase(BaseDatabase):
+    """A database held entirely in memory
+
+    Samples are indexed per (serial, sample_type) in sorted arrays, so
+    lookups are bisections rather than scans.  Query semantics follow
+    SQLiteDatabase, which makes this usable both as a test double and as
+    a cache of recent data loaded from another database.
+    """
+
+    def __init__(self):
+        super(MemoryDatabase, self).__init__()
+        # serial -> sample_type -> Series
+        self.series = {}
+        # (consumer, serial, sample_type) -> timestamp
+        self.watermarks = {}
+        # sid -> first_ts -> OutboxBatch
+        self.outbox = {}
+
+    def _series(self, serial, sample_type=None):
+        bytype = self.series.get(str(serial), {})
+        if sample_type is None:
+            return list(bytype.values())
+        if sample_type in bytype:
+            return [bytype[sample_type]]
+        return []
+
+    def commit(self):
+        pass
+
+    def add_sample(self, serial, timestamp, sample_type, total_yield):
+        bytype = self.series.setdefault(str(serial), {})
+        if sample_type not in bytype:
+            bytype[sample_type] = Series()
+        bytype[sample_type].add(timestamp, total_yield)
+        self.advance_watermark(WATERMARK_INGEST, serial, sample_type,
+                               timestamp)
+
+    def get_watermark(self, consumer, serial, sample_type):
+        return self.watermarks.get((consumer, str(serial), sample_type))
+
+    def set_watermark(self, consumer, serial, sample_type, timestamp):
+        self.watermarks[(consumer, str(serial), sample_type)] = timestamp
+
+    def advance_watermark(self, consumer, serial, sample_type, timestamp):
+        old = self.get_watermark(consumer, serial, sample_type)
+        if old is None or timestamp > old:
+            self.set_watermark(consumer, serial, sample_type, timestamp)
+
+    # The pvoutput.org upload position is a per-system watermark, with the
+    # system id standing in for the inverter serial
+    def pvoutput_get_last_datetime_uploaded(self, sid):
+        return self.get_watermark(WATERMARK_PVOUTPUT, sid, SAMPLE_INV_FAST)
+
+    def pvoutput_set_last_datetime_uploaded(self, sid, value):
+        self.set_watermark(WATERMARK_PVOUTPUT, sid, SAMPLE_INV_FAST, value)
+
+    # Batches are copied in and out, as if they'd been stored
+    @staticmethod
+    def _copy(b):
+        return OutboxBatch(b.sid, b.statuses, b.state, b.sent_ts,
+                           b.attempts, b.error)
+
+    def outbox_add(self, sid, statuses):
+        batch = OutboxBatch(sid, statuses)
+        bysid = self.outbox.setdefault(batch.sid, {})
+        if batch.first_ts in bysid:
+            raise ValueError("Duplicate outbox batch at %d" % batch.first_ts)
+        bysid[batch.first_ts] = self._copy(batch)
+        return batch
+
+    def outbox_batches(self, sid):
+        bysid = self.outbox.get(str(sid), {})
+        return [self._copy(bysid[ts]) for ts in sorted(bysid)]
+
+    def outbox_last(self, sid):
+        bysid = self.outbox.get(str(sid), {})
+        if not bysid:
+            return None
+        return max(b.last_ts for b in bysid.values())
+
+    def outbox_update(self, sid, first_ts, state, sent_ts=None, error=None):
+        batch = self.outbox.get(str(sid), {}).get(first_ts)
+        if batch is None:
+            return
+        batch.state = state
+        if sent_ts is not None:
+            batch.sent_ts = sent_ts
+        batch.error = error
+        if state == OUTBOX_FAILED:
+            batch.attempts += 1
+
+    def outbox_done(self, sid, first_ts):
+        batch = self.outbox.get(str(sid), {}).pop(first_ts, None)
+        if batch is not None:
+            self.advance_watermark(WATERMARK_PVOUTPUT, sid, SAMPLE_INV_FAST,
+                                   batch.last_ts)
+
+    def load(self, db, ids, from_ts, to_ts):
+        """Copy samples for some inverters in [from_ts, to_ts) from another
+        database"""
+        for serial in ids:
+            for ts, sample_type, y in db.get_samples(serial, from_ts, to_ts,
+                                                     dense=True):
+                self.add_sample(serial, ts, sample_type, y)
+
+    def get_one_sample(self, serial, timestamp):
+        for s in self._series(serial):
+            y = s.get(timestamp)
+            if y is not None:
+                return y
+        return None
+
+    def get_last_sample(self, serial, sample_type=None):
+        stamps = [s.timestamps[-1] for s in self._series(serial, sample_type)
+                  if s.timestamps]
+        if stamps:
+            return max(stamps)
+        return None
+
+    def get_first_sample(self, serial):
+        stamps = [s.timestamps[0] for s in self._series(serial)
+                  if s.timestamps]
+        if stamps:
+            return min(stamps)
+        return None
+
+    def serials(self):
+        return sorted(ser for ser, bytype in self.series.items()
+                      if any(s.timestamps for s in bytype.values()))
+
+    def get_samples(self, serial, from_ts, to_ts, dense=False):
+        samples = []
+        for st, s in self.series.get(str(serial), {}).items():
+            samples.extend((ts, st, y) for ts, y in s.range(from_ts, to_ts))
+        samples.sort()
+        return samples
+
+    def delete_samples(self, serial, from_ts, to_ts):
+        return sum(s.delete(from_ts, to_ts) for s in self._series(serial))
+
+    def downsample(self, serial, sample_type, from_ts, to_ts, interval):
+        return sum(s.downsample(from_ts, to_ts, interval)
+                   for s in self._series(serial, sample_type))
+
+    def get_aggregate_one_sample(self, ts, ids,
+                                 sample_type=SAMPLE_INV_FAST):
+        vals = [y for serial in ids
+                for s in self._series(serial, sample_type)
+                for y in (s.get(ts),) if y is not None]
+        if not vals:
+            return None
+        return sum(vals)
+
+    def get_aggregate_samples(self, from_ts, to_ts, ids, dense=False):
+        totals = {}
+        for serial in ids:
+            for s in self._series(serial):
+                for ts, y in s.range(from_ts, to_ts):
+                    totals[ts] = totals.get(ts, 0) + y
+        return sorted(totals.items())
+
+    def get_latest_samples_before(self, ts, ids):
+        latest = {}
+        for serial in ids:
+            yields = []
+            stamps = []
+            for s in self._series(serial):
+                lo, hi = s.bounds(ts, ts)
+                if lo:
+                    # Yields are cumulative, so the newest is also the
+                    # largest, as SQLiteDatabase's max() assumes
+                    yields.append(s.yields[lo-1])
+                    stamps.append(s.timestamps[lo-1])
+            if stamps:
+                latest[str(serial)] = (max(yields), max(stamps))
+        return latest
+
+    def get_yield_at(self, ts, ids, sample_type=SAMPLE_INV_FAST):
+        latest = self.get_latest_samples_before(ts, ids)
+        if not latest:
+            return None
+        assert(len(latest) == len(ids))
+        return total_yield_at(ts, latest)
@@ -17,44 +17,9 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
-from .base import BaseDatabase
+from .memory import MemoryDatabase
 
 
-class MockDatabase(BaseDatabase):
-    def __init__(self):
-        super(MockDatabase, self).__init__()
-        self.samples = set()
-
-    def add_sample(self, serial, timestamp, sample_type, total_yield):
-        self.samples.add((serial, timestamp, total_yield))
-
-    def get_one_sample(self, serial, timestamp):
-        for s, t, y in self.samples:
-            if (s == serial) and (t == timestamp):
-                return y
-        return None
-
-    def get_last_sample(self, serial, sample_type=None):
-        stamps = set(t for s, t, y in self.samples)
-        if stamps:
-            return max(stamps)
-        else:
-            return None
-
-    def get_aggregate_one_sample(self, ts, ids):
-        vals = set(y for s, t, y in self.samples
-                   if (t == ts) and (s in ids))
-        return sum(vals)
-
-    def get_aggregate_samples(self, from_ts, to_ts, ids):
-        rd = {}
-        for s, t, y in self.samples:
-            if (s in ids) and (t >= from_ts) and (t < to_ts):
-                if t not in rd:
-                    rd[t] = y
-                else:
-                    rd[t] += y
-        rl = []
-        for t in sorted(rd.keys()):
-            rl.append((t, rd[t]))
-        return rl
+class MockDatabase(MemoryDatabase):
+    """Kept for existing users; MemoryDatabase is the real implementation"""
+    pass
@@ -0,0 +1,269 @@
+#! /usr/bin/python3
+#
+# smadata2.db.pool - Thread safe pool of SQLite connections
+# Copyright (C) 2014 David Gibson <david@gibson.dropbear.id.au>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import contextlib
+import queue
+import threading
+
+from .base import BaseDatabase, Error, SAMPLE_INV_FAST
+from .sqlite import SQLiteDatabase
+
+all = ['PooledSQLiteDatabase']
+
+
+class PooledSQLiteDatabase(BaseDatabase):
+    """An SQLite database which can be shared between threads
+
+    Writes all go through one connection.  A thread's first write takes
+    it for a whole transaction, and other threads' writes wait until that
+    thread commits or rolls back, so every write must be followed by one
+    or the other from the same thread.  Reads borrow a connection from a
+    pool, so they run concurrently and see committed data.  The exception
+    is the thread with a transaction open, whose reads use the write
+    connection so they see its own writes too.  A read nested inside
+    another (such as while a stream is open) reuses the thread's reader.
+    The database is switched to WAL journalling so readers and the
+    writer don't block each other.
+
+    Each connection keeps its own cache of prepared statements, and
+    waits up to timeout seconds for a lock held elsewhere (such as by
+    another process) before giving up.  Waiting for a free reader gives
+    up after timeout seconds too.
+    """
+
+    def __init__(self, filename, readers=4, timeout=30.0,
+                 cached_statements=128, **options):
+        super(PooledSQLiteDatabase, self).__init__()
+        self.filename = filename
+        self.timeout = timeout
+        self.options = dict(options, timeout=timeout,
+                            cached_statements=cached_statements,
+                            check_same_thread=False)
+
+        self.writer = SQLiteDatabase(filename, **self.options)
+        self.writer.conn.execute("PRAGMA journal_mode = WAL")
+        # Held by the thread with a write transaction open, the owner
+        self.lock = threading.RLock()
+        self.owner = None
+        self.local = threading.local()
+
+        # Reader connections are opened as they're first needed
+        self.readers = queue.LifoQueue()
+        for i in range(readers):
+            self.readers.put(None)
+
+    # Other SQLiteDatabase methods which only read, and so can borrow a
+    # reader without wrappers of their own
+    READS = frozenset(["get_latest_samples_before", "midnights",
+                       "get_datapoint_totals_for_day", "get_entries",
+                       "all_history", "serials", "get_first_sample",
+                       "get_samples", "get_productions_younger_than",
+                       "pvoutput_get_last_datetime_uploaded",
+                       "outbox_batches", "outbox_last", "is_frozen",
+                       "partition_key", "partition_filename"])
+
+    def __getattr__(self, name):
+        if name in ("writer", "readers", "local"):
+            raise AttributeError(name)
+        if name in self.READS:
+            def read(*args, **kwargs):
+                with self.reader() as db:
+                    return getattr(db, name)(*args, **kwargs)
+            return read
+        if callable(getattr(SQLiteDatabase, name, None)):
+            # Could write, and a reader would lose (or lock up) the write
+            raise AttributeError("%s isn't available through the pool"
+                                 % name)
+        return getattr(self.writer, name)
+
+    @contextlib.contextmanager
+    def reader(self):
+        """Borrow a database for reading"""
+        if self.owner == threading.get_ident():
+            # Only this thread can end its own transaction
+            yield self.writer
+            return
+        held = getattr(self.local, "reader", None)
+        if held is not None:
+            # Waiting for a second reader could wait on ourselves
+            self.local.depth += 1
+            try:
+                yield held
+            finally:
+                self.local.depth -= 1
+                self._release_reader()
+            return
+
+        try:
+            db = self.readers.get(timeout=self.timeout)
+        except queue.Empty:
+            raise Error("No free reader connection after %gs"
+                        % self.timeout)
+        try:
+            if db is None:
+                db = SQLiteDatabase(self.filename, **self.options)
+            elif db.partitions != self.writer.partitions:
+                # The writer has created a partition since
+                db.partitions = db._find_partitions()
+        except Exception:
+            self.readers.put(db)
+            raise
+        self.local.reader = db
+        self.local.depth = 1
+        try:
+            yield db
+        finally:
+            self.local.depth -= 1
+            self._release_reader()
+
+    def _release_reader(self):
+        """Return this thread's reader once nothing is using it"""
+        if self.local.depth == 0:
+            db = self.local.reader
+            self.local.reader = None
+            self.readers.put(db)
+
+    @contextlib.contextmanager
+    def writer_db(self):
+        """Take the database for writing, until commit() or rollback()"""
+        if self.owner != threading.get_ident():
+            self.lock.acquire()
+            self.owner = threading.get_ident()
+        yield self.writer
+
+    def _end(self):
+        """End this thread's transaction, letting other writers in"""
+        self.owner = None
+        self.lock.release()
+
+    def close(self):
+        with self.lock:
+            self.writer.close()
+        while not self.readers.empty():
+            db = self.readers.get()
+            if db is not None:
+                db.close()
+
+    #
+    # Writes
+    #
+    def commit(self):
+        # Only this thread's own writes, if it has any
+        if self.owner != threading.get_ident():
+            return
+        try:
+            self.writer.commit()
+        finally:
+            self._end()
+
+    def rollback(self):
+        if self.owner != threading.get_ident():
+            return
+        try:
+            self.writer.conn.rollback()
+        finally:
+            self._end()
+
+    def add_sample(self, serial, timestamp, sample_type, total_yield):
+        with self.writer_db() as db:
+            db.add_sample(serial, timestamp, sample_type, total_yield)
+
+    def add_samples(self, serial, sample_type, samples):
+        with self.writer_db() as db:
+            db.add_samples(serial, sample_type, samples)
+
+    def set_watermark(self, consumer, serial, sample_type, timestamp):
+        with self.writer_db() as db:
+            db.set_watermark(consumer, serial, sample_type, timestamp)
+
+    def advance_watermark(self, consumer, serial, sample_type, timestamp):
+        with self.writer_db() as db:
+            db.advance_watermark(consumer, serial, sample_type, timestamp)
+
+    def delete_samples(self, serial, from_ts, to_ts):
+        with self.writer_db() as db:
+            return db.delete_samples(serial, from_ts, to_ts)
+
+    def downsample(self, serial, sample_type, from_ts, to_ts, interval):
+        with self.writer_db() as db:
+            return db.downsample(serial, sample_type, from_ts, to_ts,
+                                 interval)
+
+    def freeze_partition(self, key):
+        with self.writer_db() as db:
+            db.freeze_partition(key)
+
+    def pvoutput_set_last_datetime_uploaded(self, sid, value):
+        with self.writer_db() as db:
+            db.pvoutput_set_last_datetime_uploaded(sid, value)
+
+    def outbox_add(self, sid, statuses):
+        with self.writer_db() as db:
+            return db.outbox_add(sid, statuses)
+
+    def outbox_update(self, sid, first_ts, state, sent_ts=None, error=None):
+        with self.writer_db() as db:
+            db.outbox_update(sid, first_ts, state, sent_ts, error)
+
+    def outbox_done(self, sid, first_ts):
+        with self.writer_db() as db:
+            db.outbox_done(sid, first_ts)
+
+    #
+    # Reads
+    #
+    def get_watermark(self, consumer, serial, sample_type):
+        with self.reader() as db:
+            return db.get_watermark(consumer, serial, sample_type)
+
+    def get_one_sample(self, serial, timestamp):
+        with self.reader() as db:
+            return db.get_one_sample(serial, timestamp)
+
+    def get_last_sample(self, serial, sample_type=None):
+        with self.reader() as db:
+            return db.get_last_sample(serial, sample_type)
+
+    def get_aggregate_one_sample(self, ts, ids,
+                                 sample_type=SAMPLE_INV_FAST):
+        with self.reader() as db:
+            return db.get_aggregate_one_sample(ts, ids, sample_type)
+
+    def get_aggregate_samples(self, from_ts, to_ts, ids, dense=False):
+        with self.reader() as db:
+            return db.get_aggregate_samples(from_ts, to_ts, ids, dense)
+
+    def get_yield_at(self, ts, ids, sample_type=SAMPLE_INV_FAST):
+        with self.reader() as db:
+            return db.get_yield_at(ts, ids, sample_type)
+
+    def iter_productions_younger_than(self, inverters, timestamp):
+        # Keep the connection until the caller has read every row.  Reads
+        # through the writer would see writes made meanwhile, so those
+        # come all at once.
+        with self.reader() as db:
+            rows = db.iter_productions_younger_than(inverters, timestamp)
+            if db is self.writer:
+                rows = list(rows)
+            else:
+                for row in rows:
+                    yield row
+                return
+        for row in rows:
+            yield row
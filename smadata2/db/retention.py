@@ -0,0 +1,106 @@
+#! /usr/bin/python3
+#
+# smadata2.db.retention - Downsample old samples
+# Copyright (C) 2014 David Gibson <david@gibson.dropbear.id.au>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import time
+
+from .base import Error, SAMPLE_INV_FAST, WATERMARK_RETENTION
+
+all = ['Tier', 'parse_policy', 'compact']
+
+DAY = 24 * 60 * 60
+
+# How much time to downsample per transaction
+BATCH_SECONDS = 7 * DAY
+
+
+class Tier(object):
+    """Samples older than age seconds are thinned to one per interval"""
+
+    def __init__(self, age, interval):
+        if interval <= 0 or DAY % interval != 0:
+            raise Error("Retention interval %d doesn't divide a day"
+                        % interval)
+        self.age = age
+        self.interval = interval
+
+    def consumer(self):
+        return "%s-%d" % (WATERMARK_RETENTION, self.interval)
+
+    def __repr__(self):
+        return "Tier(%d, %d)" % (self.age, self.interval)
+
+
+def parse_policy(json):
+    """Build retention tiers from configuration
+
+    Args:
+       json (list): Objects with "days" and "interval" (seconds) entries
+    Returns:
+       list.  Tiers, youngest first
+    """
+    tiers = [Tier(int(t["days"]) * DAY, int(t["interval"])) for t in json]
+    tiers.sort(key=lambda t: t.age)
+    for young, old in zip(tiers, tiers[1:]):
+        if old.interval % young.interval != 0:
+            raise Error("Retention interval %d isn't a multiple of %d"
+                        % (old.interval, young.interval))
+    return tiers
+
+
+def no_progress(step, done, total):
+    pass
+
+
+def compact(db, tiers, now=None, sample_type=SAMPLE_INV_FAST,
+            batch=BATCH_SECONDS, progress=no_progress):
+    """Downsample every inverter's old samples according to tiers
+
+    Work is committed a batch at a time, and each tier's position is kept
+    as a watermark, so an interrupted run picks up where it stopped.
+
+    Returns:
+       int.  The number of samples removed
+    """
+    if now is None:
+        now = int(time.time())
+
+    removed = 0
+    for tier in tiers:
+        interval = tier.interval
+        step = max(interval, batch - batch % interval)
+        cutoff = now - tier.age
+        cutoff -= cutoff % interval
+        for serial in db.serials():
+            start = db.get_watermark(tier.consumer(), serial, sample_type)
+            if start is None:
+                start = db.get_first_sample(serial)
+                if start is None:
+                    continue
+                start -= start % interval
+            first = start
+            while start < cutoff:
+                end = min(start + step, cutoff)
+                removed += db.downsample(serial, sample_type, start, end,
+                                         interval)
+                db.set_watermark(tier.consumer(), serial, sample_type, end)
+                db.commit()
+                progress("Downsampling %s to %ds" % (serial, interval),
+                         end - first, cutoff - first)
+                start = end
+    return removed
@@ -17,17 +17,23 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
-import shutil
+import collections
+import glob
+import json
+import os
+import os.path
 import re
 import sqlite3
+import stat
 import time
 import datetime
+import urllib.request
 
-from .. import datetimeutil
-
-from .base import BaseDatabase, WrongSchema, StaleResults
-from .base import STALE_SECONDS
+from .base import BaseDatabase, Error, WrongSchema, DuplicateSample
+from .base import total_yield_at
 from .base import SAMPLETYPES, SAMPLE_INV_FAST, SAMPLE_INV_DAILY
+from .base import WATERMARK_INGEST, WATERMARK_PVOUTPUT
+from .base import OutboxBatch, OUTBOX_FAILED
 
 all = ['SQLiteDatabase']
 
@@ -41,6 +47,55 @@ def squash_schema(sqls):
     return frozenset(tmp)
 
 
+PARTITION_FORMATS = {
+    "year": "%Y",
+    "month": "%Y-%m",
+}
+
+PARTITION_PATTERNS = {
+    "year": re.compile(r"^\d{4}$"),
+    "month": re.compile(r"^\d{4}-\d{2}$"),
+}
+
+
+def _uri(filename):
+    return "file:" + urllib.request.pathname2url(os.path.abspath(filename))
+
+
+def _merge_grouped(results):
+    """Merge per-timestamp grouped rows from several partitions
+
+    Each row is (timestamp, sums...).  Rows for the same timestamp from
+    different partitions are added together.
+    """
+    if len(results) == 1:
+        return results[0]
+    merged = {}
+    for rows in results:
+        for row in rows:
+            old = merged.get(row[0])
+            if old is None:
+                merged[row[0]] = row
+            else:
+                merged[row[0]] = (row[0],) + tuple(a + b for a, b
+                                                   in zip(old[1:], row[1:]))
+    return [merged[ts] for ts in sorted(merged)]
+
+
+def _add_implied(row, implied):
+    """Add the samples runs imply to a (timestamp, total, count) row"""
+    y, n = implied(row[0])
+    return (row[0], row[1] + y, row[2] + n)
+
+
+def _duplicate(e):
+    """Re-raise a failed sample insert as DuplicateSample if that's what
+    it was, or unchanged if some other constraint failed"""
+    if str(e).startswith("UNIQUE constraint failed"):
+        raise DuplicateSample(str(e)) from e
+    raise e
+
+
 def sqlite_schema(conn):
     c = conn.cursor()
     c.execute("SELECT sql FROM sqlite_master WHERE type = 'table'")
@@ -48,6 +103,11 @@ def sqlite_schema(conn):
     return squash_schema(sqls)
 
 
+class PartitionsBusy(Error):
+    """Every attached partition is in use, so no other can be attached"""
+    pass
+
+
 class SQLiteDatabase(BaseDatabase):
     DDL = [
         """CREATE TABLE "generation"
@@ -58,100 +118,587 @@ class SQLiteDatabase(BaseDatabase):
                    total_yield INTEGER,
                    PRIMARY KEY (inverter_serial,
                                 timestamp, sample_type))""",
-        """CREATE TABLE pvoutput (sid STRING,
-                                  last_datetime_uploaded INTEGER)""",
+        """CREATE TABLE watermarks (consumer STRING NOT NULL,
+                                    inverter_serial INTEGER NOT NULL,
+                                    sample_type INTEGER NOT NULL,
+                                    timestamp INTEGER NOT NULL,
+                                    PRIMARY KEY (consumer, inverter_serial,
+                                                 sample_type))""",
+        """CREATE TABLE generation_runs (inverter_serial INTEGER NOT NULL,
+                                         sample_type INTEGER NOT NULL,
+                                         first_ts INTEGER NOT NULL,
+                                         last_ts INTEGER NOT NULL,
+                                         step INTEGER NOT NULL,
+                                         total_yield INTEGER,
+                                         PRIMARY KEY (inverter_serial,
+                                                      sample_type,
+                                                      first_ts))""",
+        """CREATE TABLE pvoutput_outbox (sid STRING NOT NULL,
+                                         first_ts INTEGER NOT NULL,
+                                         last_ts INTEGER NOT NULL,
+                                         statuses STRING NOT NULL,
+                                         state STRING NOT NULL,
+                                         sent_ts INTEGER,
+                                         attempts INTEGER NOT NULL
+                                             DEFAULT 0,
+                                         error STRING,
+                                         PRIMARY KEY (sid, first_ts))""",
     ]
 
-    def __init__(self, filename):
+    # Databases holding one partition of the generation table
+    PARTITION_DDL = DDL[:1]
+
+    # SQLite's default (and usual compile time maximum) is 10
+    MAX_ATTACHED = 10
+
+    def __init__(self, filename, partition=None, compress=False, **connect):
+        """Open an existing database
+
+        Args:
+           filename (str): The database file
+           partition (str): Store samples in per "year" or per "month"
+              database files alongside filename
+           compress (bool): Store flat runs of samples compactly
+           connect: Passed on to sqlite3.connect()
+        """
         super(SQLiteDatabase, self).__init__()
 
-        self.conn = sqlite3.connect(filename)
+        self.filename = filename
+        if partition is None:
+            self.conn = sqlite3.connect(filename, **connect)
+        else:
+            if partition not in PARTITION_FORMATS:
+                raise ValueError("Bad partition size '%s'" % partition)
+            # URI filenames let us attach frozen partitions read-only
+            self.conn = sqlite3.connect(_uri(filename), uri=True, **connect)
 
         schema = sqlite_schema(self.conn)
         if schema != squash_schema(self.DDL):
             raise WrongSchema("Incorrect database schema")
 
+        self.partition = partition
+        self.compress = compress
+        self.attached = collections.OrderedDict()
+        self.readonly = set()
+        self.partitions = self._find_partitions()
+
     def commit(self):
         self.conn.commit()
 
+    def close(self):
+        self.conn.close()
+
+    #
+    # Time partitioning
+    #
+    # With partitioning enabled, new samples go into a separate database
+    # file per year (or month), attached to the connection on demand.
+    # The main generation table still holds anything recorded before
+    # partitioning was switched on.  Queries only attach and read the
+    # partitions their time range covers.
+    #
+    def partition_key(self, timestamp):
+        dt = datetime.datetime.utcfromtimestamp(timestamp)
+        return dt.strftime(PARTITION_FORMATS[self.partition])
+
+    def partition_filename(self, key):
+        return "%s.%s" % (self.filename, key)
+
+    def _find_partitions(self):
+        if self.partition is None:
+            return []
+        pattern = PARTITION_PATTERNS[self.partition]
+        keys = []
+        for path in glob.glob(glob.escape(self.filename) + ".*"):
+            key = path[len(self.filename) + 1:]
+            if pattern.match(key):
+                keys.append(key)
+        return sorted(keys)
+
+    def is_frozen(self, key):
+        mode = os.stat(self.partition_filename(key)).st_mode
+        return not (mode & (stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+
+    def freeze_partition(self, key):
+        """Make a closed partition read-only"""
+        if key not in self.partitions:
+            raise Error("No partition %s" % key)
+        if key == self.partition_key(time.time()):
+            raise Error("Refusing to freeze the current partition")
+        if key in self.attached:
+            self._detach(key)
+        path = self.partition_filename(key)
+        os.chmod(path, os.stat(path).st_mode
+                 & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+
+    def _detach(self, key):
+        self.conn.execute("DETACH DATABASE %s" % self.attached[key])
+        del self.attached[key]
+        self.readonly.discard(key)
+
+    def _evict(self, pinned):
+        for key in list(self.attached):
+            if key in pinned:
+                continue
+            try:
+                self._detach(key)
+                return
+            except sqlite3.OperationalError:
+                # Partitions written in the open transaction stay put
+                continue
+        raise PartitionsBusy("Too many partitions in use at once")
+
+    def _attach(self, key, create=False, pinned=()):
+        """Attach a partition if necessary, returning its schema name"""
+        if key in self.attached:
+            if create and key in self.readonly:
+                raise Error("Partition %s is read-only" % key)
+            self.attached.move_to_end(key)
+            return self.attached[key]
+
+        if key not in self.partitions:
+            if not create:
+                raise Error("No partition %s" % key)
+            conn = sqlite3.connect(self.partition_filename(key))
+            for sql in self.PARTITION_DDL:
+                conn.execute(sql)
+            conn.commit()
+            conn.close()
+            self.partitions = self._find_partitions()
+
+        frozen = self.is_frozen(key)
+        if create and frozen:
+            raise Error("Partition %s is read-only" % key)
+
+        while len(self.attached) >= self.MAX_ATTACHED:
+            self._evict(pinned)
+
+        uri = _uri(self.partition_filename(key))
+        if frozen:
+            uri += "?mode=ro"
+            self.readonly.add(key)
+        name = "p" + key.replace("-", "_")
+        self.conn.execute("ATTACH DATABASE ? AS %s" % name, (uri,))
+        self.attached[key] = name
+        return name
+
+    def _partition_keys(self, from_ts=None, to_ts=None):
+        keys = self.partitions
+        if from_ts is not None:
+            first = self.partition_key(from_ts)
+            keys = [k for k in keys if k >= first]
+        if to_ts is not None:
+            last = self.partition_key(to_ts - 1)
+            keys = [k for k in keys if k <= last]
+        return keys
+
+    def _tables(self, from_ts=None, to_ts=None):
+        """Lists of generation tables covering samples in [from_ts, to_ts)
+
+        Each list can be queried together in one statement, and between
+        them the lists cover every table exactly once, oldest first.
+        """
+        if self.partition is None:
+            yield ["generation"]
+            return
+
+        # Leave room for a partition being written in the open transaction
+        size = self.MAX_ATTACHED - 1
+        keys = self._partition_keys(from_ts, to_ts)
+        chunks = [keys[:size - 1]]
+        chunks += [keys[i:i + size] for i in range(size - 1, len(keys), size)]
+        for i, chunk in enumerate(chunks):
+            tables = ["main.generation"] if i == 0 else []
+            tables += ["%s.generation" % self._attach(key, pinned=chunk)
+                       for key in chunk]
+            yield tables
+
+    def _generation(self, from_ts=None, to_ts=None):
+        """FROM clauses which between them cover [from_ts, to_ts)"""
+        for tables in self._tables(from_ts, to_ts):
+            if len(tables) == 1:
+                yield tables[0]
+            else:
+                yield ("(" + " UNION ALL ".join(
+                    "SELECT inverter_serial, timestamp, sample_type,"
+                    " total_yield FROM %s" % t for t in tables) + ")")
+
+    def _newest_partitions(self, to_ts=None):
+        """Partition generation tables which could hold samples before
+        to_ts, newest first"""
+        if self.partition is None:
+            return
+        for key in reversed(self._partition_keys(None, to_ts)):
+            yield "%s.generation" % self._attach(key)
+
+    def _insert_table(self, timestamp):
+        if self.partition is None:
+            return "generation"
+        key = self.partition_key(timestamp)
+        return "%s.generation" % self._attach(key, create=True)
+
     def add_sample(self, serial, timestamp, sample_type, total_yield):
+        if self.compress:
+            self.add_samples(serial, sample_type, [(timestamp, total_yield)])
+            return
         c = self.conn.cursor()
-        c.execute("INSERT INTO generation" +
-                  " (inverter_serial, timestamp, sample_type, total_yield)" +
-                  " VALUES (?, ?, ?, ?);",
-                  (serial, timestamp, sample_type, total_yield))
+        try:
+            c.execute("INSERT INTO " + self._insert_table(timestamp) +
+                      " (inverter_serial, timestamp, sample_type,"
+                      " total_yield) VALUES (?, ?, ?, ?);",
+                      (serial, timestamp, sample_type, total_yield))
+        except sqlite3.IntegrityError as e:
+            _duplicate(e)
+        self.advance_watermark(WATERMARK_INGEST, serial, sample_type,
+                               timestamp)
 
-    def get_one_sample(self, serial, timestamp):
+    def add_samples(self, serial, sample_type, samples):
+        samples = list(samples)
+        if not samples:
+            return
+        if self.compress:
+            samples = self._compress(serial, sample_type, samples)
+        self._insert(serial, sample_type, samples, watermark=True)
+        self.advance_watermark(WATERMARK_INGEST, serial, sample_type,
+                               max(ts for ts, y in samples))
+
+    def _insert(self, serial, sample_type, samples, watermark=False,
+                replace=False):
+        """Insert samples, oldest partition first
+
+        With partitioning, one transaction can only write to as many
+        partitions as can be attached at once.  Samples spanning more
+        are committed a few partitions at a time, with the ingest
+        watermark (if `watermark`) moved up to what has been committed.
+        With `replace`, samples already stored are overwritten rather
+        than failing.
+        """
+        verb = "INSERT OR REPLACE INTO " if replace else "INSERT INTO "
+        bykey = {}
+        for timestamp, total_yield in samples:
+            key = self.partition_key(timestamp) if self.partition else None
+            bykey.setdefault(key, []).append((timestamp, total_yield))
+        c = self.conn.cursor()
+        written = None
+        for key in sorted(bykey, key=lambda k: k or ""):
+            data = bykey[key]
+            try:
+                table = self._insert_table(data[0][0])
+            except PartitionsBusy:
+                if watermark and written is not None:
+                    self.advance_watermark(WATERMARK_INGEST, serial,
+                                           sample_type, written)
+                self.commit()
+                table = self._insert_table(data[0][0])
+            written = max([written or data[0][0]]
+                          + [ts for ts, y in data])
+            try:
+                c.executemany(verb + table +
+                              " (inverter_serial, timestamp, sample_type," +
+                              " total_yield) VALUES (?, ?, ?, ?);",
+                              ((serial, timestamp, sample_type, total_yield)
+                               for timestamp, total_yield in data))
+            except sqlite3.IntegrityError as e:
+                _duplicate(e)
+
+    #
+    # Run-length compression
+    #
+    # In compressed mode, a run of three or more evenly spaced samples
+    # with the same total_yield (inverters report one every few minutes
+    # all night) only stores its first and last sample in the generation
+    # table.  A generation_runs row records the run, and the samples in
+    # between are implied.  Queries combining several inverters fill in
+    # implied samples at the timestamps they return, and callers can ask
+    # for the full dense series.  Runs are honoured whether or not the
+    # database is currently opened in compressed mode.
+    #
+    def _compress(self, serial, sample_type, samples):
+        """Record runs in a batch of new samples
+
+        Returns:
+           list.  The samples which still need storing
+        """
+        samples = sorted(samples)
         c = self.conn.cursor()
-        c.execute("SELECT total_yield FROM generation"
-                  " WHERE inverter_serial = ?"
-                  " AND timestamp = ?", (serial, timestamp))
+
+        prev = None
+        run = None
+        last = self.get_watermark(WATERMARK_INGEST, serial, sample_type)
+        if last is not None:
+            if samples[0][0] <= last:
+                # Filling in history, which could collide with implied
+                # samples, so store it as it is
+                for ts, y in samples:
+                    if self._run_at(serial, sample_type, ts) is not None:
+                        raise DuplicateSample(
+                            "Sample at %d is already part of a run" % ts)
+                return samples
+            y = self._get_typed_sample(serial, sample_type, last)
+            if y is not None:
+                prev = (last, y)
+                c.execute("SELECT first_ts, step FROM generation_runs"
+                          " WHERE inverter_serial = ? AND sample_type = ?"
+                          " AND last_ts = ?", (serial, sample_type, last))
+                run = c.fetchone()
+
+        keep = []
+        for ts, y in samples:
+            if prev is not None and y == prev[1]:
+                step = ts - prev[0]
+                if run is not None and step == run[1]:
+                    # The previous sample is now inside the run
+                    if keep and keep[-1][0] == prev[0]:
+                        keep.pop()
+                    else:
+                        self._delete_one(serial, sample_type, prev[0])
+                    c.execute("UPDATE generation_runs SET last_ts = ?"
+                              " WHERE inverter_serial = ?"
+                              " AND sample_type = ? AND first_ts = ?",
+                              (ts, serial, sample_type, run[0]))
+                else:
+                    c.execute("INSERT INTO generation_runs (inverter_serial,"
+                              " sample_type, first_ts, last_ts, step,"
+                              " total_yield) VALUES (?, ?, ?, ?, ?, ?)",
+                              (serial, sample_type, prev[0], ts, step, y))
+                    run = (prev[0], step)
+            else:
+                run = None
+            keep.append((ts, y))
+            prev = (ts, y)
+        return keep
+
+    def _get_typed_sample(self, serial, sample_type, timestamp):
+        c = self.conn.cursor()
+        for source in self._generation(timestamp, timestamp + 1):
+            c.execute("SELECT total_yield FROM " + source +
+                      " WHERE inverter_serial = ? AND sample_type = ?"
+                      " AND timestamp = ?", (serial, sample_type, timestamp))
+            r = c.fetchone()
+            if r is not None:
+                return r[0]
+
+    def _delete_one(self, serial, sample_type, timestamp):
+        c = self.conn.cursor()
+        for tables in self._tables(timestamp, timestamp + 1):
+            for table in tables:
+                c.execute("DELETE FROM " + table +
+                          " WHERE inverter_serial = ? AND sample_type = ?"
+                          " AND timestamp = ?",
+                          (serial, sample_type, timestamp))
+
+    def _run_at(self, serial, sample_type, timestamp):
+        """The value implied at timestamp by a run, or None"""
+        c = self.conn.cursor()
+        template = ("SELECT total_yield FROM generation_runs"
+                    " WHERE inverter_serial = ?"
+                    " AND first_ts < ? AND last_ts > ?"
+                    " AND (? - first_ts) % step = 0")
+        args = (serial, timestamp, timestamp, timestamp)
+        if sample_type is not None:
+            template += " AND sample_type = ?"
+            args += (sample_type,)
+        c.execute(template, args)
         r = c.fetchone()
         if r is not None:
             return r[0]
 
-    def get_last_sample(self, serial, sample_type=None):
+    def _runs(self, ids, from_ts, to_ts, sample_type=None):
+        """Runs of the given inverters with implied samples in
+        [from_ts, to_ts)
+
+        Returns:
+           list.  (serial, sample_type, first_ts, last_ts, step,
+           total_yield) tuples
+        """
         c = self.conn.cursor()
-        if sample_type is None:
-            c.execute("SELECT max(timestamp) FROM generation"
-                      " WHERE inverter_serial = ?", (serial,))
-        else:
-            c.execute("SELECT max(timestamp) FROM generation"
-                      " WHERE inverter_serial = ? AND sample_type = ?",
-                      (serial, sample_type))
+        template = ("SELECT inverter_serial, sample_type, first_ts, last_ts,"
+                    " step, total_yield FROM generation_runs"
+                    " WHERE inverter_serial IN (" +
+                    ",".join("?" * len(ids)) + ")"
+                    " AND first_ts < ? AND last_ts > ?")
+        args = tuple(ids) + (to_ts - 1, from_ts)
+        if sample_type is not None:
+            template += " AND sample_type = ?"
+            args += (sample_type,)
+        c.execute(template, args)
+        return c.fetchall()
+
+    @staticmethod
+    def _implied_at(runs):
+        """Sum up runs' implied samples at increasing timestamps
+
+        Returns:
+           callable.  Given a timestamp no earlier than the last, returns
+           (total_yield, number of runs) implied there
+        """
+        runs = sorted(runs, key=lambda run: run[2])
+        pending = iter(runs)
+        state = {"next": next(pending, None), "active": []}
+
+        def at(ts):
+            run = state["next"]
+            while run is not None and run[2] < ts:
+                state["active"].append(run)
+                run = next(pending, None)
+            state["next"] = run
+            state["active"] = [r for r in state["active"] if r[3] > ts]
+            ys = [r[5] for r in state["active"] if (ts - r[2]) % r[4] == 0]
+            return sum(ys), len(ys)
+        return at
+
+    @staticmethod
+    def _implied(first_ts, last_ts, step, from_ts, to_ts):
+        """Timestamps of a run's implied samples in [from_ts, to_ts)"""
+        k = max(1, -((first_ts - from_ts) // step))
+        return range(first_ts + k*step, min(last_ts, to_ts), step)
+
+    def get_watermark(self, consumer, serial, sample_type):
+        c = self.conn.cursor()
+        c.execute("SELECT timestamp FROM watermarks"
+                  " WHERE consumer = ? AND inverter_serial = ?"
+                  " AND sample_type = ?", (consumer, serial, sample_type))
         r = c.fetchone()
-        return r[0]
+        if r is not None:
+            return r[0]
+
+    def set_watermark(self, consumer, serial, sample_type, timestamp):
+        c = self.conn.cursor()
+        c.execute("INSERT OR REPLACE INTO watermarks"
+                  " (consumer, inverter_serial, sample_type, timestamp)"
+                  " VALUES (?, ?, ?, ?)",
+                  (consumer, serial, sample_type, timestamp))
+
+    def advance_watermark(self, consumer, serial, sample_type, timestamp):
+        c = self.conn.cursor()
+        c.execute("INSERT INTO watermarks"
+                  " (consumer, inverter_serial, sample_type, timestamp)"
+                  " VALUES (?, ?, ?, ?)"
+                  " ON CONFLICT (consumer, inverter_serial, sample_type)"
+                  " DO UPDATE SET timestamp"
+                  " = max(timestamp, excluded.timestamp)",
+                  (consumer, serial, sample_type, timestamp))
+
+    def get_one_sample(self, serial, timestamp):
+        c = self.conn.cursor()
+        for source in self._generation(timestamp, timestamp + 1):
+            c.execute("SELECT total_yield FROM " + source +
+                      " WHERE inverter_serial = ?"
+                      " AND timestamp = ?", (serial, timestamp))
+            r = c.fetchone()
+            if r is not None:
+                return r[0]
+        return self._run_at(serial, None, timestamp)
+
+    def get_last_sample(self, serial, sample_type=None):
+        c = self.conn.cursor()
+        where = " WHERE inverter_serial = ?"
+        args = (serial,)
+        if sample_type is not None:
+            where += " AND sample_type = ?"
+            args += (sample_type,)
+        c.execute("SELECT max(timestamp) FROM generation" + where, args)
+        last = c.fetchone()[0]
+        for table in self._newest_partitions():
+            c.execute("SELECT max(timestamp) FROM " + table + where, args)
+            r = c.fetchone()[0]
+            if r is not None:
+                # Older partitions can't hold anything newer
+                if last is None or r > last:
+                    last = r
+                break
+        return last
 
     def get_aggregate_one_sample(self, ts, ids,
                                  sample_type=SAMPLE_INV_FAST):
         c = self.conn.cursor()
-        c.execute("SELECT sum(total_yield) FROM generation"
-                  " WHERE inverter_serial IN(" + ",".join("?" * len(ids)) + ")"
-                  " AND timestamp = ?"
-                  " AND sample_type = ?"
-                  " GROUP BY timestamp",
-                  tuple(ids) + (ts, sample_type))
-        r = c.fetchall()
-        if not r:
-            return None
-        assert(len(r) == 1)
-        return r[0][0]
+        total = None
+        for source in self._generation(ts, ts + 1):
+            args = tuple(ids) + (ts,)
+            template = ("SELECT sum(total_yield) FROM " + source +
+                        " WHERE inverter_serial IN(" +
+                        ",".join("?" * len(ids)) + ") AND timestamp = ?")
+            if sample_type is not None:
+                template += " AND sample_type = ?"
+                args += (sample_type,)
+            c.execute(template + " GROUP BY timestamp", args)
+            r = c.fetchall()
+            if r:
+                assert(len(r) == 1)
+                total = r[0][0] if total is None else total + r[0][0]
+        for run in self._runs(ids, ts, ts + 1, sample_type):
+            if (ts - run[2]) % run[4] == 0:
+                total = run[5] if total is None else total + run[5]
+        return total
+
+    def get_latest_samples_before(self, ts, ids):
+        """Newest sample strictly before ts from each of the given inverters
+
+        Returns:
+           dict.  Maps serial to a (total_yield, timestamp) tuple, inverters
+           with no samples before ts are omitted
+        """
+        c = self.conn.cursor()
+        template = ("SELECT inverter_serial, max(total_yield),"
+                    " max(timestamp) FROM %s WHERE inverter_serial IN (" +
+                    ",".join("?" * len(ids)) + ") AND timestamp < ?"
+                    " GROUP BY inverter_serial")
+        args = tuple(ids) + (ts,)
+        c.execute(template % "generation", args)
+        latest = dict((str(serial), (yield_, timestamp))
+                      for serial, yield_, timestamp in c.fetchall())
+        found = set()
+        for table in self._newest_partitions(ts + 1):
+            c.execute(template % table, args)
+            for serial, yield_, timestamp in c.fetchall():
+                serial = str(serial)
+                if serial in found:
+                    continue
+                found.add(serial)
+                cur = latest.get(serial)
+                if cur is None or timestamp > cur[1]:
+                    latest[serial] = (yield_, timestamp)
+            if len(found) == len(ids):
+                break
+        return latest
 
     def get_yield_at(self, ts, ids,
                      sample_type=SAMPLE_INV_FAST):
-        c = self.conn.cursor()
-        c.execute("SELECT max(total_yield), max(timestamp),"
-                  " inverter_serial FROM generation"
-                  " WHERE inverter_serial IN (" + ",".join("?" * len(ids)) + ")"
-                  " AND timestamp < ?"
-                  " GROUP BY inverter_serial",
-                  tuple(ids) + (ts,))
-        r = c.fetchall()
-        if not r:
+        latest = self.get_latest_samples_before(ts, ids)
+        if not latest:
             return None
-        assert(len(r) == len(ids))
-        total = 0
-        for yield_, timestamp, serial in r:
-            total += yield_
-            stale = ts - timestamp
-            if stale > STALE_SECONDS:
-                msg = "Latest data from inverter {} is at {} ({} days, {} hours stale)"
-                oldtime = datetimeutil.format_time(timestamp)
-                stalehours = round(stale / 60 / 60)
-                raise StaleResults(msg.format(serial, oldtime,
-                                              stalehours // 24,
-                                              stalehours % 24))
-        return total
-        
-    def get_aggregate_samples(self, from_ts, to_ts, ids):
+        assert(len(latest) == len(ids))
+        return total_yield_at(ts, latest)
+
+    def get_aggregate_samples(self, from_ts, to_ts, ids, dense=False):
+        """Per-timestamp total of several inverters' samples
+
+        Samples implied by runs are added in at the returned timestamps,
+        and with dense=True every implied timestamp is returned as well.
+        """
         c = self.conn.cursor()
-        template = ("SELECT timestamp, sum(total_yield) FROM generation" +
-                    " WHERE inverter_serial IN (" +
-                    ",".join("?" * len(ids)) +
-                    ") AND timestamp >= ? AND timestamp < ?" +
-                    " GROUP BY timestamp ORDER BY timestamp ASC")
-        c.execute(template, tuple(ids) + (from_ts, to_ts))
-        return c.fetchall()
+        results = []
+        for source in self._generation(from_ts, to_ts):
+            template = ("SELECT timestamp, sum(total_yield) FROM " + source +
+                        " WHERE inverter_serial IN (" +
+                        ",".join("?" * len(ids)) +
+                        ") AND timestamp >= ? AND timestamp < ?" +
+                        " GROUP BY timestamp ORDER BY timestamp ASC")
+            c.execute(template, tuple(ids) + (from_ts, to_ts))
+            results.append(c.fetchall())
+        results = _merge_grouped(results)
+
+        runs = self._runs(ids, from_ts, to_ts)
+        if not runs:
+            return results
+        totals = dict(results)
+        for serial, sample_type, first, last, step, y in runs:
+            for ts in self._implied(first, last, step, from_ts, to_ts):
+                if ts in totals:
+                    totals[ts] += y
+                elif dense:
+                    totals[ts] = y
+        return sorted(totals.items())
 
     # return midnights for each day in the database
     # @param serial the inverter seial number to retrieve midnights for
@@ -159,14 +706,21 @@ class SQLiteDatabase(BaseDatabase):
     def midnights(self, inverters):
         c = self.conn.cursor()
         serials = ','.join(x.serial for x in inverters)
-        template = """SELECT distinct(timestamp)
-        FROM generation
-        WHERE inverter_serial  in ( ? )
-        AND timestamp % 86400 = 0
-        ORDER BY timestamp ASC"""
-        c.execute(template, (serials,))
-        r = c.fetchall()
-        r = [datetime.datetime.utcfromtimestamp(x[0]) for x in r]
+        stamps = set()
+        for source in self._generation():
+            template = """SELECT distinct(timestamp)
+            FROM """ + source + """
+            WHERE inverter_serial  in ( ? )
+            AND timestamp % 86400 = 0
+            ORDER BY timestamp ASC"""
+            c.execute(template, (serials,))
+            stamps.update(x[0] for x in c.fetchall())
+        for run in self._runs([x.serial for x in inverters], 0, 2**63 - 1):
+            first, last, step = run[2:5]
+            stamps.update(ts for ts in self._implied(first, last, step,
+                                                     first, last)
+                          if ts % 86400 == 0)
+        r = [datetime.datetime.utcfromtimestamp(x) for x in sorted(stamps)]
         return r
 
     def get_datapoint_totals_for_day(self, inverters, start_datetime):
@@ -174,82 +728,268 @@ class SQLiteDatabase(BaseDatabase):
         before_datetime = start_datetime + datetime.timedelta(days=1)
         start_unixtime = time.mktime(start_datetime.timetuple())
         before_unixtime = time.mktime(before_datetime.timetuple())
-        serials = ','.join(x.serial for x in inverters)
-        c.execute("SELECT timestamp,sum(total_yield),count(inverter_serial) "
-                  "FROM generation "
-                  "WHERE inverter_serial in  ( ? ) "
-                  "AND timestamp >= ? and timestamp < ? "
-                  "group by timestamp "
-                  "ORDER BY timestamp ASC", (serials, start_unixtime,
-                                             before_unixtime))
-        r = c.fetchall()
-        return r
+        serials = [x.serial for x in inverters]
+        results = []
+        for source in self._generation(int(start_unixtime),
+                                       int(before_unixtime)):
+            c.execute("SELECT timestamp,sum(total_yield),"
+                      "count(inverter_serial) "
+                      "FROM " + source + " "
+                      "WHERE inverter_serial in (" +
+                      ",".join("?" * len(serials)) + ") "
+                      "AND timestamp >= ? and timestamp < ? "
+                      "group by timestamp "
+                      "ORDER BY timestamp ASC",
+                      serials + [start_unixtime, before_unixtime])
+            results.append(c.fetchall())
+        results = _merge_grouped(results)
+
+        runs = self._runs(serials, int(start_unixtime),
+                          int(before_unixtime))
+        if not runs:
+            return results
+        implied = self._implied_at(runs)
+        return [_add_implied(row, implied) for row in results]
 
     # fixed
     def get_entries(self, inverters, timestamp):
         c = self.conn.cursor()
         serials = ','.join(x.serial for x in inverters)
-        c.execute("SELECT timestamp,total_yield,inverter_serial "
-                  "FROM generation "
-                  "WHERE inverter_serial in ( ? ) "
-                  "AND timestamp = ? "
-                  "ORDER BY timestamp DESC LIMIT ?", (serials, timestamp, 1))
-        r = c.fetchall()
-        if len(r) == 0:
-            return None
-        return r
+        for source in self._generation(timestamp, timestamp + 1):
+            c.execute("SELECT timestamp,total_yield,inverter_serial "
+                      "FROM " + source + " "
+                      "WHERE inverter_serial in ( ? ) "
+                      "AND timestamp = ? "
+                      "ORDER BY timestamp DESC LIMIT ?",
+                      (serials, timestamp, 1))
+            r = c.fetchall()
+            if len(r) != 0:
+                return r
+        for inv in inverters:
+            y = self._run_at(inv.serial, None, timestamp)
+            if y is not None:
+                return [(timestamp, y, inv.serial)]
+        return None
 
     def all_history(self, inv):
         c = self.conn.cursor()
-        c.execute("SELECT timestamp, total_yield "
-                  "FROM generation "
-                  "WHERE inverter_serial = ? "
-                  "ORDER BY timestamp", (inv.serial,))
-        return c.fetchall()
+        r = []
+        for source in self._generation():
+            c.execute("SELECT timestamp, total_yield "
+                      "FROM " + source + " "
+                      "WHERE inverter_serial = ? "
+                      "ORDER BY timestamp", (inv.serial,))
+            r.extend(c.fetchall())
+        if self.partition is not None:
+            r.sort()
+        return r
 
-    def get_productions_younger_than(self, inverters, timestamp):
-        serials = ','.join(x.serial for x in inverters)
+    def serials(self):
+        """Return the serial numbers of all inverters with stored samples"""
+        c = self.conn.cursor()
+        serials = []
+        for source in self._generation():
+            c.execute("SELECT DISTINCT inverter_serial FROM " + source)
+            serials.extend(r[0] for r in c.fetchall()
+                           if r[0] not in serials)
+        return serials
+
+    def get_first_sample(self, serial):
+        c = self.conn.cursor()
+        first = None
+        for source in self._generation():
+            c.execute("SELECT min(timestamp) FROM " + source +
+                      " WHERE inverter_serial = ?", (serial,))
+            r = c.fetchone()[0]
+            if r is not None and (first is None or r < first):
+                first = r
+            if first is not None:
+                # Later chunks only hold later partitions
+                break
+        return first
+
+    def get_samples(self, serial, from_ts, to_ts, dense=False):
+        """Return every sample for one inverter in [from_ts, to_ts)
+
+        Samples implied by runs are only included with dense=True.
+
+        Returns:
+           list.  (timestamp, sample_type, total_yield) tuples, ordered by
+           timestamp
+        """
         c = self.conn.cursor()
-        c.execute("SELECT timestamp,total_yield,count(inverter_serial) "
-                  "FROM generation "
-                  "WHERE inverter_serial in ( ? ) AND "
-                  " timestamp > ? "
-                  "group by timestamp "
-                  "ORDER BY timestamp ASC", (serials, str(timestamp)))
-        r = c.fetchall()
+        r = []
+        for source in self._generation(from_ts, to_ts):
+            c.execute("SELECT timestamp, sample_type, total_yield FROM " +
+                      source +
+                      " WHERE inverter_serial = ?"
+                      " AND timestamp >= ? AND timestamp < ?"
+                      " ORDER BY timestamp ASC, sample_type ASC",
+                      (serial, from_ts, to_ts))
+            r.extend(c.fetchall())
+        if dense:
+            for run in self._runs([serial], from_ts, to_ts):
+                first, last, step = run[2:5]
+                r.extend((ts, run[1], run[5]) for ts in
+                         self._implied(first, last, step, from_ts, to_ts))
+        if self.partition is not None or dense:
+            r.sort()
         return r
 
-    def pvoutput_get_last_datetime_uploaded(self, sid):
+    def delete_samples(self, serial, from_ts, to_ts):
+        """Remove every sample for one inverter in [from_ts, to_ts)"""
         c = self.conn.cursor()
-        c.execute("SELECT last_datetime_uploaded "
-                  "FROM pvoutput "
-                  "WHERE sid = ?", (sid,))
-        r = c.fetchone()
-        if r is None:
-            return None
-        return r[0]
+        n = 0
+        # Turn overlapping runs back into ordinary samples, then only
+        # the ones outside the range need to be kept
+        for run in self._runs([serial], from_ts - 1, to_ts + 1):
+            sample_type, first, last, step, y = run[1:]
+            implied = self._implied(first, last, step, first, last)
+            self._insert(serial, sample_type,
+                         [(ts, y) for ts in implied
+                          if ts < from_ts or ts >= to_ts])
+            n += len([ts for ts in implied if from_ts <= ts < to_ts])
+            c.execute("DELETE FROM generation_runs"
+                      " WHERE inverter_serial = ? AND sample_type = ?"
+                      " AND first_ts = ?", (serial, sample_type, first))
+        for tables in self._tables(from_ts, to_ts):
+            for table in tables:
+                c.execute("DELETE FROM " + table +
+                          " WHERE inverter_serial = ?"
+                          " AND timestamp >= ? AND timestamp < ?",
+                          (serial, from_ts, to_ts))
+                n += c.rowcount
+        return n
 
-    def pvoutput_maybe_init_system(self, sid):
-        print(sid)
+    def downsample(self, serial, sample_type, from_ts, to_ts, interval):
         c = self.conn.cursor()
-        c.execute("SELECT * FROM pvoutput"
-                  " WHERE sid = ?",
-                  (sid,))
-        r = c.fetchone()
-        if r is None:
+        n = 0
+        # A run would go on implying the samples thinned out, so turn
+        # overlapping runs back into ordinary samples first
+        for run in self._runs([serial], from_ts - 1, to_ts + 1,
+                              sample_type):
+            first, last, step, y = run[2:]
+            self._insert(serial, sample_type,
+                         [(ts, y) for ts in self._implied(first, last, step,
+                                                          first, last)])
+            c.execute("DELETE FROM generation_runs"
+                      " WHERE inverter_serial = ? AND sample_type = ?"
+                      " AND first_ts = ?", (serial, sample_type, first))
+        for tables in self._tables(from_ts, to_ts):
+            for table in tables:
+                c.execute("DELETE FROM " + table +
+                          " WHERE inverter_serial = ? AND sample_type = ?"
+                          " AND timestamp >= ? AND timestamp < ?"
+                          " AND timestamp NOT IN"
+                          " (SELECT min(timestamp) FROM " + table +
+                          "  WHERE inverter_serial = ? AND sample_type = ?"
+                          "  AND timestamp >= ? AND timestamp < ?"
+                          "  GROUP BY timestamp / ?)",
+                          (serial, sample_type, from_ts, to_ts) * 2
+                          + (interval,))
+                n += c.rowcount
+        return n
+
+    def get_productions_younger_than(self, inverters, timestamp):
+        return list(self.iter_productions_younger_than(inverters, timestamp))
+
+    def iter_productions_younger_than(self, inverters, timestamp):
+        """Stream the system's production after timestamp, from the fast
+        samples
+
+        Rows come straight off the cursor, a partition chunk at a time,
+        oldest first, so a long backlog is never all in memory.  Samples
+        implied by runs are added in at the returned timestamps.
+
+        Yields:
+           tuple.  (timestamp, total yield, inverters reporting)
+        """
+        serials = [x.serial for x in inverters]
+        marks = ",".join("?" * len(serials))
+        # Inverters in the middle of a flat run have no row of their own
+        implied = self._implied_at(self._runs(serials, int(timestamp) + 1,
+                                              2**63 - 1, SAMPLE_INV_FAST))
+        row = None
+        for source in self._generation(int(timestamp) + 1):
             c = self.conn.cursor()
-            c.execute("INSERT INTO pvoutput(sid) VALUES ( ? )",
-                      (sid,))
-            self.commit()
+            c.execute("SELECT timestamp, sum(total_yield),"
+                      " count(inverter_serial) FROM " + source +
+                      " WHERE inverter_serial IN (" + marks + ")"
+                      " AND sample_type = ? AND timestamp > ?"
+                      " GROUP BY timestamp ORDER BY timestamp ASC",
+                      serials + [SAMPLE_INV_FAST, int(timestamp)])
+            for r in c:
+                # A timestamp split across chunks comes out of each
+                if row is not None and r[0] == row[0]:
+                    row = (row[0], row[1] + r[1], row[2] + r[2])
+                    continue
+                if row is not None:
+                    yield _add_implied(row, implied)
+                row = r
+        if row is not None:
+            yield _add_implied(row, implied)
+
+    # The pvoutput.org upload position is a per-system watermark, with the
+    # system id standing in for the inverter serial
+    def pvoutput_get_last_datetime_uploaded(self, sid):
+        return self.get_watermark(WATERMARK_PVOUTPUT, sid, SAMPLE_INV_FAST)
 
     def pvoutput_set_last_datetime_uploaded(self, sid, value):
-        c = self.conn.cursor()
-        self.pvoutput_maybe_init_system(sid)
-        c.execute("update pvoutput "
-                  "SET last_datetime_uploaded = ?"
-                  "WHERE sid = ?", (value, sid))
+        self.set_watermark(WATERMARK_PVOUTPUT, sid, SAMPLE_INV_FAST, value)
         self.commit()
 
+    #
+    # Statuses waiting to go to pvoutput.org, a row per batch.  Callers
+    # commit, so a batch's progress is durable as soon as it's recorded.
+    #
+    def outbox_add(self, sid, statuses):
+        batch = OutboxBatch(sid, statuses)
+        c = self.conn.cursor()
+        c.execute("INSERT INTO pvoutput_outbox"
+                  " (sid, first_ts, last_ts, statuses, state)"
+                  " VALUES (?, ?, ?, ?, ?)",
+                  (batch.sid, batch.first_ts, batch.last_ts,
+                   json.dumps(batch.statuses), batch.state))
+        return batch
+
+    def outbox_batches(self, sid):
+        c = self.conn.cursor()
+        c.execute("SELECT statuses, state, sent_ts, attempts, error"
+                  " FROM pvoutput_outbox WHERE sid = ?"
+                  " ORDER BY first_ts", (str(sid),))
+        return [OutboxBatch(sid, json.loads(statuses), state, sent_ts,
+                            attempts, error)
+                for statuses, state, sent_ts, attempts, error
+                in c.fetchall()]
+
+    def outbox_last(self, sid):
+        c = self.conn.cursor()
+        c.execute("SELECT max(last_ts) FROM pvoutput_outbox WHERE sid = ?",
+                  (str(sid),))
+        return c.fetchone()[0]
+
+    def outbox_update(self, sid, first_ts, state, sent_ts=None, error=None):
+        c = self.conn.cursor()
+        c.execute("UPDATE pvoutput_outbox SET state = ?,"
+                  " sent_ts = coalesce(?, sent_ts), error = ?,"
+                  " attempts = attempts + ?"
+                  " WHERE sid = ? AND first_ts = ?",
+                  (state, sent_ts, error, int(state == OUTBOX_FAILED),
+                   str(sid), first_ts))
+
+    def outbox_done(self, sid, first_ts):
+        """Drop a batch which has been sent, and move the upload watermark
+        past it, in the same transaction"""
+        c = self.conn.cursor()
+        c.execute("SELECT last_ts FROM pvoutput_outbox"
+                  " WHERE sid = ? AND first_ts = ?", (str(sid), first_ts))
+        r = c.fetchone()
+        if r is None:
+            return
+        c.execute("DELETE FROM pvoutput_outbox WHERE sid = ? AND first_ts = ?",
+                  (str(sid), first_ts))
+        self.advance_watermark(WATERMARK_PVOUTPUT, sid, SAMPLE_INV_FAST, r[0])
+
 
 SCHEMA_CURRENT = squash_schema(SQLiteDatabase.DDL)
 
@@ -257,7 +997,9 @@ SCHEMA_CURRENT = squash_schema(SQLiteDatabase.DDL)
 SCHEMA_EMPTY = frozenset()
 
 
-def create_from_empty(conn):
+def create_from_empty(conn, progress):
+    # Allow later space reclaiming without a full VACUUM
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
     for sql in SQLiteDatabase.DDL:
         conn.execute(sql)
     conn.commit()
@@ -271,10 +1013,9 @@ SCHEMA_NOPVO = squash_schema((
     """CREATE TABLE schema (magic INTEGER, version INTEGER)"""))
 
 
-def update_nopvo(conn):
+def update_nopvo(conn, progress):
     conn.execute("""CREATE TABLE pvoutput (sid STRING,
                                            last_datetime_uploaded INTEGER)""")
-    conn.execute("VACUUM")
     conn.commit()
 
 
@@ -288,40 +1029,128 @@ SCHEMA_V0 = squash_schema((
                               last_datetime_uploaded INTEGER)"""))
 
 
-def update_v0(conn):
+def update_v0(conn, progress):
     conn.execute("DROP TABLE schema")
-    conn.execute("VACUUM")
     conn.commit()
 
 
-SCHEMA_V2_3 = squash_schema((
-    """CREATE TABLE generation (inverter_serial INTEGER,
+_V2_GENERATION = """CREATE TABLE generation (inverter_serial INTEGER,
                                 timestamp INTEGER,
                                 total_yield INTEGER,
                                 PRIMARY KEY (inverter_serial,
-                                             timestamp))""",
-    """CREATE TABLE pvoutput (sid STRING,
-                              last_datetime_uploaded INTEGER)"""))
+                                             timestamp))"""
+
+_V2_PVOUTPUT = """CREATE TABLE pvoutput (sid STRING,
+                              last_datetime_uploaded INTEGER)"""
+
+_V3_GENERATION = """CREATE TABLE "%s"
+              (inverter_serial INTEGER NOT NULL,
+               timestamp INTEGER NOT NULL,
+               sample_type INTEGER CHECK (""" + \
+    " OR ".join(["sample_type = %d" % x for x in SAMPLETYPES]) + """),
+               total_yield INTEGER,
+               PRIMARY KEY (inverter_serial,
+                            timestamp, sample_type))"""
+
+SCHEMA_V2_3 = squash_schema((_V2_GENERATION, _V2_PVOUTPUT))
+
+# An interrupted update_v2_3()
+SCHEMA_V2_3_PARTIAL = squash_schema((_V2_GENERATION, _V2_PVOUTPUT,
+                                     _V3_GENERATION % "new_generation"))
+
+# Rows moved per transaction by chunked updates
+BATCH_ROWS = 50000
 
 
-def update_v2_3(conn):
-    conn.execute("""CREATE TABLE "new_generation"
-                           (inverter_serial INTEGER NOT NULL,
-                            timestamp INTEGER NOT NULL,
-                            sample_type INTEGER CHECK (""" +
-                 " OR ".join(["sample_type = %d" % x for x in SAMPLETYPES]) +
-                 """),
-                            total_yield INTEGER,
-                            PRIMARY KEY (inverter_serial,
-                                        timestamp, sample_type))""")
-    conn.execute("""INSERT INTO new_generation (inverter_serial, timestamp,
-                                                sample_type, total_yield)
-                        SELECT inverter_serial, timestamp, ?, total_yield
-                               FROM generation""", (SAMPLE_INV_FAST,))
+def update_v2_3(conn, progress):
+    if sqlite_schema(conn) == SCHEMA_V2_3:
+        conn.execute(_V3_GENERATION % "new_generation")
+        conn.commit()
+
+    c = conn.cursor()
+    c.execute("SELECT count(*) FROM generation")
+    remaining = c.fetchone()[0]
+    c.execute("SELECT count(*) FROM new_generation")
+    done = c.fetchone()[0]
+    total = done + remaining
+
+    # Move rather than copy, one batch per transaction.  If we're
+    # interrupted the database is left in SCHEMA_V2_3_PARTIAL with no
+    # row in both tables, and we simply carry on next time.  Pages freed
+    # from the old table get reused by the new one, so the file doesn't
+    # grow to hold two copies of the data.
+    while True:
+        c.execute("SELECT max(rowid) FROM"
+                  " (SELECT rowid FROM generation ORDER BY rowid LIMIT ?)",
+                  (BATCH_ROWS,))
+        last = c.fetchone()[0]
+        if last is None:
+            break
+        c.execute("""INSERT INTO new_generation (inverter_serial, timestamp,
+                                                 sample_type, total_yield)
+                         SELECT inverter_serial, timestamp, ?, total_yield
+                             FROM generation WHERE rowid <= ?""",
+                  (SAMPLE_INV_FAST, last))
+        done += c.rowcount
+        c.execute("DELETE FROM generation WHERE rowid <= ?", (last,))
+        conn.commit()
+        progress("Converting samples", done, total)
+
     conn.execute("DROP TABLE generation")
     conn.execute("ALTER TABLE new_generation RENAME TO generation")
     conn.commit()
-    conn.execute("VACUUM")
+
+
+SCHEMA_V3 = squash_schema((_V3_GENERATION % "generation", _V2_PVOUTPUT))
+
+_V4_WATERMARKS = """CREATE TABLE watermarks (consumer STRING NOT NULL,
+                                    inverter_serial INTEGER NOT NULL,
+                                    sample_type INTEGER NOT NULL,
+                                    timestamp INTEGER NOT NULL,
+                                    PRIMARY KEY (consumer, inverter_serial,
+                                                 sample_type))"""
+
+
+def update_v3(conn, progress):
+    conn.execute(_V4_WATERMARKS)
+    # One last full scan, so nobody needs max(timestamp) again
+    conn.execute("""INSERT INTO watermarks (consumer, inverter_serial,
+                                            sample_type, timestamp)
+                        SELECT ?, inverter_serial, sample_type,
+                               max(timestamp)
+                            FROM generation
+                            GROUP BY inverter_serial, sample_type""",
+                 (WATERMARK_INGEST,))
+    conn.execute("""INSERT OR REPLACE INTO watermarks (consumer,
+                                                       inverter_serial,
+                                                       sample_type,
+                                                       timestamp)
+                        SELECT ?, sid, ?, max(last_datetime_uploaded)
+                            FROM pvoutput
+                            WHERE last_datetime_uploaded IS NOT NULL
+                            GROUP BY sid""",
+                 (WATERMARK_PVOUTPUT, SAMPLE_INV_FAST))
+    conn.execute("DROP TABLE pvoutput")
+    conn.commit()
+
+
+SCHEMA_V4 = squash_schema((_V3_GENERATION % "generation", _V4_WATERMARKS))
+
+
+def update_v4(conn, progress):
+    conn.execute(SQLiteDatabase.DDL[2])
+    conn.commit()
+
+
+SCHEMA_V5 = squash_schema(SQLiteDatabase.DDL[:3])
+
+
+def update_v5(conn, progress):
+    # Upload progress already lives in the watermarks table, which
+    # update_v3 moved the old pvoutput table into.  The outbox starts
+    # out empty.
+    conn.execute(SQLiteDatabase.DDL[3])
+    conn.commit()
 
 
 _schema_table = {
@@ -330,24 +1159,190 @@ _schema_table = {
     SCHEMA_V0: update_v0,
     SCHEMA_NOPVO: update_nopvo,
     SCHEMA_V2_3: update_v2_3,
+    SCHEMA_V2_3_PARTIAL: update_v2_3,
+    SCHEMA_V3: update_v3,
+    SCHEMA_V4: update_v4,
+    SCHEMA_V5: update_v5,
 }
 
 
-def try_open(filename):
+def no_progress(step, done, total):
+    pass
+
+
+def backup(filename, bkname, pages=1024, pause=0, progress=no_progress):
+    """Copy a database with SQLite's online backup API
+
+    The source is only locked while each batch of pages is copied, so
+    other connections can keep using it during a long backup.  Sleeping
+    for pause seconds between batches leaves them more room still.
+    """
+    src = sqlite3.connect(filename)
+    dest = sqlite3.connect(bkname)
+
+    def backup_progress(status, remaining, total):
+        progress("Backing up", total - remaining, total)
+        if remaining and pause:
+            time.sleep(pause)
+
+    try:
+        src.backup(dest, pages=pages, progress=backup_progress)
+    finally:
+        dest.close()
+        src.close()
+
+
+def snapshot(filename, dest, pages=256, pause=0.05, full=False,
+             progress=no_progress, **options):
+    """Make or refresh a copy of a live database
+
+    The first snapshot is an online backup of every database file,
+    throttled so that downloads can carry on meanwhile.  After that,
+    unless full is set, only samples above the snapshot's ingest
+    watermarks are copied across.  An incremental refresh doesn't see
+    samples deleted or downsampled in the source, so take a full
+    snapshot after doing either.
+
+    Each file is backed up in its own transaction, so the files of a
+    partitioned snapshot needn't be from the same moment: partitions
+    can hold samples newer than the watermarks in the main file.  The
+    next refresh copies those again, overwriting them.
+
+    Args:
+       filename (str): The live database
+       dest (str): The snapshot
+       options: Passed on to SQLiteDatabase, as for create_or_update()
+    """
+    src = SQLiteDatabase(filename, **options)
     try:
-        db = SQLiteDatabase(filename)
+        if not full and os.path.exists(dest):
+            snap = try_open(dest, **options)
+            if snap is not None:
+                try:
+                    _refresh_snapshot(src, snap, pause, progress)
+                finally:
+                    snap.close()
+                return
+
+        # Each partition file is copied separately, so partitions
+        # created meanwhile are left out rather than caught half done
+        keys = list(src.partitions)
+        backup(filename, dest + ".tmp", pages, pause, progress)
+        for key in keys:
+            backup(src.partition_filename(key),
+                   "%s.%s.tmp" % (dest, key), pages, pause, progress)
+        for key in keys:
+            os.replace("%s.%s.tmp" % (dest, key), "%s.%s" % (dest, key))
+        os.replace(dest + ".tmp", dest)
+    finally:
+        src.close()
+
+
+def _refresh_snapshot(src, snap, pause, progress):
+    c = snap.conn.cursor()
+    serials = src.serials()
+    for i, serial in enumerate(serials):
+        for sample_type in SAMPLETYPES:
+            upto = src.get_watermark(WATERMARK_INGEST, serial, sample_type)
+            since = snap.get_watermark(WATERMARK_INGEST, serial,
+                                       sample_type)
+            if upto is None or (since is not None and upto <= since):
+                continue
+            if since is None:
+                since = -1
+
+            samples = [(ts, y) for ts, st, y
+                       in src.get_samples(serial, since + 1, upto + 1)
+                       if st == sample_type]
+            # A full snapshot's partitions may already have some
+            snap._insert(serial, sample_type, samples, replace=True)
+
+            # Runs which grew may have swallowed samples we already have
+            for run in src._runs([serial], since + 1, upto + 1,
+                                 sample_type):
+                first, last = run[2:4]
+                for tables in snap._tables(first + 1, last):
+                    for table in tables:
+                        c.execute("DELETE FROM " + table +
+                                  " WHERE inverter_serial = ?"
+                                  " AND sample_type = ?"
+                                  " AND timestamp > ? AND timestamp < ?",
+                                  (serial, sample_type, first, last))
+                c.execute("INSERT OR REPLACE INTO generation_runs"
+                          " (inverter_serial, sample_type, first_ts,"
+                          " last_ts, step, total_yield)"
+                          " VALUES (?, ?, ?, ?, ?, ?)", run)
+
+            snap.set_watermark(WATERMARK_INGEST, serial, sample_type, upto)
+            snap.commit()
+            if pause:
+                time.sleep(pause)
+        progress("Refreshing snapshot", i + 1, len(serials))
+
+    # Bring the other consumers' positions across too
+    sc = src.conn.cursor()
+    sc.execute("SELECT consumer, inverter_serial, sample_type, timestamp"
+               " FROM watermarks WHERE consumer != ?", (WATERMARK_INGEST,))
+    c.executemany("INSERT OR REPLACE INTO watermarks (consumer,"
+                  " inverter_serial, sample_type, timestamp)"
+                  " VALUES (?, ?, ?, ?)", sc.fetchall())
+    sc.execute("SELECT * FROM pvoutput_outbox")
+    c.execute("DELETE FROM pvoutput_outbox")
+    c.executemany("INSERT INTO pvoutput_outbox"
+                  " VALUES (?, ?, ?, ?, ?, ?, ?, ?)", sc.fetchall())
+    snap.commit()
+
+
+def vacuum(conn, pages=1024, progress=no_progress):
+    """Reclaim free space, a batch of pages at a time if possible"""
+    c = conn.cursor()
+    c.execute("PRAGMA auto_vacuum")
+    if c.fetchone()[0] != 2:
+        # Not in incremental mode, only a full VACUUM will do
+        progress("Vacuuming", 0, 1)
+        conn.execute("VACUUM")
+        progress("Vacuuming", 1, 1)
+        return
+
+    c.execute("PRAGMA freelist_count")
+    total = c.fetchone()[0]
+    remaining = total
+    while remaining:
+        c.execute("PRAGMA incremental_vacuum(%d)" % pages)
+        c.fetchall()
+        conn.commit()
+        c.execute("PRAGMA freelist_count")
+        remaining = c.fetchone()[0]
+        progress("Vacuuming", total - remaining, total)
+
+
+def try_open(filename, **options):
+    try:
+        db = SQLiteDatabase(filename, **options)
         return db
     except WrongSchema:
         return None
 
 
-def create_or_update(filename):
-    db = try_open(filename)
+def create_or_update(filename, backup_db=True, vacuum_db=False,
+                     progress=no_progress, **options):
+    """Open a database, creating it or updating its schema as necessary
 
-    if db is None:
+    Args:
+       filename (str): The database file
+       backup_db (bool): Save a copy as <filename>.bak before updating
+       vacuum_db (bool): Reclaim free space after updating
+       progress (callable): Called as progress(step, done, total) while
+          long running steps make progress
+       options: Passed on to SQLiteDatabase
+    """
+    db = try_open(filename, **options)
+
+    if db is None and backup_db:
         bkname = filename + ".bak"
-        shutil.copyfile(filename, bkname)
+        backup(filename, bkname, progress=progress)
 
+    updated = False
     while db is None:
         conn = sqlite3.connect(filename)
 
@@ -359,7 +1354,8 @@ def create_or_update(filename):
         conv = _schema_table[old_schema]
         assert conv is not None
 
-        conv(conn)
+        conv(conn, progress)
+        updated = True
 
         new_schema = sqlite_schema(conn)
 
@@ -370,6 +1366,9 @@ def create_or_update(filename):
         del conn
 
         # Try again
-        db = try_open(filename)
+        db = try_open(filename, **options)
+
+    if updated and vacuum_db:
+        vacuum(db.conn, progress=progress)
 
     return db
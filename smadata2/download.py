@@ -17,22 +17,32 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
+import collections
+import heapq
+import itertools
+import queue
+import threading
 import time
 
-from .db import SAMPLE_INV_FAST, SAMPLE_INV_DAILY
+from . import backfill
+from .db import SAMPLE_INV_FAST, SAMPLE_INV_DAILY, WATERMARK_INGEST
 
 
-def download_type(ic, db, sample_type, data_fn):
-    lasttime = db.get_last_sample(ic.serial, sample_type)
+def download_start(ic, db, sample_type):
+    lasttime = db.get_watermark(WATERMARK_INGEST, ic.serial, sample_type)
     if lasttime is None:
         lasttime = ic.starttime
+    return lasttime
+
+
+def download_type(ic, db, sample_type, data_fn):
+    lasttime = download_start(ic, db, sample_type)
 
     now = int(time.time())
 
     data = data_fn(lasttime + 1, now)
 
-    for timestamp, total in data:
-        db.add_sample(ic.serial, timestamp, sample_type, total)
+    db.add_samples(ic.serial, sample_type, data)
 
     return data
 
@@ -46,3 +56,284 @@ def download_inverter(ic, db):
     db.commit()
 
     return (data, data_daily)
+
+
+# Kinds of download work, most urgent first
+LIVE = 0
+DAILY = 1
+BACKFILL = 2
+
+
+class InverterDownload(object):
+    """The outcome of downloading from one inverter, with timings"""
+
+    def __init__(self, ic, start, start_daily):
+        self.ic = ic
+        self.adapter = getattr(ic, "adapter", None)
+        self.start = start
+        self.start_daily = start_daily
+
+        self.data = []
+        self.data_daily = []
+        self.backfilled = []
+        self.deferred = 0
+        self.error = None
+
+        self.connect_time = 0.0
+        self.fetch_time = 0.0
+        self.store_time = 0.0
+
+        # Work items not yet handed back
+        self.pending = 0
+
+    def total_time(self):
+        return self.connect_time + self.fetch_time + self.store_time
+
+
+class WorkItem(object):
+    """One historic request to make of an inverter
+
+    first and last are inclusive, as for historic().  Items of the same
+    kind are done in order of deadline: now for live data, and for
+    backfill, when the inverter will forget the window's first sample.
+    """
+
+    def __init__(self, dl, kind, sample_type, first, last, deadline):
+        self.dl = dl
+        self.kind = kind
+        self.sample_type = sample_type
+        self.first = first
+        self.last = last
+        self.deadline = deadline
+
+        self.data = None
+        self.skipped = False
+
+    def fetch(self, sma):
+        if self.sample_type == SAMPLE_INV_DAILY:
+            fn = sma.historic_daily
+        else:
+            fn = sma.historic
+        t0 = time.monotonic()
+        self.data = fn(self.first, self.last)
+        self.dl.fetch_time += time.monotonic() - t0
+
+    def store(self, db):
+        dl = self.dl
+        t0 = time.monotonic()
+        if self.kind == BACKFILL:
+            dl.backfilled.extend(backfill.store_window(
+                dl.ic, db, self.sample_type, self.first, self.last,
+                self.data))
+        else:
+            db.add_samples(dl.ic.serial, self.sample_type, self.data)
+            db.commit()
+            if self.kind == LIVE:
+                dl.data = self.data
+            else:
+                dl.data_daily = self.data
+        dl.store_time += time.monotonic() - t0
+
+
+class DownloadQueue(object):
+    """Work items for one adapter, most urgent first
+
+    New data comes first, a pass over the inverters in the order they
+    were queued, with each inverter's live then daily item together.
+    Backfill follows in a second pass.  Keeping an inverter's items
+    together means the adapter only needs one connection open at a
+    time.
+    """
+
+    def __init__(self):
+        self.heap = []
+        self.seq = itertools.count()
+        self.order = {}
+
+    def __len__(self):
+        return len(self.heap)
+
+    def push(self, item):
+        rank = self.order.setdefault(id(item.dl), len(self.order))
+        heapq.heappush(self.heap, (item.kind == BACKFILL, rank, item.kind,
+                                   item.deadline, next(self.seq), item))
+
+    def pop(self):
+        return heapq.heappop(self.heap)[-1]
+
+
+def plan_downloads(inverters, db, now, horizon=None, tiers=None):
+    """Queue up the work for a set of inverters, one queue per adapter
+
+    Returns:
+       tuple.  (list of InverterDownloads, dict of DownloadQueues by
+       adapter)
+    """
+    downloads = []
+    queues = collections.OrderedDict()
+    for ic in inverters:
+        dl = InverterDownload(ic,
+                              download_start(ic, db, SAMPLE_INV_FAST),
+                              download_start(ic, db, SAMPLE_INV_DAILY))
+        downloads.append(dl)
+        # A badly configured inverter fails on its own, not the whole run
+        try:
+            items = _plan_inverter(dl, db, now, horizon, tiers)
+        except Exception as e:
+            dl.error = e
+            continue
+
+        queue_ = queues.setdefault(dl.adapter, DownloadQueue())
+        for item in items:
+            queue_.push(item)
+        dl.pending = len(items)
+    return downloads, queues
+
+
+def _plan_inverter(dl, db, now, horizon, tiers):
+    """The work items for one inverter"""
+    ic = dl.ic
+    if dl.start is None or dl.start_daily is None:
+        raise ValueError("No start time configured for inverter %s"
+                         % ic.serial)
+    items = [WorkItem(dl, LIVE, SAMPLE_INV_FAST, dl.start + 1, now, now),
+             WorkItem(dl, DAILY, SAMPLE_INV_DAILY, dl.start_daily + 1,
+                      now, now)]
+    if horizon is not None:
+        for st in (SAMPLE_INV_FAST, SAMPLE_INV_DAILY):
+            windows = backfill.plan(ic, db, st, now, horizon[st],
+                                    tiers if st == SAMPLE_INV_FAST
+                                    else None)
+            items.extend(WorkItem(dl, BACKFILL, st, first, last,
+                                  first + horizon[st])
+                         for first, last in windows)
+    return items
+
+
+def download_all(inverters, db, report=None, connect=None, horizon=None,
+                 budget=None, tiers=None):
+    """Download from many inverters, talking to several at once
+
+    Inverters are grouped by the local Bluetooth adapter they're
+    configured to use, and each adapter gets a worker thread with a
+    queue of work: new fast samples and daily totals from every inverter
+    first, then (optionally) holes in older history.  Backfill
+    only runs while the worker has been busy for less than `budget`
+    seconds, so after an outage fresh data still lands promptly;
+    whatever is deferred is found again next time.
+
+    Only the calling thread touches the database: it plans the work,
+    then stores the results as workers hand them back, so the database
+    needn't be thread safe.
+
+    Args:
+       inverters (list): Inverter configurations
+       db (BaseDatabase): Where to store the samples
+       report (callable): Called with each InverterDownload once all its
+          work is stored (or it fails)
+       connect (callable): Returns a logged on connection to the given
+          inverter, which the caller closes.  By default a new one from
+          its connect_and_logon(), closed once the inverter is done
+       horizon (dict): Also fetch missing older history this far back,
+          by sample type (e.g. backfill.HORIZON)
+       budget (float): Seconds per adapter after which backfill is
+          deferred, by default no limit
+       tiers (list): Retention policy, so thinned history isn't
+          backfilled
+    Returns:
+       list.  An InverterDownload per inverter, in completion order
+    """
+    downloads, queues = plan_downloads(inverters, db, int(time.time()),
+                                       horizon, tiers)
+    # Inverters which failed before there was any work for them
+    unplanned = [dl for dl in downloads if dl.error is not None]
+
+    done = queue.Queue()
+
+    def worker(work):
+        started = time.monotonic()
+        # The one connection open, and whose it is.  Connections we open
+        # are closed on moving to another inverter, ones from connect()
+        # belong to the caller.
+        current = None
+        sma = None
+        while work:
+            item = work.pop()
+            dl = item.dl
+            if current is not dl and sma is not None:
+                if connect is None:
+                    _close(sma)
+                sma = None
+            current = dl
+            if (dl.error is not None
+                or (item.kind == BACKFILL and budget is not None
+                    and time.monotonic() - started >= budget)):
+                item.skipped = True
+            else:
+                try:
+                    if sma is None:
+                        t0 = time.monotonic()
+                        if connect is None:
+                            sma = dl.ic.connect_and_logon()
+                        else:
+                            sma = connect(dl.ic)
+                        dl.connect_time += time.monotonic() - t0
+                    item.fetch(sma)
+                except Exception as e:
+                    dl.error = e
+            done.put(item)
+        if sma is not None and connect is None:
+            _close(sma)
+
+    threads = [threading.Thread(target=worker, args=(work,),
+                                name="download-%s" % (adapter or "default"),
+                                daemon=True)
+               for adapter, work in queues.items()]
+    for t in threads:
+        t.start()
+
+    results = []
+    for dl in unplanned:
+        results.append(dl)
+        if report is not None:
+            report(dl)
+
+    for i in range(sum(dl.pending for dl in downloads)):
+        item = done.get()
+        dl = item.dl
+        if item.skipped:
+            if dl.error is None:
+                dl.deferred += 1
+        elif dl.error is None:
+            try:
+                item.store(db)
+            except Exception as e:
+                dl.error = e
+        dl.pending -= 1
+        if dl.pending == 0:
+            results.append(dl)
+            if report is not None:
+                report(dl)
+
+    for t in threads:
+        t.join()
+    return results
+
+
+def _close(sma):
+    """Close an inverter connection, if it can be"""
+    close = getattr(sma, "close", None)
+    if close is not None:
+        try:
+            close()
+        except Exception:
+            pass
+
+
+def adapter_times(results):
+    """Total time spent on each adapter, to help balance them"""
+    times = collections.OrderedDict()
+    for dl in results:
+        times[dl.adapter] = (times.get(dl.adapter, 0.0)
+                             + dl.connect_time + dl.fetch_time)
+    return times
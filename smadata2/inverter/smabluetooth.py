@@ -111,9 +111,12 @@ class Connection(base.InverterConnection):
     BROADCAST = "ff:ff:ff:ff:ff:ff"
     BROADCAST2 = bytearray(b'\xff\xff\xff\xff\xff\xff')
 
-    def __init__(self, addr):
+    def __init__(self, addr, adapter=None):
         self.sock = socket.socket(socket.AF_BLUETOOTH, socket.SOCK_STREAM,
                                   socket.BTPROTO_RFCOMM)
+        if adapter is not None:
+            # Go out through a particular local adapter
+            self.sock.bind((adapter, 0))
         self.sock.connect((addr, 1))
 
         self.remote_addr = addr
@@ -126,6 +129,9 @@ class Connection(base.InverterConnection):
 
         self.tagcounter = 0
 
+    def close(self):
+        self.sock.close()
+
     def gettag(self):
         self.tagcounter += 1
         return self.tagcounter
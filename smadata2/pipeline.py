@@ -0,0 +1,116 @@
+#! /usr/bin/python3
+#
+# smadata2.pipeline - Streaming stages for preparing pvoutput.org uploads
+# Copyright (C) 2014 David Gibson <david@gibson.dropbear.id.au>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import collections
+import datetime
+
+all = ['Pipeline', 'trim_night', 'complete', 'localize', 'batched']
+
+# Each stage is a generator taking an iterable of statuses, so stages
+# chain together without any of them holding more than a few statuses.
+# Statuses are (timestamp, total yield, ...) tuples, oldest first.
+
+
+class Pipeline(object):
+    """Counts of what comes out of each stage of a chain of generators"""
+
+    def __init__(self):
+        self.counts = collections.OrderedDict()
+
+    def stage(self, name, items):
+        """Pass items through, counting them under name"""
+        # Stages are listed in the order they're chained, not the order
+        # items first reach them
+        self.counts.setdefault(name, 0)
+        return self._count(name, items)
+
+    def _count(self, name, items):
+        for item in items:
+            self.counts[name] += 1
+            yield item
+
+    def __getitem__(self, name):
+        return self.counts.get(name, 0)
+
+    def __str__(self):
+        return " -> ".join("%s %d" % kv for kv in self.counts.items())
+
+
+def trim_night(statuses, last_yield=None):
+    """Drop statuses which don't add anything, such as overnight
+
+    A status with the same yield as the one before is dropped, and so
+    are those after it, up to the last one before the yield changes
+    again, which is kept as the baseline the next day starts from.  A
+    run still flat at the end is dropped completely.
+
+    Args:
+       last_yield (int): Yield of the status before the first one
+    """
+    skipping = False
+    # While skipping, whether to keep a status depends on the next one
+    held = None
+    for this in statuses:
+        if held is not None:
+            if held[1] != this[1]:
+                skipping = False
+                yield held
+            held = None
+        if skipping:
+            held = this
+        elif this[1] == last_yield:
+            skipping = True
+        else:
+            yield this
+        last_yield = this[1]
+
+
+def complete(statuses, ninverters):
+    """Hold back statuses which not every inverter has reported
+
+    Statuses are (timestamp, total yield, inverters reporting).  Ones
+    with some inverters missing are only passed on once a complete one
+    comes after them, since the others may not have reported yet.
+    """
+    waiting = []
+    for status in statuses:
+        waiting.append(status)
+        if status[2] == ninverters:
+            for s in waiting:
+                yield s
+            waiting = []
+
+
+def localize(statuses, tz):
+    """Add local time: (timestamp, datetime in tz, total yield)"""
+    for status in statuses:
+        yield (status[0], datetime.datetime.fromtimestamp(status[0], tz),
+               status[1])
+
+
+def batched(items, size):
+    """Group items into lists of at most size"""
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
@@ -0,0 +1,152 @@
+#! /usr/bin/python3
+#
+# smadata2.pvoutputcache - Keep pvoutput.org responses between runs
+# Copyright (C) 2014 David Gibson <david@gibson.dropbear.id.au>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import sqlite3
+import threading
+import time
+
+all = ['ResponseCache', 'open_cache', 'CACHES']
+
+
+class ResponseCache(object):
+    """pvoutput.org responses, kept in an SQLite file between runs
+
+    Responses are keyed by system, API script and arguments.  Each one
+    remembers the range of days it describes, in pvoutput.org's YYYYMMDD
+    form, so uploading to or deleting from a day can drop everything
+    that might now be out of date.  Responses also expire after their
+    ttl, if they have one.  The file is only a cache, and can be deleted
+    at any time.
+    """
+
+    # Bump this to throw away caches written by older code
+    VERSION = 1
+
+    DDL = """CREATE TABLE responses (sid STRING NOT NULL,
+                                     script STRING NOT NULL,
+                                     args STRING NOT NULL,
+                                     body STRING NOT NULL,
+                                     first_day STRING,
+                                     last_day STRING,
+                                     expires REAL,
+                                     PRIMARY KEY (sid, script, args))"""
+
+    def __init__(self, filename, clock=time.time, timeout=30.0):
+        self.filename = filename
+        self.clock = clock
+        # Uploads to several systems may share the cache from their own
+        # threads.  Every statement stands alone, so run in autocommit.
+        self.conn = sqlite3.connect(filename, timeout=timeout,
+                                    isolation_level=None,
+                                    check_same_thread=False)
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.invalidations = 0
+
+        with self.lock:
+            c = self.conn.cursor()
+            c.execute("PRAGMA user_version")
+            if c.fetchone()[0] != self.VERSION:
+                c.execute("DROP TABLE IF EXISTS responses")
+                c.execute(self.DDL)
+                c.execute("PRAGMA user_version = %d" % self.VERSION)
+            c.execute("DELETE FROM responses WHERE expires <= ?",
+                      (self.clock(),))
+
+    def get(self, sid, script, args):
+        """A cached response, or None"""
+        with self.lock:
+            c = self.conn.cursor()
+            c.execute("SELECT body, expires FROM responses"
+                      " WHERE sid = ? AND script = ? AND args = ?",
+                      (str(sid), script, args))
+            r = c.fetchone()
+            if r is not None and r[1] is not None and r[1] <= self.clock():
+                c.execute("DELETE FROM responses"
+                          " WHERE sid = ? AND script = ? AND args = ?",
+                          (str(sid), script, args))
+                r = None
+            if r is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return r[0]
+
+    def put(self, sid, script, args, body, ttl=None, first_day=None,
+            last_day=None):
+        """Remember a response
+
+        Args:
+           ttl (float): Seconds the response stays good for, or None to
+              keep it until one of its days is invalidated
+           first_day, last_day (str): The days the response describes
+        """
+        expires = None
+        if ttl is not None:
+            expires = self.clock() + ttl
+        if last_day is None:
+            last_day = first_day
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO responses"
+                              " (sid, script, args, body, first_day,"
+                              " last_day, expires)"
+                              " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                              (str(sid), script, args, body, first_day,
+                               last_day, expires))
+            self.stores += 1
+
+    def invalidate(self, sid, day):
+        """Drop responses about a system which cover a day"""
+        with self.lock:
+            c = self.conn.cursor()
+            c.execute("DELETE FROM responses WHERE sid = ?"
+                      " AND first_day <= ? AND last_day >= ?",
+                      (str(sid), day, day))
+            self.invalidations += c.rowcount
+
+    def clear(self):
+        with self.lock:
+            self.conn.execute("DELETE FROM responses")
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def __str__(self):
+        lookups = self.hits + self.misses
+        ratio = (100.0 * self.hits / lookups) if lookups else 0.0
+        return ("%s: %d hits, %d misses (%.1f%%), %d stored, %d invalidated"
+                % (self.filename, self.hits, self.misses, ratio, self.stores,
+                   self.invalidations))
+
+
+# Caches opened by open_cache(), by filename
+CACHES = {}
+_caches_lock = threading.Lock()
+
+
+def open_cache(filename):
+    """The process wide ResponseCache for a file"""
+    with _caches_lock:
+        if filename not in CACHES:
+            CACHES[filename] = ResponseCache(filename)
+        return CACHES[filename]
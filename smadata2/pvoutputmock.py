@@ -0,0 +1,360 @@
+#! /usr/bin/python3
+#
+# smadata2.pvoutputmock - Local stand-in for the pvoutput.org API
+# Copyright (C) 2014 David Gibson <david@gibson.dropbear.id.au>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import collections
+import datetime
+import http.server
+import random
+import socket
+import sys
+import threading
+import time
+import urllib.parse
+
+all = ['MockSystem', 'MockServer']
+
+
+class MockSystem(object):
+    """What the mock server knows about one pvoutput.org system"""
+
+    def __init__(self, sid, name="Mock System", size=1234, donation=True,
+                 quota=None):
+        self.sid = str(sid)
+        self.name = name
+        self.size = size
+        self.donation = donation
+        # date -> time -> cumulative energy, all as pvoutput formats them
+        self.statuses = {}
+        # date -> energy generated that day
+        self.outputs = {}
+
+        # Requests allowed per hour, as the real service counts them
+        if quota is None:
+            quota = 300 if donation else 60
+        self.quota = quota
+        self.hour = None
+        self.used = 0
+
+    def count_request(self, now):
+        """Count a request against the quota
+
+        Returns:
+           tuple.  (whether it's allowed, requests left, when the count
+           resets)
+        """
+        hour = int(now // 3600)
+        if hour != self.hour:
+            self.hour = hour
+            self.used = 0
+        self.used += 1
+        reset = (hour + 1) * 3600
+        return (self.used <= self.quota, max(0, self.quota - self.used),
+                reset)
+
+    def add_status(self, d, t, energy):
+        self.statuses.setdefault(d, {})[t] = int(energy)
+
+    def day(self, d):
+        """A day's statuses, with energy counted from the first one"""
+        day = self.statuses.get(d, {})
+        if not day:
+            return []
+        times = sorted(day)
+        base = day[times[0]]
+        return [(t, day[t] - base) for t in times]
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super(_Handler, self).setup()
+        # Headers and body go out in separate writes, so don't let Nagle
+        # hold the body back waiting on the client's delayed ACK
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.server.mock.opened(self.connection)
+
+    def finish(self):
+        try:
+            super(_Handler, self).finish()
+        finally:
+            self.server.mock.closed(self.connection)
+
+    def respond(self, args):
+        script = urllib.parse.urlsplit(self.path).path
+        code, body, headers = self.server.mock.handle(script, self.headers,
+                                                      args)
+        if code is None:
+            # An injected dropped connection
+            self.close_connection = True
+            self.connection.shutdown(socket.SHUT_RDWR)
+            return
+        body = body.encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "text/plain;charset=UTF-8")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        query = urllib.parse.urlsplit(self.path).query
+        self.respond(dict(urllib.parse.parse_qsl(query)))
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length).decode("ascii")
+        self.respond(dict(urllib.parse.parse_qsl(body)))
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _Server(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Connections dropped by disconnect() are expected
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super(_Server, self).handle_error(request, client_address)
+
+
+class MockServer(object):
+    """A pvoutput.org lookalike listening on a local port
+
+    Enough of the API is implemented for API objects to work against it
+    unmodified: point them at `url`.  Each system's hourly request quota
+    is enforced, and reported in X-Rate-Limit headers when asked for.
+    The server also counts the connections
+    and requests it sees, so tests can check connections are reused,
+    and disconnect() drops every open connection, as a real server does
+    to idle keep-alive connections.
+
+    To look more like the real service, every answer can be delayed by
+    `latency` seconds, or by `latencies[script]` for particular scripts.
+    Failures can be queued with fail(), or made to happen at random to a
+    `failure_rate` fraction of requests.
+    """
+
+    def __init__(self, apikey="MOCKAPIKEY", clock=time.time, latency=0.0,
+                 failure_rate=0.0, seed=None):
+        self.apikey = apikey
+        self.clock = clock
+        self.systems = {}
+        self.lock = threading.Lock()
+
+        self.latency = latency
+        self.latencies = {}
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        # script, or None for any -> [(code, body), ...] still to come
+        self.failures = {}
+
+        self.connections = 0
+        self.requests = collections.Counter()
+        self.failed = collections.Counter()
+        self.sockets = set()
+
+        self.httpd = _Server(("127.0.0.1", 0), _Handler)
+        self.httpd.mock = self
+        self.url = "http://127.0.0.1:%d" % self.httpd.server_address[1]
+        self.thread = None
+
+        self.scripts = {
+            "/service/r2/getsystem.jsp": self.getsystem,
+            "/service/r2/addstatus.jsp": self.addstatus,
+            "/service/r2/addbatchstatus.jsp": self.addbatchstatus,
+            "/service/r2/getstatus.jsp": self.getstatus,
+            "/service/r2/deletestatus.jsp": self.deletestatus,
+            "/service/r2/getmissing.jsp": self.getmissing,
+            "/service/r2/addoutput.jsp": self.addoutput,
+            "/service/r2/addbatchoutput.jsp": self.addbatchoutput,
+        }
+
+    def add_system(self, sid, **kwargs):
+        system = MockSystem(sid, **kwargs)
+        self.systems[system.sid] = system
+        return system
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever,
+                                       args=(0.05,), name="pvoutputmock",
+                                       daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.disconnect()
+        self.httpd.server_close()
+        self.thread.join()
+
+    def opened(self, sock):
+        with self.lock:
+            self.connections += 1
+            self.sockets.add(sock)
+
+    def closed(self, sock):
+        with self.lock:
+            self.sockets.discard(sock)
+
+    def disconnect(self):
+        """Close every open client connection"""
+        with self.lock:
+            sockets = list(self.sockets)
+        for sock in sockets:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def fail(self, script=None, code=503, body=None, times=1, headers=None):
+        """Make the next requests fail
+
+        Args:
+           script (str): Only fail requests to this script, or None for
+              any
+           code (int): HTTP status to answer with, or None to drop the
+              connection without answering
+           body (str): Response body, or a generic one for the code
+           times (int): How many requests to fail
+           headers (dict): Extra response headers, such as Retry-After
+        """
+        if body is None and code is not None:
+            body = "%s %d: Injected failure" % (
+                "Service Unavailable" if code >= 500 else "Error", code)
+        with self.lock:
+            self.failures.setdefault(script, []).extend(
+                [(code, body, headers or {})] * times)
+
+    def _failure(self, script):
+        """The failure, if any, this request should get"""
+        for key in (script, None):
+            queued = self.failures.get(key)
+            if queued:
+                return queued.pop(0)
+        if self.failure_rate and self.random.random() < self.failure_rate:
+            return 503, "Service Unavailable 503: Random failure", {}
+        return None
+
+    def handle(self, script, headers, args):
+        """Answer one API request
+
+        Returns:
+           tuple.  (HTTP status, or None to drop the connection, response
+           body, extra response headers)
+        """
+        with self.lock:
+            self.requests[script] += 1
+            failure = self._failure(script)
+            if failure is not None:
+                self.failed[script] += 1
+        latency = self.latencies.get(script, self.latency)
+        if latency:
+            time.sleep(latency)
+        if failure is not None:
+            return failure
+        if headers.get("X-Pvoutput-Apikey") != self.apikey:
+            return 401, "Unauthorized 401: Invalid API Key", {}
+        system = self.systems.get(headers.get("X-Pvoutput-SystemId"))
+        if system is None:
+            return 401, "Unauthorized 401: Invalid System ID", {}
+        fn = self.scripts.get(script)
+        if fn is None:
+            return 404, "Not Found 404: %s" % script, {}
+
+        with self.lock:
+            allowed, remaining, reset = system.count_request(self.clock())
+            extra = {}
+            if headers.get("X-Rate-Limit") == "1":
+                extra = {
+                    "X-Rate-Limit-Remaining": str(remaining),
+                    "X-Rate-Limit-Limit": str(system.quota),
+                    "X-Rate-Limit-Reset": str(reset),
+                }
+            if not allowed:
+                return (403, "Forbidden 403: Exceeded %d requests per hour"
+                        % system.quota, extra)
+            code, body = fn(system, args)
+            return code, body, extra
+
+    #
+    # The API scripts
+    #
+    def getsystem(self, system, args):
+        return 200, ("%s,%d,0000,1,250,Mock Panel,1,5000,Mock Inverter,N,"
+                     "1.0,No,,0.000000,0.000000,5;;%d"
+                     % (system.name, system.size, int(system.donation)))
+
+    def addstatus(self, system, args):
+        system.add_status(args["d"], args["t"], args["v1"])
+        return 200, "OK 200: Added Status"
+
+    def addbatchstatus(self, system, args):
+        results = []
+        for entry in args["data"].split(";"):
+            d, t, v1 = entry.split(",")[:3]
+            system.add_status(d, t, v1)
+            results.append("%s,%s,1" % (d, t))
+        return 200, ";".join(results)
+
+    def getstatus(self, system, args):
+        day = system.day(args["d"])
+        if "from" in args:
+            day = [(t, e) for t, e in day if t >= args["from"]]
+        if "to" in args:
+            day = [(t, e) for t, e in day if t <= args["to"]]
+        if args.get("asc", "0") != "1":
+            day.reverse()
+        day = day[:int(args.get("limit", 30))]
+        if not day:
+            return 400, "Bad request 400: No status found"
+        return 200, ";".join("%s,%s,%d,0.000,0,0,0.000,NaN,NaN,NaN,NaN"
+                             % (args["d"], t, e) for t, e in day)
+
+    def deletestatus(self, system, args):
+        if "t" in args:
+            system.statuses.get(args["d"], {}).pop(args["t"], None)
+        else:
+            system.statuses.pop(args["d"], None)
+        return 200, "OK 200: Deleted Status"
+
+    def getmissing(self, system, args):
+        day = datetime.datetime.strptime(args["df"], "%Y%m%d").date()
+        last = datetime.datetime.strptime(args["dt"], "%Y%m%d").date()
+        missing = []
+        while day <= last:
+            d = day.strftime("%Y%m%d")
+            if d not in system.outputs:
+                missing.append(d)
+            day += datetime.timedelta(days=1)
+        return 200, ",".join(missing)
+
+    def addoutput(self, system, args):
+        system.outputs[args["d"]] = int(args["g"])
+        return 200, "OK 200: Added Output"
+
+    def addbatchoutput(self, system, args):
+        results = []
+        for entry in args["data"].split(";"):
+            d, g = entry.split(",")[:2]
+            system.outputs[d] = int(g)
+            results.append("%s,%s,1" % (d, g))
+        return 200, ";".join(results)
@@ -18,9 +18,12 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 import sys
-import urllib.request
+import collections
+import email.utils
+import http.client
+import random
+import threading
 import urllib.parse
-import urllib.error
 import time
 import datetime
 
@@ -29,6 +32,483 @@ class Error(Exception):
     pass
 
 
+class HTTPError(Error):
+    """The server answered, but not with 200 OK"""
+
+    def __init__(self, code, message, url):
+        super(HTTPError, self).__init__("Bad HTTP response code (%d) on %s: %s"
+                                        % (code, url, message))
+        self.code = code
+        self.message = message
+        self.url = url
+
+
+class NetworkError(Error):
+    """We couldn't get an answer from the server at all"""
+    pass
+
+
+class CircuitOpen(Error):
+    """Requests to a host are refused after it has failed repeatedly"""
+
+    def __init__(self, host, wait):
+        super(CircuitOpen, self).__init__(
+            "Not trying %s again for %.0fs after repeated failures"
+            % (host, wait))
+        self.host = host
+        self.wait = wait
+
+
+# Errors which mean a kept-alive connection was closed under us, so it's
+# worth trying again on a new one
+STALE = (http.client.RemoteDisconnected, http.client.CannotSendRequest,
+         ConnectionResetError, ConnectionAbortedError, BrokenPipeError)
+
+
+class EndpointStats(object):
+    """Counters for requests to one API script"""
+
+    def __init__(self, script):
+        self.script = script
+        self.requests = 0
+        self.errors = 0
+        self.reconnects = 0
+        self.seconds = 0.0
+        self.sent = 0
+        self.received = 0
+
+    def __str__(self):
+        mean = (1000.0 * self.seconds / self.requests) if self.requests else 0
+        return ("%s: %d requests (%d failed, %d reconnects), %.1fms mean,"
+                " %d bytes sent, %d received"
+                % (self.script, self.requests, self.errors, self.reconnects,
+                   mean, self.sent, self.received))
+
+
+class ConnectionPool(object):
+    """Keep-alive HTTP/1.1 connections, pooled per host
+
+    Up to `size` idle connections are kept for each scheme, host and
+    port.  A request takes an idle connection if there is one, and puts
+    it back afterwards unless the server said it would close it.  If a
+    reused connection turns out to have been closed by the server in the
+    meantime, the request is retried once on a new connection.
+
+    One pool can be shared by any number of API objects, and threads.
+    """
+
+    def __init__(self, size=4, timeout=30.0):
+        self.size = size
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.stats = {}
+        self.connects = 0
+
+    def _checkout(self, scheme, netloc):
+        with self.lock:
+            idle = self.idle.get((scheme, netloc))
+            if idle:
+                return idle.pop(), True
+            self.connects += 1
+        if scheme == "https":
+            conn = http.client.HTTPSConnection(netloc, timeout=self.timeout)
+        else:
+            conn = http.client.HTTPConnection(netloc, timeout=self.timeout)
+        return conn, False
+
+    def _checkin(self, scheme, netloc, conn):
+        with self.lock:
+            idle = self.idle.setdefault((scheme, netloc), [])
+            if len(idle) < self.size:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def endpoint(self, script):
+        with self.lock:
+            if script not in self.stats:
+                self.stats[script] = EndpointStats(script)
+            return self.stats[script]
+
+    def request(self, url, args, headers):
+        """POST form encoded arguments to a URL
+
+        Returns:
+           tuple.  (HTTP status, body as str, response headers)
+        Raises:
+           pvoutputorg.NetworkError
+        """
+        parts = urllib.parse.urlsplit(url)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        body = urllib.parse.urlencode(args).encode("ascii")
+        headers = dict(headers)
+        headers["Content-Type"] = "application/x-www-form-urlencoded"
+
+        stats = self.endpoint(parts.path)
+        t0 = time.monotonic()
+        while True:
+            conn, reused = self._checkout(parts.scheme, parts.netloc)
+            try:
+                conn.request("POST", path, body, headers)
+                resp = conn.getresponse()
+                data = resp.read()
+            except STALE as e:
+                conn.close()
+                if reused:
+                    stats.reconnects += 1
+                    continue
+                stats.errors += 1
+                raise NetworkError("%s on %s" % (e, url)) from e
+            except (OSError, http.client.HTTPException) as e:
+                conn.close()
+                stats.errors += 1
+                raise NetworkError("%s on %s" % (e, url)) from e
+            break
+
+        if resp.will_close:
+            conn.close()
+        else:
+            self._checkin(parts.scheme, parts.netloc, conn)
+
+        stats.requests += 1
+        if resp.status != 200:
+            stats.errors += 1
+        stats.seconds += time.monotonic() - t0
+        stats.sent += len(body)
+        stats.received += len(data)
+        return resp.status, data.decode("utf-8", "replace"), resp.headers
+
+    def close(self):
+        with self.lock:
+            idle = [c for conns in self.idle.values() for c in conns]
+            self.idle.clear()
+        for conn in idle:
+            conn.close()
+
+
+# Shared by every API object which isn't given its own pool
+DEFAULT_POOL = ConnectionPool()
+
+# Requests allowed per hour, per system
+FREE_QUOTA = 60
+DONATION_QUOTA = 300
+
+
+class TokenBucket(object):
+    """Requests allowed by an hourly quota, refilled continuously"""
+
+    def __init__(self, limit, now):
+        self.limit = limit
+        self.tokens = float(limit)
+        # When tokens was counted, which is in the future while blocked
+        self.updated = now
+        # Whether the server has told us its count
+        self.synced = False
+
+    def refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.limit, self.tokens
+                              + (now - self.updated) * self.limit / 3600.0)
+            self.updated = now
+
+    def block(self, until):
+        """The server's quota is used up until then, when its count
+        starts again from the whole quota"""
+        self.tokens = float(self.limit)
+        self.updated = until
+
+    def reserve(self, now):
+        """Take a token, returning how long to wait before using it"""
+        self.refill(now)
+        self.tokens -= 1
+        wait = max(0.0, self.updated - now)
+        if self.tokens < 0:
+            wait += -self.tokens * 3600.0 / self.limit
+        return wait
+
+
+class RateLimiter(object):
+    """Keeps pvoutput.org requests within their hourly quotas
+
+    Each system has a token bucket holding up to an hour's worth of
+    requests, so a request only waits once the quota really is used up.
+    When responses carry the X-Rate-Limit headers, the bucket is brought
+    into line with the server's own count.  One RateLimiter is meant to
+    be shared by every API object and thread in the process.
+    """
+
+    def __init__(self, clock=time.time, sleep=time.sleep):
+        self.clock = clock
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        self.buckets = {}
+
+        self.requests = 0
+        self.waits = 0
+        self.waited = 0.0
+
+    def _bucket(self, key, now):
+        if key not in self.buckets:
+            self.buckets[key] = TokenBucket(FREE_QUOTA, now)
+        return self.buckets[key]
+
+    def set_limit(self, key, limit):
+        """Set the quota for key, unless the server has told us it"""
+        with self.lock:
+            bucket = self._bucket(key, self.clock())
+            if not bucket.synced and bucket.limit != limit:
+                bucket.tokens += limit - bucket.limit
+                bucket.limit = limit
+
+    def acquire(self, key):
+        """Wait until a request for key is allowed"""
+        with self.lock:
+            wait = self._bucket(key, self.clock()).reserve(self.clock())
+            self.requests += 1
+            if wait > 0:
+                self.waits += 1
+                self.waited += wait
+        if wait > 0:
+            self.sleep(wait)
+        return wait
+
+    def update(self, key, headers):
+        """Adjust to the X-Rate-Limit headers on a response, if any"""
+        remaining = headers.get("X-Rate-Limit-Remaining")
+        limit = headers.get("X-Rate-Limit-Limit")
+        reset = headers.get("X-Rate-Limit-Reset")
+        if remaining is None or limit is None:
+            return
+        with self.lock:
+            now = self.clock()
+            bucket = self._bucket(key, now)
+            bucket.refill(now)
+            bucket.limit = int(limit)
+            bucket.tokens = min(bucket.tokens, float(remaining))
+            bucket.synced = True
+            if int(remaining) <= 0 and reset is not None \
+                    and float(reset) > now:
+                bucket.block(float(reset))
+
+    def __str__(self):
+        return ("%d requests, %d waited for %.1fs"
+                % (self.requests, self.waits, self.waited))
+
+
+# Shared by every API object which isn't given its own limiter
+DEFAULT_LIMITER = RateLimiter()
+
+# Kinds of failure worth retrying
+CONNECT = "connect"             # No answer from the server at all
+SERVER = "server"               # 5xx
+RATE_LIMITED = "rate-limited"   # 403 for exceeding the hourly quota
+
+
+def failure_kind(code, message):
+    """Which kind of retryable failure a response is, if any
+
+    Args:
+       code (int): HTTP status, or None if there was no answer
+    Returns:
+       str.  CONNECT, SERVER, RATE_LIMITED, or None if the request
+       succeeded or retrying it wouldn't help
+    """
+    if code is None:
+        return CONNECT
+    if code >= 500:
+        return SERVER
+    if code == 403 and "Exceeded" in message:
+        return RATE_LIMITED
+    return None
+
+
+class RetryPolicy(object):
+    """How often, and how far apart, to retry one kind of failure
+
+    Retries back off exponentially from `base` seconds up to `cap`,
+    with "full jitter": each delay is picked at random from zero up to
+    the backoff, so clients which failed together don't retry together.
+    """
+
+    def __init__(self, retries, base, cap):
+        self.retries = retries
+        self.base = base
+        self.cap = cap
+
+    def delay(self, attempt, rand):
+        """Seconds to wait before retry number attempt (from 0)"""
+        return rand.uniform(0, min(self.cap, self.base * 2 ** attempt))
+
+
+class CircuitBreaker(object):
+    """Stop sending requests to a host which keeps failing
+
+    After `threshold` failures in a row the circuit opens, and requests
+    fail straight away with CircuitOpen for `cooldown` seconds.  After
+    that requests are let through again, but without retries: an answer
+    closes the circuit, while another failure opens it for another
+    cooldown.
+    """
+
+    def __init__(self, host, threshold, cooldown):
+        self.host = host
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.open_until = None
+        self.opened = 0
+
+    def check(self, now):
+        if self.open_until is not None and now < self.open_until:
+            raise CircuitOpen(self.host, self.open_until - now)
+
+    def succeeded(self):
+        self.failures = 0
+        self.open_until = None
+
+    def failed(self, now):
+        self.failures += 1
+        if self.failures >= self.threshold or self.open_until is not None:
+            if self.open_until is None or now >= self.open_until:
+                self.opened += 1
+            self.open_until = now + self.cooldown
+
+
+class Retrier(object):
+    """Decides when requests which failed are tried again
+
+    Each kind of failure has its own RetryPolicy, and each host its own
+    CircuitBreaker.  A Retry-After header on the response is honoured if
+    it asks for a longer wait than the backoff.  A rate limited request
+    whose response said when the quota resets is left to the
+    RateLimiter to hold back until then.  Like the RateLimiter, one
+    Retrier is meant to be shared by every API object in the process,
+    and it keeps count of where the time went.
+    """
+
+    POLICIES = {
+        CONNECT: RetryPolicy(3, 1.0, 30.0),
+        SERVER: RetryPolicy(3, 2.0, 60.0),
+        RATE_LIMITED: RetryPolicy(1, 300.0, 3600.0),
+    }
+
+    def __init__(self, policies=None, threshold=5, cooldown=60.0,
+                 clock=time.time, sleep=time.sleep, rand=None):
+        self.policies = dict(self.POLICIES)
+        if policies is not None:
+            self.policies.update(policies)
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.clock = clock
+        self.sleep = sleep
+        self.random = rand if rand is not None else random.Random()
+        self.lock = threading.Lock()
+        self.breakers = {}
+
+        self.attempts = 0
+        self.retries = collections.Counter()
+        self.gave_up = 0
+        self.refused = 0
+        self.transmitting = 0.0
+        self.backing_off = 0.0
+        self.rate_limited = 0.0
+
+    def check(self, host):
+        """Raise CircuitOpen if host isn't being sent requests"""
+        with self.lock:
+            if host not in self.breakers:
+                self.breakers[host] = CircuitBreaker(host, self.threshold,
+                                                     self.cooldown)
+            try:
+                self.breakers[host].check(self.clock())
+            except CircuitOpen:
+                self.refused += 1
+                raise
+            self.attempts += 1
+
+    def waited(self, seconds):
+        """Count time the RateLimiter held a request back"""
+        with self.lock:
+            self.rate_limited += seconds
+
+    def transmitted(self, seconds):
+        """Count time spent on a request"""
+        with self.lock:
+            self.transmitting += seconds
+
+    def retry_after(self, headers):
+        """Seconds a response's Retry-After header asks for, or None"""
+        value = headers.get("Retry-After")
+        if value is None:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            when = email.utils.parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        return max(0.0, when.timestamp() - self.clock())
+
+    def result(self, host, kind, attempt, headers):
+        """Record how a request went, and whether to retry it
+
+        Args:
+           kind (str): What went wrong, from failure_kind()
+           attempt (int): How many retries there have been already
+           headers: The response headers, if there was a response
+        Returns:
+           float.  Seconds to wait before retrying, or None not to retry
+        """
+        with self.lock:
+            breaker = self.breakers[host]
+            if kind in (CONNECT, SERVER):
+                breaker.failed(self.clock())
+            else:
+                # The server answered, so it's up
+                breaker.succeeded()
+            policy = self.policies.get(kind)
+            if policy is None:
+                return None
+            if attempt >= policy.retries or breaker.open_until is not None:
+                self.gave_up += 1
+                return None
+            self.retries[kind] += 1
+            delay = policy.delay(attempt, self.random)
+
+        if kind == RATE_LIMITED and "X-Rate-Limit-Reset" in headers:
+            delay = 0.0
+        after = self.retry_after(headers)
+        if after is not None:
+            delay = max(delay, after)
+        return delay
+
+    def backoff(self, delay):
+        with self.lock:
+            self.backing_off += delay
+        if delay > 0:
+            self.sleep(delay)
+
+    def __str__(self):
+        retries = ", ".join("%d %s" % (n, kind)
+                            for kind, n in sorted(self.retries.items()))
+        return ("%d attempts, %d retried (%s), %d gave up, %d refused by"
+                " open circuits; %.1fs transmitting, %.1fs waiting"
+                " (%.1fs backing off, %.1fs rate limited)"
+                % (self.attempts, sum(self.retries.values()),
+                   retries or "none", self.gave_up, self.refused,
+                   self.transmitting, self.backing_off + self.rate_limited,
+                   self.backing_off, self.rate_limited))
+
+
+# Shared by every API object which isn't given its own Retrier
+DEFAULT_RETRIER = Retrier()
+
+
 def parse_date(pvodate):
     """ parse a date supplied by pvoutput.org
     @param pvoutput_date a date in pvoutput API form
@@ -75,12 +555,29 @@ def format_datetime(dt):
     return format_date(d), format_time(t)
 
 
+# How long cached responses stay good for, in seconds.  Statuses for a
+# closed day only change when we upload them, which drops them from the
+# cache anyway, so they're kept longest.
+SYSTEM_TTL = 24 * 3600
+STATUS_TTL = 30 * 24 * 3600
+MISSING_TTL = 3600
+
+# Days at least this old are over in every timezone
+CLOSED_DAYS = 2
+
+
 class API(object):
     """Represents the pvoutput.org web API, for a particular system
 
-    API documentation can be found at http://pvoutput.org/help.html#api-spec"""
+    API documentation can be found at http://pvoutput.org/help.html#api-spec
+
+    With a response cache (see pvoutputcache), system information, the
+    statuses of closed days and missing output dates are answered from
+    it where possible.  Uploading to or deleting from a day drops what
+    the cache knows about that day."""
 
-    def __init__(self, baseurl, apikey, sid):
+    def __init__(self, baseurl, apikey, sid, pool=None, limiter=None,
+                 cache=None, retrier=None):
         if not baseurl:
             raise ValueError("Bad or missing base URL")
 
@@ -93,12 +590,25 @@ class API(object):
         self.baseurl = baseurl
         self.apikey = apikey
         self.sid = sid
+        if pool is None:
+            pool = DEFAULT_POOL
+        self.pool = pool
+        if limiter is None:
+            limiter = DEFAULT_LIMITER
+        self.limiter = limiter
+        if retrier is None:
+            retrier = DEFAULT_RETRIER
+        self.retrier = retrier
+        self.cache = cache
 
         self.__getsystem()
 
     def _request(self, script, args):
         """Invoke a specific API script
 
+        Failures which might not happen again are retried, as the
+        retrier says.
+
         Args:
            script (str): The path to the script to invoke
            args (dict): Arguments to the script
@@ -108,21 +618,67 @@ class API(object):
            pvoutputorg.Error
         """
         url = self.baseurl + script
+        key = (self.apikey, str(self.sid))
+        host = urllib.parse.urlsplit(url).netloc
+
+        attempt = 0
+        while True:
+            self.retrier.check(host)
+            self.retrier.waited(self.limiter.acquire(key))
+            t0 = time.monotonic()
+            try:
+                code, data, headers = self.pool.request(url, args, {
+                    "X-Pvoutput-Apikey": self.apikey,
+                    "X-Pvoutput-SystemId": str(self.sid),
+                    "X-Rate-Limit": "1",
+                })
+            except NetworkError as e:
+                code, data, headers, error = None, "", {}, e
+            else:
+                self.limiter.update(key, headers)
+                error = None
+                if code != 200:
+                    error = HTTPError(code, data.strip(), url)
+            self.retrier.transmitted(time.monotonic() - t0)
+
+            delay = self.retrier.result(host, failure_kind(code, data),
+                                        attempt, headers)
+            if error is None:
+                return data
+            if delay is None:
+                raise error
+            self.retrier.backoff(delay)
+            attempt += 1
+
+    def _cached_request(self, script, args, ttl, first_day=None,
+                        last_day=None):
+        """_request(), answered from the response cache if possible
 
-        req = urllib.request.Request(url=url,
-                                     data=urllib.parse.urlencode(args))
-        req.add_header("X-Pvoutput-Apikey", self.apikey)
-        req.add_header("X-Pvoutput-SystemId", self.sid)
-        f = urllib.request.urlopen(req)
-        code = f.getcode()
-        if code != 200:
-            raise Error("Bad HTTP response code (%d) on %s" % (code, url))
-        return f.read()
+        Args:
+           ttl (float): Seconds the response may be reused for
+           first_day, last_day (str): The days the response describes
+        """
+        if self.cache is None:
+            return self._request(script, args)
+        key = urllib.parse.urlencode(sorted(args.items()))
+        data = self.cache.get(self.sid, script, key)
+        if data is None:
+            data = self._request(script, args)
+            self.cache.put(self.sid, script, key, data, ttl, first_day,
+                           last_day)
+        return data
+
+    def _invalidate(self, days):
+        """Forget cached responses about days we've changed"""
+        if self.cache is not None:
+            for d in sorted(set(days)):
+                self.cache.invalidate(self.sid, d)
 
     def __getsystem(self):
         """Update self with information from the getsystem API call"""
 
-        data = self._request("/service/r2/getsystem.jsp", {"donations": 1})
+        data = self._cached_request("/service/r2/getsystem.jsp",
+                                    {"donations": 1}, SYSTEM_TTL)
         sysinfo, tarriffs, donation = data.split(";")
 
         sysinfo = sysinfo.split(",")
@@ -131,6 +687,12 @@ class API(object):
         self.system_size = int(sysinfo[1])
         self.donation_mode = int(donation) > 0
 
+        if self.donation_mode:
+            quota = DONATION_QUOTA
+        else:
+            quota = FREE_QUOTA
+        self.limiter.set_limit((self.apikey, str(self.sid)), quota)
+
     def __str__(self):
         return ("SID %s: \"%s\" (%d W) [donation mode: %s]"
                 % (self.sid, self.name, self.system_size, self.donation_mode))
@@ -153,6 +715,7 @@ class API(object):
         @return None
         @fixme check API response"""
         fdate, ftime = format_datetime(dt)
+        self._invalidate([fdate])
         self._request("/service/r2/addstatus.jsp", {
             "d": fdate,
             "t": ftime,
@@ -168,6 +731,7 @@ class API(object):
         @fixme should check server response rather than just printing..."""
         data = [format_datetime(dt) + (str(y), "-1")
                 for dt, y in batch]
+        self._invalidate(d for d, t, y, v2 in data)
         data = ";".join(",".join(x) for x in data)
 
         results = self._request("/service/r2/addbatchstatus.jsp", {
@@ -185,7 +749,11 @@ class API(object):
 
     def addstatus_bulk(self, data):
         """Upload a whole bunch of statuses, splitting into multiple
-        requests as necessary"""
+        requests as necessary
+
+        Batches are sent one after another, each waiting for the previous
+        one's response, which keeps them in order as the API requires.
+        The rate limiter paces them within the hourly quota."""
 
         batchsize = self.status_batchsize()
 
@@ -193,7 +761,6 @@ class API(object):
         while done < len(data):
             batch = data[done:done+batchsize]
             self.addbatchstatus(batch)
-            time.sleep(60)
             done += len(batch)
 
     def deletestatus(self, dt):
@@ -213,6 +780,7 @@ class API(object):
         else:
             raise TypeError
 
+        self._invalidate([opts["d"]])
         self._request("/service/r2/deletestatus.jsp", opts)
 
     def getstatus(self, date, from_=None, to=None):
@@ -228,13 +796,22 @@ class API(object):
         if to is not None:
             opts["to"] = format_time(to)
 
+        day = date
+        if isinstance(day, datetime.datetime):
+            day = day.date()
+        closed = (day <= datetime.date.today()
+                  - datetime.timedelta(days=CLOSED_DAYS))
+
         try:
-            data = self._request('/service/r2/getstatus.jsp', opts)
-        except urllib.error.HTTPError as e:
+            if closed:
+                data = self._cached_request('/service/r2/getstatus.jsp',
+                                            opts, STATUS_TTL, opts["d"])
+            else:
+                data = self._request('/service/r2/getstatus.jsp', opts)
+        except HTTPError as e:
             # API gives an error if no data is present
             if e.code == 400:
-                message = e.read()
-                if message == "Bad request 400: No status found":
+                if e.message == "Bad request 400: No status found":
                     return None
             # Anything else, propagate the error
             raise
@@ -260,11 +837,10 @@ class API(object):
 
         try:
             data = self._request('/service/r2/getstatus.jsp', opts)
-        except urllib.error.HTTPError as e:
+        except HTTPError as e:
             # API gives an error if no data is present
             if e.code == 400:
-                message = e.read()
-                if message == "Bad request 400: No status found":
+                if e.message == "Bad request 400: No status found":
                     return None
             # Anything else, propagate the error
             raise
@@ -280,6 +856,36 @@ class API(object):
 
         return dt, y
 
+    #
+    # Methods dealing with daily outputs
+    #
+    def output_batchsize(self):
+        """ number of outputs allowed in a batch
+        @return the number of outputs allowed in a batch
+        """
+        if self.donation_mode:
+            return 100
+        return 30
+
+    def addbatchoutput(self, outputs):
+        """upload several days' outputs at once
+        @param outputs a list of (date, energy generated in Wh)
+        @return None"""
+        data = [(format_date(d), str(int(g))) for d, g in outputs]
+        self._invalidate(d for d, g in data)
+
+        results = self._request("/service/r2/addbatchoutput.jsp", {
+            "data": ";".join(",".join(x) for x in data),
+        })
+        results = results.split(";")
+        if len(results) != len(outputs):
+            raise Error("Unexpected number of results from addbatchoutput")
+
+        for r in results:
+            d, g, status = r.split(",")
+            if status != "1":
+                raise Error("Failed to upload output for %s" % d)
+
     # Here be dragons...
     def addoutput(self, somedate, somedelta):
         """ add a daily output to pvoutput
@@ -289,6 +895,7 @@ class API(object):
         @fixme check API response
         """
 
+        self._invalidate([format_date(somedate)])
         content = self._request("/service/r2/addoutput.jsp", {
             "d": format_date(somedate),
             "g": somedelta,
@@ -309,11 +916,12 @@ class API(object):
         formatted_datefrom = format_date(datefrom)
         formatted_dateto = format_date(dateto)
 
-        data = self._request('/service/r2/getmissing.jsp', {
+        data = self._cached_request('/service/r2/getmissing.jsp', {
             'df': formatted_datefrom,
             'dt': formatted_dateto,
-        })
-        missings = data.split(',')
+        }, MISSING_TTL, formatted_datefrom, formatted_dateto)
+        # Nothing missing is an empty answer
+        missings = [d for d in data.strip().split(',') if d]
 
         print("missings: " + str(missings))
 
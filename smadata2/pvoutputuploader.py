@@ -1,13 +1,22 @@
 import time
 import datetime
 
+from . import reconcile
+from .pipeline import Pipeline, trim_night, complete, localize, batched
+from .db import OUTBOX_SENDING, OUTBOX_FAILED
+
 
 class PVOutputUploader(object):
+    # statuses per outbox batch, the most pvoutput.org accepts at once
+    OUTBOX_BATCH = 100
+
     def __init__(self, db, system, pvoutput):
         self.verbose = False
         self.db = db
         self.pvoutput = pvoutput
         self.system = system
+        # statuses counted through each stage of queueing and sending
+        self.pipeline = Pipeline()
 
     # setVerbose
     # @param verbose whether to be verbose or not
@@ -17,14 +26,15 @@ class PVOutputUploader(object):
     # send entries to server
     # @param entries entries to send [[ dt, totalprod ], ...]
     # @fixme sanity checking for too-old-dates should be made by callers
-    # @fixme move this batching into pvoutput
+    # @note batches go out one at a time, each after the server has
+    #       answered the last, so they arrive in order as the API wants.
+    #       The API's rate limiter does any waiting needed for the quota.
     def send_production(self, entries):
         batch = []
 
         too_old_in_days = self.pvoutput.days_ago_accepted_by_api()
+        batchsize = self.pvoutput.status_batchsize()
 
-        havesent = False
-        timeout = 20
         for i in entries:
             timestamp = i[0]
             total_production = i[1]
@@ -35,94 +45,135 @@ class PVOutputUploader(object):
 
             # 14 day limit on API - only upload the last 13 days of data:
             if (time.time() - timestamp) > (too_old_in_days*24*60*60 - 600):
-                    print(("Skipping too-old datapoint @" + str(timestamp)))
-                    continue
+                print(("Skipping too-old datapoint @" + str(timestamp)))
+                continue
 
             dt = datetime.datetime.fromtimestamp(timestamp)
             batch.append([dt, total_production])
 
-            if len(batch) == self.pvoutput.batchstatus_count_accepted_by_api():
-                if havesent:
-                    # if we do *not* wait, other requests can get served
-                    # first.  The API wants stuff *in order*!  Sucks.
-                    print(("sleeping %d" % timeout))
-                    time.sleep(timeout)
-                else:
-                    havesent = True
+            if len(batch) == batchsize:
                 self.pvoutput.addbatchstatus(batch)
                 batch = []
 
         if batch:
-                if havesent:
-                    print("sleeping before sending final batch")
-                    time.sleep(timeout)
-                self.pvoutput.addbatchstatus(batch)
+            self.pvoutput.addbatchstatus(batch)
 
     # filter out entries that we shouldn't upload to pvoutput.org
-    # @param hwm the last datapoint [timestamp,generation] sent to server
+    # @param last_yield the yield of the last status sent to the server
     # @param statuses the list of statuses to trim
     # @return trimmed status list
     # @note each day needs a baseline-no-production-yet datapoint
-    # @fixme change this to screw with statuses in-place instead
-    def trim_unwanted_unuploaded_statuses(self, last_datetime, statuses):
-        skipping = False
-        last = [None, last_datetime]    # *cough*
-        ret = []
-        while statuses:
-            this = statuses.pop(0)
-            if skipping:
-                if statuses:
-                    next = statuses[0]
-                    if this[1] == next[1]:
-                        pass		# keep skipping
-                    else:
-                        skipping = False
-                        ret.append(this)
-                else:
-                    break
-            else:			# not skipping
-                if last[1] == this[1]:
-                    skipping = True
-                else:
-                    ret.append(this)
-            last = this
-
+    # @note the upload itself streams the same stages, see queue_unuploaded
+    def trim_unwanted_unuploaded_statuses(self, last_yield, statuses):
         # do not upload any final status where not all inverters have reported
-        if len(ret):                    # untested - I only have one inverter
-            invertercount = len(self.system.inverters())
-            while len(ret):
-                if ret[-1][2] == invertercount:
-                    break
-                ret.pop()
-
-        return ret
-
-    # upload statuses that we do not believe are present on the server
-    def upload_unuploaded_statuses(self):
+        return list(complete(trim_night(statuses, last_yield),
+                             len(self.system.inverters())))
+
+    # queue statuses that are neither on the server nor already queued
+    # in the outbox, in batches of at most OUTBOX_BATCH
+    # @return the number of statuses queued
+    # @note the outbox is committed, so the batches survive a crash
+    # @note statuses stream from the database cursor through the trimming
+    #       stages into the outbox, so only one batch is held at a time
+    def queue_unuploaded(self):
         sid = self.system.pvoutput_sid
         last_datetime = self.db.pvoutput_get_last_datetime_uploaded(sid)
         if last_datetime is None:
             self.db.pvoutput_set_last_datetime_uploaded(sid, 0)
+            self.db.commit()
             last_datetime = self.db.pvoutput_get_last_datetime_uploaded(sid)
+        queued = self.db.outbox_last(sid)
+        if queued is not None and queued > last_datetime:
+            last_datetime = queued
 
         print(("last_datetime=%d" % last_datetime))
-        prods = self.db.get_productions_younger_than(self.system.inverters(),
-                                                     last_datetime)
-        print("prods")
-        print(len(prods))
-        new_prods = self.trim_unwanted_unuploaded_statuses(last_datetime,
-                                                           prods)
-        print("new_prods")
-        print(len(new_prods))
-        prods = new_prods
-        if prods:
-            self.send_production(prods)
-            new_last = prods[-1]
-            new_last_datetime = new_last[0]
-            print(("new ldate_datetime=" + str(new_last_datetime)))
-            self.db.pvoutput_set_last_datetime_uploaded(sid, new_last_datetime)
+        p = self.pipeline
+        inverters = self.system.inverters()
+        # The yield already sent or queued, so a flat run after it is
+        # trimmed rather than starting again with its first status
+        last_yield = None
+        if last_datetime > 0:
+            last_yield = self.db.get_aggregate_one_sample(
+                last_datetime, [inv.serial for inv in inverters])
+        prods = p.stage("read", self.db.iter_productions_younger_than(
+            inverters, last_datetime))
+        prods = p.stage("trimmed", trim_night(prods, last_yield))
+        prods = p.stage("complete", complete(prods, len(inverters)))
+        n = 0
+        for batch in p.stage("queued batches",
+                             batched(prods, self.OUTBOX_BATCH)):
+            self.db.outbox_add(sid, [(ts, y) for ts, y, count in batch])
+            n += len(batch)
+        self.db.commit()
+        return n
+
+    # batches in the outbox, oldest first
+    def pending_batches(self):
+        return self.db.outbox_batches(self.system.pvoutput_sid)
+
+    # send outbox batches in order, resuming each after the last status
+    # the server is known to have
+    # @param batches batches from pending_batches()
+    # @param progress called with (batch, sent_ts, error) after every
+    #        request, to be passed on to record()
+    # @return the number of statuses sent
+    # @note doesn't touch the database, so it can run in another thread
+    # @note statuses are filtered, converted to local time and grouped
+    #       into requests lazily, a request's worth at a time.  The API's
+    #       rate limiter does any waiting needed for the quota.
+    def send_batches(self, batches, progress):
+        too_old = self.pvoutput.days_ago_accepted_by_api()*24*60*60 - 600
+        batchsize = self.pvoutput.status_batchsize()
+        tz = self.system.timezone()
+        p = self.pipeline
+        skipped = p["recent"] - p["unsent"]
+        sent = 0
+        for batch in batches:
+            try:
+                now = time.time()
+                entries = p.stage("unsent", batch.unsent())
+                entries = p.stage("recent", (e for e in entries
+                                             if now - e[0] <= too_old))
+                entries = localize(entries, tz)
+                for chunk in p.stage("requests", batched(entries, batchsize)):
+                    self.pvoutput.addbatchstatus([(dt, y)
+                                                  for ts, dt, y in chunk])
+                    sent += len(chunk)
+                    progress((batch, chunk[-1][0], None))
+            except Exception as e:
+                progress((batch, None, e))
+                raise
+            progress((batch, batch.last_ts, None))
+        skipped += p["unsent"] - p["recent"]
+        if skipped:
+            print("Skipped %d too-old datapoints" % skipped)
+        return sent
+
+    # save progress reported by send_batches()
+    # @note a batch is dropped from the outbox, and the watermark moved
+    #       past it, in one transaction once all of it is sent
+    def record(self, item):
+        batch, sent_ts, error = item
+        sid = self.system.pvoutput_sid
+        if error is not None:
+            self.db.outbox_update(sid, batch.first_ts, OUTBOX_FAILED,
+                                  error=str(error))
+        elif sent_ts >= batch.last_ts:
+            self.db.outbox_done(sid, batch.first_ts)
+        else:
+            self.db.outbox_update(sid, batch.first_ts, OUTBOX_SENDING,
+                                  sent_ts=sent_ts)
+        self.db.commit()
+
+    # upload statuses that we do not believe are present on the server
+    def upload_unuploaded_statuses(self):
+        self.queue_unuploaded()
+        batches = self.pending_batches()
+        if batches:
+            self.send_batches(batches, self.record)
         else:
             print("No un-uploaded production")
+        self.debug(str(self.pipeline))
 
     # upload statuses for a specific day
     # @param day day to upload for
@@ -145,103 +196,53 @@ class PVOutputUploader(object):
         if self.verbose:
             print(message)
 
+    # report how a day on pvoutput.org differs from our data
+    # @param diff a reconcile.DayDiff
+    def report_diff(self, diff):
+        print(diff)
+        tz = self.system.timezone()
+        for kind in (reconcile.MISSING, reconcile.EXTRA,
+                     reconcile.MISMATCHED):
+            for first, last in diff.runs[kind]:
+                self.debug("%s: %s - %s"
+                           % (kind,
+                              datetime.datetime.fromtimestamp(first, tz),
+                              datetime.datetime.fromtimestamp(last, tz)))
+
     # check that the db entries are accurately reflected on
     # pvoutput.org for date
     # @param date a datetime object - midnight, please
-    # @fixme take a... you know... date instead of a datetime?
+    # @return a reconcile.DayDiff
     def reconcile_date(self, date):
-        mydata = self.db.get_datapoint_totals_for_day(self.system.inverters(),
-                                                      date)
-
-        # for prod in mydata:
-        #     timestamp = prod[0]
-        #     cumulative = prod[1]
-        #     print("timestamp=%s cumulative=%s" % (timestamp, cumulative))
-
-        theirdata = self.pvoutput.getstatus(date)
-        # for output in theirdata:
-        #     print("date=%s time=%s production=%s" \
-        #            % (output[0], output[1], output[2]))
-
-        my_last_delta = None
-
-        first_production = None
-        while 1:
-            if not mydata:
-                break
-            if not theirdata:
-                break
-            mine = mydata[0]
-            my_timestamp = mine[0]
-            my_datetime = datetime.datetime.fromtimestamp(my_timestamp)
-            my_production = mine[1]
-
-            if first_production is None:
-                first_production = my_production
-
-            # print("my_timestamp=%d my_production=%d" \
-            #       % (my_timestamp, my_production))
-            my_delta = mine[1] - first_production
-
-            my_last_delta = my_delta
-
-            theirs = theirdata[0]
-            their_datetime = theirs[0]
-            their_delta = theirs[1]
-            if their_datetime > my_datetime:
-                mydata.pop(0)
-                if (my_delta != 0):
-                    # fred = datetime.datetime.utcfromtimestamp(my_timestamp)
-                    print(("Extra datapoint from me: %s %s"
-                          % (my_datetime, my_delta)))
-            elif their_datetime < my_datetime:
-                print(("Extra datapoint from them: %s %s"
-                      % (their_datetime, their_delta)))
-                theirdata.pop(0)
-            else:
-                if their_delta != my_delta:
-                    print((("production mismatch (timestamp=%d)" +
-                           " (them=%d us=%d)")
-                          % (my_datetime, their_delta, my_delta)))
-                else:
-                    self.debug("ALL GOOD (them=%d us=%d) (them=%d us=%d)"
-                               % (their_datetime, my_datetime,
-                                  their_delta, my_delta))
-                theirdata.pop(0)
-                mydata.pop(0)
-
-        if theirdata:
-            print(("There are %d on pvoutput.org which aren't in our data"
-                  % len(theirdata)))
-            for output in theirdata:
-                self.debug("their extra: datetime=%s production=%s"
-                           % (output[0], output[1]))
-
-        printed_mydata_warning_once = False
-        if mydata:
-            for mine in mydata:
-                my_delta = mine[1] - first_production
-                if my_delta != my_last_delta:  # zeroes at end of day
-                    if not printed_mydata_warning_once:
-                        print((("There are %d extra readings in my database" +
-                               "which are not on pvoutput.org")
-                              % len(mydata)))
-                        printed_mydata_warning_once = True
-                    self.debug("my extra: timestamp=%s cumulative=%s"
-                               % (mine[0], my_delta))
+        if isinstance(date, datetime.datetime):
+            date = date.date()
+        diff, = reconcile.reconcile(self.db, self.system, self.pvoutput,
+                                    [date])
+        self.report_diff(diff)
+        return diff
 
     # reconcile all data in my database against what is on pvoutput.org
-    def reconcile(self):
-        dates = self.db.midnights(self.system.inverters())
+    # @param fix upload our statuses where theirs are missing or wrong
+    # @param workers most days to fetch from pvoutput.org at once
+    # @return list of reconcile.DayDiff, one per day compared
+    def reconcile(self, fix=False, workers=4):
         now = datetime.datetime.now()
-        for date in dates:
-            if (date.date() == now.date()):
-                # FIXME: API limit; can't get historical information for today
-                continue
-            limitdays = self.pvoutput.days_ago_accepted_by_api()
-            if now - date < datetime.timedelta(days=limitdays):
-                print(("date: %s" % date))
-                self.reconcile_date(date)
+        limitdays = self.pvoutput.days_ago_accepted_by_api()
+        # FIXME: API limit; can't get historical information for today
+        dates = [date.date() for date in self.db.midnights(
+                     self.system.inverters())
+                 if date.date() != now.date()
+                 and now - date < datetime.timedelta(days=limitdays)]
+        diffs = []
+        for diff in reconcile.reconcile(self.db, self.system, self.pvoutput,
+                                        dates, workers=workers):
+            self.report_diff(diff)
+            if fix and not diff.ok():
+                n = reconcile.repair(self.db, self.system, self.pvoutput,
+                                     diff)
+                print("Re-sent %d statuses for %s" % (n, diff.date))
+            diffs.append(diff)
+        return diffs
 
     # simply pull out data for inspection for a particular date/time
     # @param pvstyle_date e.g. "20141231"
@@ -0,0 +1,213 @@
+#! /usr/bin/python3
+#
+# smadata2.reconcile - Compare our statuses with those on pvoutput.org
+# Copyright (C) 2014 David Gibson <david@gibson.dropbear.id.au>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import collections
+import concurrent.futures
+import datetime
+import itertools
+
+from . import datetimeutil
+from .upload import trim_flat
+
+all = ['MATCHED', 'MISSING', 'EXTRA', 'MISMATCHED',
+       'merge_join', 'DayDiff', 'diff_day', 'fetch_days', 'reconcile',
+       'repair']
+
+# How each timestamp compares
+MATCHED = "matched"
+MISSING = "missing"             # We have it, pvoutput.org doesn't
+EXTRA = "extra"                 # pvoutput.org has it, we don't
+MISMATCHED = "mismatched"       # Both have it, with different energy
+
+
+def merge_join(mine, theirs):
+    """Walk two series of (timestamp, value), each sorted by timestamp
+
+    Yields:
+       tuple.  (timestamp, our value, their value), with None for a
+       value missing from one side
+    """
+    mine = iter(mine)
+    theirs = iter(theirs)
+    a = next(mine, None)
+    b = next(theirs, None)
+    while a is not None or b is not None:
+        if b is None or (a is not None and a[0] < b[0]):
+            yield a[0], a[1], None
+            a = next(mine, None)
+        elif a is None or b[0] < a[0]:
+            yield b[0], None, b[1]
+            b = next(theirs, None)
+        else:
+            yield a[0], a[1], b[1]
+            a = next(mine, None)
+            b = next(theirs, None)
+
+
+class DayDiff(object):
+    """How one day's statuses on pvoutput.org differ from ours
+
+    Differences are kept as runs of consecutive timestamps, (first, last)
+    inclusive, with nothing of another kind in between.
+    """
+
+    def __init__(self, date):
+        self.date = date
+        self.runs = {MISSING: [], EXTRA: [], MISMATCHED: []}
+        self.counts = collections.Counter()
+        self.last_kind = None
+
+    def add(self, kind, ts):
+        self.counts[kind] += 1
+        runs = self.runs.get(kind)
+        if runs is not None:
+            if kind == self.last_kind:
+                runs[-1] = (runs[-1][0], ts)
+            else:
+                runs.append((ts, ts))
+        self.last_kind = kind
+
+    @property
+    def missing(self):
+        return self.runs[MISSING]
+
+    @property
+    def extra(self):
+        return self.runs[EXTRA]
+
+    @property
+    def mismatched(self):
+        return self.runs[MISMATCHED]
+
+    def ok(self):
+        return not any(self.runs.values())
+
+    def __str__(self):
+        parts = ["%d matched" % self.counts[MATCHED]]
+        for kind in (MISSING, EXTRA, MISMATCHED):
+            if self.counts[kind]:
+                parts.append("%d %s in %d runs" % (self.counts[kind], kind,
+                                                   len(self.runs[kind])))
+        return "%s: %s" % (self.date, ", ".join(parts))
+
+
+def diff_day(date, mine, theirs):
+    """Compare one day's statuses
+
+    Args:
+       date (date): The day
+       mine (list): Our (timestamp, total yield) samples for the day
+       theirs (list): pvoutput.org's (timestamp, energy) statuses, energy
+          counted from the day's first status, or None if it has none
+    Returns:
+       DayDiff.
+    """
+    diff = DayDiff(date)
+    # pvoutput.org gets the day as we upload it, and counts energy from
+    # its first status
+    mine = trim_flat(list(mine))
+    base = mine[0][1] if mine else 0
+    mine = ((ts, y - base) for ts, y in mine)
+    for ts, ours, their in merge_join(mine, theirs or ()):
+        if their is None:
+            diff.add(MISSING, ts)
+        elif ours is None:
+            diff.add(EXTRA, ts)
+        elif ours != their:
+            diff.add(MISMATCHED, ts)
+        else:
+            diff.add(MATCHED, ts)
+    return diff
+
+
+def fetch_days(api, dates, tz, workers=4, ahead=16):
+    """Fetch pvoutput.org's statuses for many days
+
+    getstatus only covers a day at a time, so up to `workers` days are
+    fetched concurrently, staying at most `ahead` days in front of the
+    consumer.  The shared rate limiter keeps them within the quota.
+
+    Yields:
+       tuple.  (date, [(timestamp, energy), ...]) in the order of dates
+    """
+    def fetch(date):
+        statuses = api.getstatus(date) or []
+        return [(datetimeutil.totimestamp(dt.replace(tzinfo=tz)), y)
+                for dt, y in statuses]
+
+    dates = iter(dates)
+    with concurrent.futures.ThreadPoolExecutor(workers) as ex:
+        pending = collections.deque((d, ex.submit(fetch, d))
+                                    for d in itertools.islice(dates, ahead))
+        while pending:
+            date, future = pending.popleft()
+            statuses = future.result()
+            for d in itertools.islice(dates, 1):
+                pending.append((d, ex.submit(fetch, d)))
+            yield date, statuses
+
+
+def _day_samples(db, sc, date):
+    ts_start, ts_end = datetimeutil.day_timestamps(date, sc.timezone())
+    ids = [inv.serial for inv in sc.inverters()]
+    return db.get_aggregate_samples(ts_start, ts_end, ids)
+
+
+def reconcile(db, sc, api, dates, workers=4, ahead=16):
+    """Compare a system's statuses with pvoutput.org's, day by day
+
+    The database is only read from the calling thread.
+
+    Args:
+       db (BaseDatabase): Where our samples are
+       sc (SMAData2SystemConfig): The system
+       api (pvoutputorg.API): The system on pvoutput.org
+       dates (iterable): Days to compare, as date objects
+       workers (int): Most days to fetch concurrently
+       ahead (int): Most days to fetch before they're compared
+    Yields:
+       DayDiff.  One per date, in order
+    """
+    for date, theirs in fetch_days(api, dates, sc.timezone(), workers,
+                                   ahead):
+        yield diff_day(date, _day_samples(db, sc, date), theirs)
+
+
+def repair(db, sc, api, diff):
+    """Upload our statuses where pvoutput.org's are missing or wrong
+
+    Statuses pvoutput.org has and we don't are left alone.
+
+    Returns:
+       int.  The number of statuses sent
+    """
+    tz = sc.timezone()
+    runs = sorted(diff.missing + diff.mismatched)
+    data = []
+    i = 0
+    for ts, y in trim_flat(_day_samples(db, sc, diff.date)):
+        while i < len(runs) and runs[i][1] < ts:
+            i += 1
+        if i == len(runs):
+            break
+        if runs[i][0] <= ts:
+            data.append((datetime.datetime.fromtimestamp(ts, tz), y))
+    if data:
+        api.addstatus_bulk(data)
+    return len(data)
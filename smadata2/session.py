@@ -0,0 +1,190 @@
+#! /usr/bin/python3
+#
+# smadata2.session - Long lived, logged on inverter connections
+# Copyright (C) 2014 David Gibson <david@gibson.dropbear.id.au>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import threading
+import time
+
+from .inverter.base import Error
+
+all = ['Session', 'SessionManager']
+
+# What a dead or confused connection looks like
+FAILURES = (OSError, Error)
+
+
+class Session(object):
+    """A logged on connection to one inverter, kept open between uses
+
+    Inverters drop a logon after `timeout` seconds, so a session logs
+    on again once it is within `margin` seconds of that.  A connection
+    which has sat idle for `probe` seconds is checked with a cheap
+    signal strength query before being handed out, and replaced if
+    that fails.  Operations are called through the session, e.g.
+    session.historic(from, to); one which fails on an established
+    connection is retried once on a new one.
+    """
+
+    def __init__(self, ic, timeout=900, margin=60, probe=120,
+                 clock=time.monotonic):
+        self.ic = ic
+        self.timeout = timeout
+        self.margin = margin
+        self.probe = probe
+        self.clock = clock
+        self.lock = threading.RLock()
+
+        self.conn = None
+        self.logon_time = None
+        self.last_used = None
+
+        self.connects = 0
+        self.logons = 0
+        self.probes = 0
+        self.retries = 0
+
+    def __getattr__(self, name):
+        if name.startswith("_") or name in ("ic", "conn", "lock"):
+            raise AttributeError(name)
+
+        def call(*args, **kwargs):
+            return self.call(name, *args, **kwargs)
+        return call
+
+    def expires(self):
+        """When the current logon lapses, or None if not connected"""
+        if self.logon_time is None:
+            return None
+        return self.logon_time + self.timeout
+
+    def _connect(self):
+        self.close()
+        self.conn = self.ic.connect_and_logon(timeout=self.timeout)
+        self.connects += 1
+        self.logon_time = self.last_used = self.clock()
+
+    def connection(self):
+        """The underlying connection, logged on and believed to work
+
+        Raises:
+           Whatever connecting to the inverter raises.
+        """
+        with self.lock:
+            now = self.clock()
+            if self.conn is None:
+                self._connect()
+            elif now >= self.expires() - self.margin:
+                try:
+                    self.conn.logon(timeout=self.timeout)
+                    self.logons += 1
+                    self.logon_time = self.last_used = now
+                except FAILURES:
+                    self._connect()
+            elif now - self.last_used >= self.probe:
+                try:
+                    self.conn.getsignal()
+                    self.probes += 1
+                    self.last_used = now
+                except FAILURES:
+                    self._connect()
+            return self.conn
+
+    def call(self, name, *args, **kwargs):
+        """Call a connection method, retrying once on a new connection"""
+        with self.lock:
+            before = self.connects
+            conn = self.connection()
+            try:
+                result = getattr(conn, name)(*args, **kwargs)
+            except FAILURES:
+                # A connection we only just made isn't worth replacing
+                if self.connects != before:
+                    self.close()
+                    raise
+                self.retries += 1
+                self._connect()
+                try:
+                    result = getattr(self.conn, name)(*args, **kwargs)
+                except FAILURES:
+                    self.close()
+                    raise
+            self.last_used = self.clock()
+            return result
+
+    def close(self):
+        with self.lock:
+            if self.conn is not None:
+                close = getattr(self.conn, "close", None)
+                if close is not None:
+                    try:
+                        close()
+                    except FAILURES:
+                        pass
+            self.conn = None
+            self.logon_time = None
+
+
+class SessionManager(object):
+    """Sessions for a set of inverters, one per serial number
+
+    A SessionManager's connect() can be handed to download_all() in
+    place of connecting and logging on from scratch every time.
+    """
+
+    def __init__(self, timeout=900, margin=60, probe=120,
+                 clock=time.monotonic):
+        self.timeout = timeout
+        self.margin = margin
+        self.probe = probe
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.sessions = {}
+
+    def __contains__(self, ic):
+        with self.lock:
+            session = self.sessions.get(str(ic.serial))
+        return session is not None and session.conn is not None
+
+    def get(self, ic):
+        """The session for an inverter, which may not be connected yet"""
+        with self.lock:
+            serial = str(ic.serial)
+            if serial not in self.sessions:
+                self.sessions[serial] = Session(ic, self.timeout,
+                                                self.margin, self.probe,
+                                                self.clock)
+            return self.sessions[serial]
+
+    def connect(self, ic):
+        """A connected, logged on session for an inverter"""
+        session = self.get(ic)
+        session.connection()
+        return session
+
+    def drop(self, ic):
+        """Close an inverter's connection, the next use makes a new one"""
+        with self.lock:
+            session = self.sessions.get(str(ic.serial))
+        if session is not None:
+            session.close()
+
+    def close(self):
+        with self.lock:
+            sessions = list(self.sessions.values())
+        for session in sessions:
+            session.close()
@@ -20,10 +20,16 @@
 import sys
 import argparse
 import os.path
+import signal
 import datetime
+import time
 import dateutil.parser
 
+import smadata2.backfill
 import smadata2.config
+import smadata2.daemon
+import smadata2.db
+import smadata2.db.retention
 import smadata2.db.sqlite
 import smadata2.datetimeutil
 import smadata2.download
@@ -80,28 +86,94 @@ def yieldat(config, args):
 def download(config, args):
     db = config.database()
 
+    def report(dl):
+        inv = dl.ic
+        print("%s (SN: %s)" % (inv.name, inv.serial))
+        if dl.error is not None:
+            print("ERROR downloading inverter: %s" % dl.error,
+                  file=sys.stderr)
+            return
+
+        data, daily = dl.data, dl.data_daily
+        if len(data):
+            print("Downloaded %d observations from %s to %s"
+                  % (len(data),
+                     smadata2.datetimeutil.format_time(data[0][0]),
+                     smadata2.datetimeutil.format_time(data[-1][0])))
+        else:
+            print("No new fast sampled data")
+        if len(daily):
+            print("Downloaded %d daily observations from %s to %s"
+                  % (len(daily),
+                     smadata2.datetimeutil.format_time(daily[0][0]),
+                     smadata2.datetimeutil.format_time(daily[-1][0])))
+        else:
+            print("No new daily data")
+        if args.backfill:
+            print("Backfilled %d observations" % len(dl.backfilled))
+        print("Connect %.1fs, fetch %.1fs, store %.1fs"
+              % (dl.connect_time, dl.fetch_time, dl.store_time))
+
+    if args.backfill:
+        horizon = smadata2.backfill.HORIZON
+    else:
+        horizon = None
+    inverters = [inv for system in config.systems()
+                 for inv in system.inverters()]
+    results = smadata2.download.download_all(inverters, db, report,
+                                             horizon=horizon,
+                                             tiers=config.retention)
+
+    adapters = smadata2.download.adapter_times(results)
+    if len(adapters) > 1:
+        for adapter, t in adapters.items():
+            print("Adapter %s: %.1fs" % (adapter or "default", t))
+
+
+def backfill(config, args):
+    db = config.database()
+
     for system in config.systems():
         for inv in system.inverters():
             print("%s (SN: %s)" % (inv.name, inv.serial))
-
             try:
-                data, daily = smadata2.download.download_inverter(inv, db)
-                if len(data):
-                    print("Downloaded %d observations from %s to %s"
-                          % (len(data),
-                             smadata2.datetimeutil.format_time(data[0][0]),
-                             smadata2.datetimeutil.format_time(data[-1][0])))
-                else:
-                    print("No new fast sampled data")
-                if len(daily):
-                    print("Downloaded %d daily observations from %s to %s"
-                          % (len(daily),
-                             smadata2.datetimeutil.format_time(daily[0][0]),
-                             smadata2.datetimeutil.format_time(daily[-1][0])))
-                else:
-                    print("No new daily data")
+                sma = inv.connect_and_logon()
+                data, daily, windows = smadata2.backfill.backfill_inverter(
+                    inv, db, sma, tiers=config.retention)
             except Exception as e:
-                print("ERROR downloading inverter: %s" % e, file=sys.stderr)
+                print("ERROR backfilling inverter: %s" % e, file=sys.stderr)
+                continue
+            print("\tFilled %d observations and %d daily observations"
+                  " from %d requests" % (len(data), len(daily), windows))
+
+
+def daemon(config, args):
+    db = config.database()
+
+    def report(dl):
+        inv = dl.ic
+        now = smadata2.datetimeutil.format_time(time.time())
+        if dl.error is not None:
+            print("%s: %s (SN: %s): ERROR %s"
+                  % (now, inv.name, inv.serial, dl.error), file=sys.stderr)
+        else:
+            print("%s: %s (SN: %s): %d new samples, %d backfilled in %.1fs"
+                  % (now, inv.name, inv.serial, len(dl.data),
+                     len(dl.backfilled), dl.total_time()))
+        sys.stdout.flush()
+
+    collector = smadata2.daemon.Collector(config.systems(), db,
+                                          interval=args.interval,
+                                          max_interval=args.max_interval,
+                                          report=report, fill=args.backfill,
+                                          tiers=config.retention)
+
+    def stop(signum, frame):
+        collector.stop()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    collector.run()
 
 
 def settime(config, args):
@@ -129,9 +201,24 @@ def upload(config, args):
 
     print("Uploading data for %s" % d)
 
-    for system in config.systems():
-        print("%s" % system.name)
-        smadata2.upload.upload_date(system, d, db)
+    def prepare(system):
+        return smadata2.upload.load_data_for_date(db, system, d)
+
+    def send(system, data):
+        api = config.pvoutput_connect(system)
+        api.addstatus_bulk(data)
+        return len(data)
+
+    def report(up):
+        name = ", ".join(system.name for system in up.systems)
+        if up.error is not None:
+            print("%s: ERROR %s" % (name, up.error), file=sys.stderr)
+        else:
+            print("%s: %d statuses in %.1fs"
+                  % (name, sum(up.results), up.send_time))
+
+    smadata2.upload.upload_all(config.systems(), prepare, send,
+                               report=report, workers=args.workers)
 
 
 def setupdb(config, args):
@@ -140,12 +227,66 @@ def setupdb(config, args):
         print("Creating database '%s'..." % dbname)
     else:
         print("Updating database schema for '%s'..." % dbname)
+
+    def progress(step, done, total):
+        print("\t%s: %d/%d" % (step, done, total))
+
     try:
-        smadata2.db.sqlite.create_or_update(config.dbname)
+        smadata2.db.sqlite.create_or_update(config.dbname,
+                                            backup_db=args.backup,
+                                            vacuum_db=args.vacuum,
+                                            progress=progress)
     except smadata2.db.WrongSchema as e:
         print(e)
 
 
+def archive(config, args):
+    if config.archivedir is None:
+        print("No archive directory configured", file=sys.stderr)
+        sys.exit(1)
+
+    db = config.database()
+    # Archiving goes behind the query cache's back, so skip it
+    if isinstance(db, smadata2.db.CachedDatabase):
+        db = db.db
+
+    cutoff = int(time.time()) - args.age * 24 * 60 * 60
+    print("Archiving months closed before %s"
+          % smadata2.datetimeutil.format_time(cutoff))
+    moved = db.archive_before(cutoff)
+    print("Moved %d samples to the archive" % moved)
+
+
+def snapshot(config, args):
+    last = {}
+
+    def progress(step, done, total):
+        percent = 100 * done // total if total else 100
+        if last.get(step) != percent:
+            print("\t%s: %d%%" % (step, percent))
+            last[step] = percent
+
+    print("Snapshotting '%s' to '%s'..." % (config.dbname, args.dest))
+    smadata2.db.sqlite.snapshot(config.dbname, args.dest,
+                                pause=args.pause, full=args.full,
+                                progress=progress,
+                                partition=config.dbpartition)
+
+
+def compact(config, args):
+    if not config.retention:
+        print("No retention policy configured", file=sys.stderr)
+        sys.exit(1)
+
+    def progress(step, done, total):
+        print("\t%s: %d%%" % (step, 100 * done // total))
+
+    db = config.database()
+    removed = smadata2.db.retention.compact(db, config.retention,
+                                            progress=progress)
+    print("Removed %d samples" % removed)
+
+
 def argparser():
     parser = argparse.ArgumentParser(description="Work with Bluetooth"
                                      " enabled SMA photovoltaic inverters")
@@ -165,10 +306,51 @@ def argparser():
     help = "Download power history and record in database"
     parse_download = subparsers.add_parser("download", help=help)
     parse_download.set_defaults(func=download)
+    parse_download.add_argument("--backfill", action="store_true",
+                                help="Also fetch missing older history")
+
+    help = "Download missing power history which the inverters still have"
+    parse_backfill = subparsers.add_parser("backfill", help=help)
+    parse_backfill.set_defaults(func=backfill)
+
+    help = "Keep downloading power history while the sun is up"
+    parse_daemon = subparsers.add_parser("daemon", help=help)
+    parse_daemon.set_defaults(func=daemon)
+    parse_daemon.add_argument("--interval", type=int, default=300,
+                              help="Seconds between polls while producing")
+    parse_daemon.add_argument("--max-interval", type=int, default=1800,
+                              dest="max_interval",
+                              help="Longest wait between polls")
+    parse_daemon.add_argument("--backfill", action="store_true",
+                              help="Fetch missing older history when idle")
 
     help = "Create database or update schema"
     parse_setupdb = subparsers.add_parser("setupdb", help=help)
     parse_setupdb.set_defaults(func=setupdb)
+    parse_setupdb.add_argument("--no-backup", dest="backup",
+                               action="store_false",
+                               help="Don't back up the database first")
+    parse_setupdb.add_argument("--vacuum", action="store_true",
+                               help="Reclaim free space after updating")
+
+    help = "Move old samples from the database to the columnar archive"
+    parse_archive = subparsers.add_parser("archive", help=help)
+    parse_archive.set_defaults(func=archive)
+    parse_archive.add_argument("--age", type=int, default=365,
+                               help="Archive months older than AGE days")
+
+    help = "Make or refresh a consistent copy of the database"
+    parse_snapshot = subparsers.add_parser("snapshot", help=help)
+    parse_snapshot.set_defaults(func=snapshot)
+    parse_snapshot.add_argument(type=str, dest="dest")
+    parse_snapshot.add_argument("--full", action="store_true",
+                                help="Copy everything, even if DEST exists")
+    parse_snapshot.add_argument("--pause", type=float, default=0.05,
+                                help="Seconds to wait between batches")
+
+    help = "Downsample old samples according to the retention policy"
+    parse_compact = subparsers.add_parser("compact", help=help)
+    parse_compact.set_defaults(func=compact)
 
     help = "Update inverters' clocks"
     parse_settime = subparsers.add_parser("settime", help=help)
@@ -178,6 +360,8 @@ def argparser():
     parse_upload_date = subparsers.add_parser("upload", help=help)
     parse_upload_date.set_defaults(func=upload)
     parse_upload_date.add_argument("--date", type=str, dest="upload_date")
+    parse_upload_date.add_argument("--workers", type=int, default=8,
+                                   help="Most systems to upload to at once")
 
     return parser
 
@@ -0,0 +1,92 @@
+#! /usr/bin/python3
+#
+# smadata2.sun - Sunrise and sunset times
+# Copyright (C) 2014 David Gibson <david@gibson.dropbear.id.au>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import calendar
+import math
+
+# Julian day number of 0001-01-01 00:00 UTC, less one
+_JD_ORDINAL = 1721424.5
+_J2000 = 2451545.0
+
+# Sun's altitude at rise/set, allowing for refraction and its radius
+_ZENITH = 90.833
+
+
+def _sin(deg):
+    return math.sin(math.radians(deg))
+
+
+def _cos(deg):
+    return math.cos(math.radians(deg))
+
+
+def sun_times(d, latitude, longitude):
+    """Sunrise and sunset on a day, using NOAA's solar calculator algorithm
+
+    Accurate to within a minute or two away from the poles.
+
+    Args:
+       d (datetime.date): The (local) date
+       latitude (float): Degrees north
+       longitude (float): Degrees east
+    Returns:
+       tuple.  (sunrise, sunset) as unix timestamps.  If the sun doesn't
+       set that day this is the whole UTC day, if it doesn't rise, None.
+    """
+    # Julian centuries since J2000, at noon
+    jc = (d.toordinal() + _JD_ORDINAL + 0.5 - _J2000) / 36525.0
+
+    mean_long = (280.46646 + jc * (36000.76983 + jc * 0.0003032)) % 360
+    mean_anom = 357.52911 + jc * (35999.05029 - 0.0001537 * jc)
+    ecc = 0.016708634 - jc * (0.000042037 + 0.0000001267 * jc)
+    centre = (_sin(mean_anom) * (1.914602 - jc * (0.004817 + 0.000014 * jc))
+              + _sin(2 * mean_anom) * (0.019993 - 0.000101 * jc)
+              + _sin(3 * mean_anom) * 0.000289)
+    omega = 125.04 - 1934.136 * jc
+    app_long = mean_long + centre - 0.00569 - 0.00478 * _sin(omega)
+    obliquity = (23 + (26 + (21.448 - jc * (46.815 + jc * (0.00059
+                                                           - jc * 0.001813)))
+                       / 60) / 60
+                 + 0.00256 * _cos(omega))
+    decl = math.degrees(math.asin(_sin(obliquity) * _sin(app_long)))
+
+    y = math.tan(math.radians(obliquity / 2)) ** 2
+    # Equation of time, in minutes
+    eqtime = 4 * math.degrees(y * _sin(2 * mean_long)
+                              - 2 * ecc * _sin(mean_anom)
+                              + 4 * ecc * y * _sin(mean_anom)
+                              * _cos(2 * mean_long)
+                              - 0.5 * y * y * _sin(4 * mean_long)
+                              - 1.25 * ecc * ecc * _sin(2 * mean_anom))
+
+    midnight = calendar.timegm(d.timetuple())
+
+    cos_ha = (_cos(_ZENITH) / (_cos(latitude) * _cos(decl))
+              - (math.tan(math.radians(latitude))
+                 * math.tan(math.radians(decl))))
+    if cos_ha > 1:
+        return None
+    if cos_ha < -1:
+        return (midnight, midnight + 24 * 60 * 60)
+    ha = math.degrees(math.acos(cos_ha))
+
+    # Minutes after UTC midnight
+    noon = 720 - 4 * longitude - eqtime
+    return (midnight + int(round((noon - 4 * ha) * 60)),
+            midnight + int(round((noon + 4 * ha) * 60)))
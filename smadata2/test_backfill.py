@@ -0,0 +1,152 @@
+#! /usr/bin/python3
+
+import os
+
+from nose.tools import assert_equals
+
+import smadata2.backfill
+import smadata2.db.sqlite
+from smadata2.db import SAMPLE_INV_FAST, SAMPLE_INV_DAILY
+from smadata2.db.memory import MemoryDatabase
+from smadata2.db.retention import Tier
+
+DAY = 24 * 60 * 60
+NOW = 1000 * DAY
+
+
+def test_find_gaps():
+    stamps = [0, 300, 600, 1500, 1800]
+    assert_equals(smadata2.backfill.find_gaps(stamps, 0, 1800, 300),
+                  [(601, 1499)])
+    # Missing at either end
+    assert_equals(smadata2.backfill.find_gaps(stamps, -600, 2400, 300),
+                  [(-600, -1), (601, 1499), (1801, 2400)])
+    assert_equals(smadata2.backfill.find_gaps([], 0, 1800, 300),
+                  [(0, 1800)])
+
+
+def test_find_gaps_dst():
+    # Daylight saving moves local midnight by an hour
+    stamps = [0, DAY, 2*DAY - 3600, 3*DAY - 3600, 5*DAY - 3600]
+    assert_equals(smadata2.backfill.find_gaps(stamps, 0, 5*DAY - 3600, DAY),
+                  [(3*DAY - 3599, 5*DAY - 3601)])
+
+
+def test_merge_gaps():
+    gaps = [(0, 100), (200, 300), (2000, 2100)]
+    assert_equals(smadata2.backfill.merge_gaps(gaps, 500),
+                  [(0, 300), (2000, 2100)])
+    assert_equals(smadata2.backfill.merge_gaps(gaps, 50), gaps)
+
+
+class FakeConnection(object):
+    def __init__(self):
+        self.requests = []
+
+    def historic(self, fromtime, totime):
+        self.requests.append((fromtime, totime))
+        first = -(-fromtime // 300) * 300
+        return [(ts, ts // 300) for ts in range(first, totime + 1, 300)]
+
+    def historic_daily(self, fromtime, totime):
+        self.requests.append((fromtime, totime))
+        first = -(-fromtime // DAY) * DAY
+        return [(ts, ts // DAY) for ts in range(first, totime + 1, DAY)]
+
+
+class FakeInverter(object):
+    serial = "__TEST__"
+    starttime = None
+
+
+class BackfillChecks(object):
+    horizon = {SAMPLE_INV_FAST: 2*DAY, SAMPLE_INV_DAILY: 40*DAY}
+
+    def opendb(self):
+        return MemoryDatabase()
+
+    def setUp(self):
+        self.db = self.opendb()
+        self.ic = FakeInverter()
+        self.sma = FakeConnection()
+
+        # Two days of fast samples with holes in, and some daily ones
+        start = NOW - 2*DAY
+        self.expected = [(ts, ts // 300) for ts in range(start, NOW, 300)]
+        present = [s for i, s in enumerate(self.expected)
+                   if not (10 <= i < 20 or 30 <= i < 33 or i == 400)]
+        self.db.add_samples(self.ic.serial, SAMPLE_INV_FAST, present)
+        daily = [(ts, ts // DAY) for ts in range(NOW - 40*DAY, NOW, DAY)
+                 if ts != NOW - 20*DAY]
+        self.db.add_samples(self.ic.serial, SAMPLE_INV_DAILY, daily)
+        self.db.commit()
+
+    def test_plan(self):
+        windows = smadata2.backfill.plan(self.ic, self.db, SAMPLE_INV_FAST,
+                                         now=NOW, horizon=2*DAY)
+        start = NOW - 2*DAY
+        # The first two holes are close enough to merge
+        assert_equals(windows,
+                      [(start + 10*300 - 299, start + 33*300 - 1),
+                       (start + 400*300 - 299, start + 400*300 + 299)])
+
+    def test_plan_daily(self):
+        windows = smadata2.backfill.plan(self.ic, self.db, SAMPLE_INV_DAILY,
+                                         now=NOW, horizon=40*DAY)
+        assert_equals(windows, [(NOW - 21*DAY + 1, NOW - 19*DAY - 1)])
+
+    def test_horizon(self):
+        windows = smadata2.backfill.plan(self.ic, self.db, SAMPLE_INV_FAST,
+                                         now=NOW, horizon=DAY)
+        assert_equals(len(windows), 1)
+        # Thinned on purpose by the retention policy
+        windows = smadata2.backfill.plan(self.ic, self.db, SAMPLE_INV_FAST,
+                                         now=NOW, horizon=2*DAY,
+                                         tiers=[Tier(DAY, 3600)])
+        assert_equals(len(windows), 1)
+        windows = smadata2.backfill.plan(self.ic, self.db, SAMPLE_INV_FAST,
+                                         now=NOW, horizon=2*DAY,
+                                         tiers=[Tier(DAY // 2, 3600)])
+        assert_equals(windows, [])
+
+    def test_nothing_downloaded(self):
+        self.ic.serial = "__OTHER__"
+        assert_equals(smadata2.backfill.plan(self.ic, self.db,
+                                             SAMPLE_INV_FAST, now=NOW), [])
+
+    def test_backfill(self):
+        data, daily, n = smadata2.backfill.backfill_inverter(
+            self.ic, self.db, self.sma, now=NOW, horizon=self.horizon)
+        assert_equals(len(data), 14)
+        assert_equals(daily, [(NOW - 20*DAY, (NOW - 20*DAY) // DAY)])
+        assert_equals(n, 3)
+        assert_equals(len(self.sma.requests), 3)
+
+        samples = [(ts, y) for ts, st, y
+                   in self.db.get_samples(self.ic.serial, NOW - 2*DAY, NOW,
+                                          dense=True)
+                   if st == SAMPLE_INV_FAST]
+        assert_equals(samples, self.expected)
+
+        # Nothing left to do
+        data, daily, n = smadata2.backfill.backfill_inverter(
+            self.ic, self.db, self.sma, now=NOW, horizon=self.horizon)
+        assert_equals((data, daily, n), ([], [], 0))
+
+
+class TestBackfillMemory(BackfillChecks):
+    pass
+
+
+class TestBackfillCompressed(BackfillChecks):
+    # Flat stretches are stored as runs, which still count as samples
+    def opendb(self):
+        self.dbname = "__testdb__smadata2_%s_.sqlite" % self.__class__.__name__
+        if os.path.exists(self.dbname):
+            os.remove(self.dbname)
+        return smadata2.db.sqlite.create_or_update(self.dbname,
+                                                   compress=True)
+
+    def tearDown(self):
+        self.db.close()
+        os.remove(self.dbname)
@@ -0,0 +1,29 @@
+#! /usr/bin/python3
+
+import io
+
+from nose.tools import assert_equals
+
+import smadata2.bench
+
+
+def test_backlog():
+    samples = smadata2.bench.backlog(2, now=1000000)
+    assert_equals(len(samples), 2 * 288)
+    assert_equals(samples[-1][0] - samples[0][0], 2*24*3600 - 300)
+    # Twelve hours of production a day
+    assert_equals(samples[-1][1] - samples[0][1], 2 * 143)
+
+
+def test_run():
+    out = io.StringIO()
+    results = smadata2.bench.run(backlogs=[1], memory=True, out=out)
+    assert_equals([r.name for r in results], ["api", "getstatus", "uploader"])
+    for r in results:
+        # A day trims to 145 statuses, which is two batches to upload,
+        # and spans two dates to read back
+        assert_equals(r.requests, 2)
+        assert r.statuses >= 144
+        assert r.seconds >= r.server_seconds > 0
+    assert results[-1].peak > 0
+    assert_equals(len(out.getvalue().splitlines()), 3)
@@ -40,6 +40,22 @@ class TestConfigWithPVOutput(BaseTestConfig):
     def test_apikey(self):
         assert_equals(self.c.pvoutput_apikey, None)
 
+    def test_cache(self):
+        assert_equals(self.c.pvoutput_cache,
+                      os.path.expanduser("~/.smadata2-pvoutput.sqlite"))
+
+
+class TestConfigNoPVOutputCache(BaseTestConfig):
+    json = """
+    {
+        "pvoutput.org": {
+            "cache": null
+        }
+    }"""
+
+    def test_cache(self):
+        assert self.c.pvoutput_cache is None
+
 
 class TestConfigEmptySystem(BaseTestConfig):
     json = """
@@ -164,3 +180,19 @@ class TestConfigUTCSystem(TestConfigEmptySystem):
         dt = datetime.datetime(2007, 11, 5,
                                15, 37, 56, 9999, system.timezone())
         assert_equals(dt.tzname(), "UTC")
+
+
+class TestConfigRetention(BaseTestConfig):
+    json = """
+    {
+        "database": {
+            "retention": [
+                {"days": 365, "interval": 86400},
+                {"days": 30, "interval": 3600}
+            ]
+        }
+    }"""
+
+    def test_retention(self):
+        assert_equals([(t.age, t.interval) for t in self.c.retention],
+                      [(30*86400, 3600), (365*86400, 86400)])
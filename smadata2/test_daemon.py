@@ -0,0 +1,132 @@
+#! /usr/bin/python3
+
+import calendar
+
+import dateutil.tz
+from nose.tools import assert_equals
+
+import smadata2.daemon
+from smadata2.db.memory import MemoryDatabase
+
+
+class FakeConnection(object):
+    def __init__(self, ic):
+        self.ic = ic
+
+    def logon(self, timeout=900):
+        pass
+
+    def getsignal(self):
+        return 0.5
+
+    def historic(self, fromtime, totime):
+        return [(ts, y) for ts, y in self.ic.samples if ts >= fromtime]
+
+    def historic_daily(self, fromtime, totime):
+        return []
+
+
+class FakeInverter(object):
+    def __init__(self, serial):
+        self.serial = serial
+        self.starttime = 0
+        self.connects = 0
+        self.fail = False
+        self.samples = []
+
+    def connect_and_logon(self, timeout=900):
+        self.connects += 1
+        return FakeConnection(self)
+
+
+class FakeSystem(object):
+    def __init__(self, invs, location=(51.5074, -0.1278)):
+        self.invs = invs
+        self.loc = location
+
+    def inverters(self):
+        return self.invs
+
+    def location(self):
+        return self.loc
+
+    def timezone(self):
+        return dateutil.tz.tzutc()
+
+
+class TestCollector(object):
+    # Midnight UTC on midsummer's day; London sunrise is at 03:43
+    MIDNIGHT = calendar.timegm((2024, 6, 21, 0, 0, 0))
+    DAWN = calendar.timegm((2024, 6, 21, 3, 13, 0))
+
+    def setUp(self):
+        self.now = self.MIDNIGHT
+        self.inv = FakeInverter("__TEST__")
+        self.collector = smadata2.daemon.Collector(
+            [FakeSystem([self.inv])], MemoryDatabase(),
+            clock=lambda: self.now)
+        self.state = self.collector.states["__TEST__"]
+
+    def produce(self, y):
+        ts = self.now - self.now % 300
+        self.inv.samples = [(ts, y)]
+
+    def test_night(self):
+        self.collector.start()
+        # Sunrise less the margin, to within the algorithm's accuracy
+        assert abs(self.state.next_poll - self.DAWN) < 120
+
+    def test_adaptive(self):
+        self.now = self.MIDNIGHT + 12*3600
+        self.collector.start()
+        assert_equals(self.state.next_poll, self.now)
+
+        self.produce(10)
+        assert_equals(self.collector.poll(), self.now + 300)
+        # Nothing new, so back off
+        self.now += 300
+        assert_equals(self.collector.poll(), self.now + 600)
+        self.now += 600
+        assert_equals(self.collector.poll(), self.now + 1200)
+        self.now += 1200
+        assert_equals(self.collector.poll(), self.now + 1800)
+        self.now += 1800
+        assert_equals(self.collector.poll(), self.now + 1800)
+        # Production picks up again
+        self.now += 1800
+        self.produce(20)
+        assert_equals(self.collector.poll(), self.now + 300)
+        # The session was kept throughout, logging on again as needed
+        assert_equals(self.inv.connects, 1)
+        assert self.collector.sessions.get(self.inv).logons > 0
+
+    def test_after_sunset(self):
+        # Sunset is at 20:21, so this is the last poll within the margin
+        self.now = calendar.timegm((2024, 6, 21, 20, 50, 0))
+        self.collector.start()
+        self.produce(10)
+        self.collector.poll()
+        # Next poll is tomorrow morning
+        assert self.state.next_poll > self.DAWN + 23*3600
+
+    def test_backoff(self):
+        self.now = self.MIDNIGHT + 12*3600
+        self.collector.start()
+
+        def broken(timeout=900):
+            self.inv.connects += 1
+            raise IOError("Inverter unreachable")
+        self.inv.connect_and_logon = broken
+
+        for delay in (300, 600, 1200, 2400, 3600, 3600):
+            assert_equals(self.collector.poll(), self.now + delay)
+            self.now += delay
+        assert_equals(self.inv.connects, 6)
+        assert self.inv not in self.collector.sessions
+
+    def test_no_location(self):
+        system = FakeSystem([self.inv], location=None)
+        collector = smadata2.daemon.Collector([system], MemoryDatabase(),
+                                              clock=lambda: self.now)
+        collector.start()
+        assert_equals(collector.states["__TEST__"].next_poll, self.now)
@@ -0,0 +1,240 @@
+#! /usr/bin/python3
+
+import threading
+import time
+
+from nose.tools import assert_equals
+
+import smadata2.download
+from smadata2.db import SAMPLE_INV_FAST, SAMPLE_INV_DAILY, WATERMARK_INGEST
+from smadata2.db.memory import MemoryDatabase
+
+
+class FakeConnection(object):
+    def __init__(self, ic):
+        self.ic = ic
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+        self.ic.closed += 1
+
+    def historic(self, fromtime, totime):
+        assert not self.closed
+        self.ic.threads.add(threading.current_thread().name)
+        time.sleep(0.05)
+        first = -(-fromtime // 300) * 300
+        return [(ts, ts // 300) for ts in range(first, first + 3000, 300)]
+
+    def historic_daily(self, fromtime, totime):
+        return [(fromtime, 1)]
+
+
+class FakeInverter(object):
+    def __init__(self, serial, adapter, fail=False):
+        self.serial = serial
+        self.adapter = adapter
+        self.starttime = -1
+        self.fail = fail
+        self.threads = set()
+        self.closed = 0
+
+    def connect_and_logon(self):
+        if self.fail:
+            raise IOError("No route to inverter")
+        return FakeConnection(self)
+
+
+class WriterCheckingDatabase(MemoryDatabase):
+    def __init__(self):
+        super(WriterCheckingDatabase, self).__init__()
+        self.writers = set()
+
+    def add_sample(self, serial, timestamp, sample_type, total_yield):
+        self.writers.add(threading.current_thread())
+        super(WriterCheckingDatabase, self).add_sample(
+            serial, timestamp, sample_type, total_yield)
+
+
+class TestDownloadAll(object):
+    def setUp(self):
+        self.db = WriterCheckingDatabase()
+        self.invs = [FakeInverter("__TEST__%d" % i, "adapter%d" % (i % 2))
+                     for i in range(4)]
+
+    def test_download(self):
+        reported = []
+        results = smadata2.download.download_all(self.invs, self.db,
+                                                 reported.append)
+        assert_equals(len(results), 4)
+        assert_equals(reported, results)
+        for dl in results:
+            assert dl.error is None
+            assert_equals(len(dl.data), 10)
+            assert dl.fetch_time > 0
+
+        # One worker per adapter, and all writes from this thread
+        assert_equals(self.invs[0].threads, self.invs[2].threads)
+        assert self.invs[0].threads != self.invs[1].threads
+        assert_equals(self.db.writers, set([threading.current_thread()]))
+
+        for inv in self.invs:
+            assert_equals(self.db.get_watermark(WATERMARK_INGEST, inv.serial,
+                                                SAMPLE_INV_FAST), 2700)
+            assert_equals(self.db.get_watermark(WATERMARK_INGEST, inv.serial,
+                                                SAMPLE_INV_DAILY), 0)
+
+        times = smadata2.download.adapter_times(results)
+        assert_equals(sorted(times.keys()), ["adapter0", "adapter1"])
+
+    def test_resume(self):
+        smadata2.download.download_all(self.invs, self.db)
+        results = smadata2.download.download_all(self.invs, self.db)
+        assert_equals([dl.data[0][0] for dl in results], [3000] * 4)
+
+    def test_failure(self):
+        self.invs[1].fail = True
+        results = smadata2.download.download_all(self.invs, self.db)
+        failed = [dl for dl in results if dl.error is not None]
+        assert_equals([dl.ic for dl in failed], [self.invs[1]])
+        assert self.db.get_last_sample(self.invs[3].serial) is not None
+        assert self.db.get_last_sample(self.invs[1].serial) is None
+
+    def test_no_start(self):
+        # Never downloaded from, and nowhere configured to start
+        self.invs[2].starttime = None
+        reported = []
+        results = smadata2.download.download_all(self.invs, self.db,
+                                                 reported.append)
+        assert_equals(len(results), 4)
+        assert_equals(sorted(id(dl) for dl in reported),
+                      sorted(id(dl) for dl in results))
+        failed = [dl for dl in results if dl.error is not None]
+        assert_equals([dl.ic for dl in failed], [self.invs[2]])
+        assert isinstance(failed[0].error, ValueError)
+        assert self.db.get_last_sample(self.invs[3].serial) is not None
+
+
+class RecordingConnection(FakeConnection):
+    def __init__(self, ic, log):
+        super(RecordingConnection, self).__init__(ic)
+        self.log = log
+        self.log.append((ic.serial, "connect", None))
+
+    def close(self):
+        super(RecordingConnection, self).close()
+        self.log.append((self.ic.serial, "close", None))
+
+    def historic(self, fromtime, totime):
+        self.log.append((self.ic.serial, "fast", fromtime))
+        return super(RecordingConnection, self).historic(fromtime, totime)
+
+    def historic_daily(self, fromtime, totime):
+        self.log.append((self.ic.serial, "daily", fromtime))
+        return super(RecordingConnection, self).historic_daily(fromtime,
+                                                               totime)
+
+
+class TestDownloadQueue(object):
+    HORIZON = {SAMPLE_INV_FAST: 2 * 10**9, SAMPLE_INV_DAILY: 2 * 10**9}
+
+    def setUp(self):
+        self.db = MemoryDatabase()
+        self.log = []
+        self.invs = [FakeInverter("__TEST__%d" % i, None) for i in range(2)]
+        for inv in self.invs:
+            inv.connect_and_logon = (
+                lambda inv=inv: RecordingConnection(inv, self.log))
+            # A hole at 900 and 1200
+            self.db.add_samples(inv.serial, SAMPLE_INV_FAST,
+                                [(ts, ts // 300) for ts in range(0, 3000, 300)
+                                 if ts not in (900, 1200)])
+
+    def fetches(self):
+        return [entry for entry in self.log
+                if entry[1] not in ("connect", "close")]
+
+    def test_order(self):
+        results = smadata2.download.download_all(self.invs, self.db,
+                                                 horizon=self.HORIZON)
+        # Every inverter's new data before any backfill, one inverter at
+        # a time, with only one connection open at once
+        a, b = [inv.serial for inv in self.invs]
+        assert_equals(self.log, [
+            (a, "connect", None), (a, "fast", 2701), (a, "daily", 0),
+            (a, "close", None),
+            (b, "connect", None), (b, "fast", 2701), (b, "daily", 0),
+            (b, "close", None),
+            (a, "connect", None), (a, "fast", 601), (a, "close", None),
+            (b, "connect", None), (b, "fast", 601), (b, "close", None)])
+        for dl in results:
+            assert_equals(dl.backfilled, [(900, 3), (1200, 4)])
+            assert_equals(dl.deferred, 0)
+            assert_equals(len(dl.data), 10)
+            assert_equals(self.db.get_one_sample(dl.ic.serial, 900), 3)
+            assert dl.error is None
+
+    def test_budget(self):
+        results = smadata2.download.download_all(self.invs, self.db,
+                                                 horizon=self.HORIZON,
+                                                 budget=0)
+        assert_equals(len(self.fetches()), 4)
+        for dl in results:
+            assert dl.error is None
+            assert_equals(dl.backfilled, [])
+            assert_equals(dl.deferred, 1)
+            assert_equals(len(dl.data), 10)
+            assert_equals(self.db.get_one_sample(dl.ic.serial, 900), None)
+
+    def test_no_backfill(self):
+        smadata2.download.download_all(self.invs, self.db)
+        assert_equals(len(self.fetches()), 4)
+
+    def test_failure_skips_rest(self):
+        del self.invs[0].connect_and_logon
+        self.invs[0].fail = True
+        results = smadata2.download.download_all(self.invs, self.db,
+                                                 horizon=self.HORIZON)
+        assert_equals(len(results), 2)
+        failed = [dl for dl in results if dl.error is not None]
+        assert_equals([dl.ic for dl in failed], [self.invs[0]])
+        assert_equals(failed[0].deferred, 0)
+        assert_equals(len(self.fetches()), 3)
+
+    def test_deadline(self):
+        q = smadata2.download.DownloadQueue()
+        dl = smadata2.download.InverterDownload(self.invs[0], 0, 0)
+        for kind, deadline in [(smadata2.download.BACKFILL, 50),
+                               (smadata2.download.LIVE, 100),
+                               (smadata2.download.BACKFILL, 10),
+                               (smadata2.download.DAILY, 100)]:
+            q.push(smadata2.download.WorkItem(dl, kind, SAMPLE_INV_FAST,
+                                              0, 0, deadline))
+        order = []
+        while q:
+            item = q.pop()
+            order.append((item.kind, item.deadline))
+        assert_equals(order, [(smadata2.download.LIVE, 100),
+                              (smadata2.download.DAILY, 100),
+                              (smadata2.download.BACKFILL, 10),
+                              (smadata2.download.BACKFILL, 50)])
+
+    def test_inverters_together(self):
+        q = smadata2.download.DownloadQueue()
+        dls = [smadata2.download.InverterDownload(inv, 0, 0)
+               for inv in self.invs]
+        for kind in (smadata2.download.LIVE, smadata2.download.DAILY,
+                     smadata2.download.BACKFILL):
+            for dl in dls:
+                q.push(smadata2.download.WorkItem(dl, kind, SAMPLE_INV_FAST,
+                                                  0, 0, 0))
+        order = []
+        while q:
+            item = q.pop()
+            order.append((dls.index(item.dl), item.kind))
+        assert_equals(order, [(0, smadata2.download.LIVE),
+                              (0, smadata2.download.DAILY),
+                              (1, smadata2.download.LIVE),
+                              (1, smadata2.download.DAILY),
+                              (0, smadata2.download.BACKFILL),
+                              (1, smadata2.download.BACKFILL)])
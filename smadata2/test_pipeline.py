@@ -0,0 +1,88 @@
+#! /usr/bin/python3
+
+import datetime
+import dateutil.tz
+import random
+
+from nose.tools import assert_equals
+
+from smadata2.pipeline import Pipeline, trim_night, complete, localize, \
+    batched
+
+
+def old_trim(last_yield, statuses):
+    """The list based trim the upload used to do"""
+    statuses = list(statuses)
+    skipping = False
+    last = [None, last_yield]
+    ret = []
+    while statuses:
+        this = statuses.pop(0)
+        if skipping:
+            if statuses:
+                if this[1] != statuses[0][1]:
+                    skipping = False
+                    ret.append(this)
+            else:
+                break
+        else:
+            if last[1] == this[1]:
+                skipping = True
+            else:
+                ret.append(this)
+        last = this
+    return ret
+
+
+def test_trim_night():
+    day = [(0, 10), (300, 10), (600, 10), (900, 10), (1200, 11), (1500, 12),
+           (1800, 12), (2100, 12)]
+    # The start of the night and the baseline before the morning stay
+    assert_equals(list(trim_night(day)),
+                  [(0, 10), (900, 10), (1200, 11), (1500, 12)])
+    assert_equals(list(trim_night(day, 10)),
+                  [(900, 10), (1200, 11), (1500, 12)])
+    assert_equals(list(trim_night([])), [])
+
+
+def test_trim_night_random():
+    rand = random.Random(48)
+    for n in range(200):
+        statuses = []
+        y = 0
+        for i in range(rand.randint(0, 40)):
+            y += rand.choice((0, 0, 1))
+            statuses.append((i*300, y))
+        assert_equals(list(trim_night(iter(statuses))),
+                      old_trim(None, statuses))
+
+
+def test_complete():
+    statuses = [(0, 1, 2), (300, 2, 1), (600, 3, 2), (900, 4, 1),
+                (1200, 5, 1)]
+    # Incomplete statuses wait for a complete one after them
+    assert_equals([s[0] for s in complete(statuses, 2)], [0, 300, 600])
+    assert_equals(len(list(complete(statuses, 1))), 5)
+
+
+def test_localize():
+    tz = dateutil.tz.tzoffset(None, 10*3600)
+    assert_equals(list(localize([(0, 5)], tz)),
+                  [(0, datetime.datetime(1970, 1, 1, 10, 0, tzinfo=tz), 5)])
+
+
+def test_batched():
+    assert_equals(list(batched(range(7), 3)), [[0, 1, 2], [3, 4, 5], [6]])
+    assert_equals(list(batched(range(6), 3)), [[0, 1, 2], [3, 4, 5]])
+    assert_equals(list(batched([], 3)), [])
+
+
+def test_stages_are_lazy():
+    p = Pipeline()
+    source = p.stage("read", ((i*300, i // 3) for i in range(10**9)))
+    requests = p.stage("requests", batched(trim_night(source), 10))
+    assert_equals(len(next(requests)), 10)
+    # Only enough was read for the first request
+    assert p["read"] < 40
+    assert_equals(p["requests"], 1)
+    assert str(p).startswith("read ")
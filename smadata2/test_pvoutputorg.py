@@ -2,6 +2,7 @@
 
 import os
 import datetime
+import random
 import time
 import dateutil
 
@@ -9,7 +10,9 @@ from nose.tools import assert_equals
 from nose.plugins.attrib import attr
 
 import smadata2.config
+import smadata2.pvoutputcache
 import smadata2.pvoutputorg
+import smadata2.pvoutputmock
 import smadata2.datetimeutil
 import smadata2.check
 import smadata2.upload
@@ -75,6 +78,439 @@ class TestMockAPI(object):
         assert_equals(self.api.donation_mode, True)
 
 
+class FakeClock(object):
+    def __init__(self, now):
+        self.now = now
+        self.slept = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, secs):
+        self.slept.append(secs)
+        self.now += secs
+
+
+class TestRateLimiter(object):
+    def setUp(self):
+        self.clock = FakeClock(1000000.0)
+        self.limiter = smadata2.pvoutputorg.RateLimiter(self.clock,
+                                                        self.clock.sleep)
+
+    def test_burst(self):
+        # A whole hour's quota is available straight away
+        for i in range(60):
+            assert_equals(self.limiter.acquire("k"), 0)
+        # Then one request per minute
+        assert_equals(self.limiter.acquire("k"), 60.0)
+        assert_equals(self.limiter.acquire("k"), 60.0)
+        assert_equals(self.limiter.waits, 2)
+        assert_equals(self.limiter.waited, 120.0)
+
+    def test_refill(self):
+        for i in range(60):
+            self.limiter.acquire("k")
+        self.clock.now += 600
+        for i in range(10):
+            assert_equals(self.limiter.acquire("k"), 0)
+        assert self.limiter.acquire("k") > 0
+
+    def test_keys(self):
+        for i in range(60):
+            self.limiter.acquire("a")
+        assert_equals(self.limiter.acquire("b"), 0)
+
+    def test_donation(self):
+        self.limiter.set_limit("k", 300)
+        for i in range(300):
+            assert_equals(self.limiter.acquire("k"), 0)
+        assert_equals(self.limiter.acquire("k"), 12.0)
+
+    def test_headers(self):
+        self.limiter.update("k", {"X-Rate-Limit-Remaining": "2",
+                                  "X-Rate-Limit-Limit": "60",
+                                  "X-Rate-Limit-Reset": "0"})
+        # Our own guess doesn't override the server's count
+        self.limiter.set_limit("k", 300)
+        assert_equals(self.limiter.acquire("k"), 0)
+        assert_equals(self.limiter.acquire("k"), 0)
+        assert_equals(self.limiter.acquire("k"), 60.0)
+
+    def test_reset(self):
+        self.limiter.update("k", {
+            "X-Rate-Limit-Remaining": "0",
+            "X-Rate-Limit-Limit": "60",
+            "X-Rate-Limit-Reset": str(self.clock.now + 1200),
+        })
+        assert_equals(self.limiter.acquire("k"), 1200)
+        assert_equals(self.limiter.acquire("k"), 0)
+
+    def test_early_reset(self):
+        # The quota comes back whole at the reset, however long our own
+        # count says it would take
+        self.limiter.update("k", {
+            "X-Rate-Limit-Remaining": "0",
+            "X-Rate-Limit-Limit": "5",
+            "X-Rate-Limit-Reset": str(self.clock.now + 100),
+        })
+        for i in range(5):
+            assert_equals(self.limiter.acquire("k"), 100 if i == 0 else 0)
+        assert_equals(self.limiter.acquire("k"), 720.0)
+
+
+class TestMockServer(object):
+    def setUp(self):
+        self.clock = FakeClock(time.time())
+        self.limiter = smadata2.pvoutputorg.RateLimiter(self.clock,
+                                                        self.clock.sleep)
+        self.server = smadata2.pvoutputmock.MockServer(
+            clock=self.clock).start()
+        self.server.add_system(1001, name="First")
+        self.server.add_system(1002, name="Second", donation=False)
+        self.pool = smadata2.pvoutputorg.ConnectionPool()
+        self.retrier = smadata2.pvoutputorg.Retrier(
+            clock=self.clock, sleep=self.clock.sleep, rand=random.Random(50))
+        self.api = self.connect(1001)
+        self.date = datetime.date(2014, 7, 31)
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.stop()
+
+    def connect(self, sid):
+        return smadata2.pvoutputorg.API(self.server.url, "MOCKAPIKEY", sid,
+                                        pool=self.pool,
+                                        limiter=self.limiter,
+                                        retrier=self.retrier)
+
+    def batch(self, n):
+        dt0 = datetime.datetime.combine(self.date, datetime.time(10, 0))
+        return [(dt0 + datetime.timedelta(minutes=5*i), 1000 + i)
+                for i in range(n)]
+
+    def test_getsystem(self):
+        assert_equals(self.api.name, "First")
+        assert_equals(self.api.system_size, 1234)
+        assert self.api.donation_mode
+        assert not self.connect(1002).donation_mode
+
+    def test_addbatch(self):
+        batch = self.batch(25)
+        self.api.addbatchstatus(batch)
+        results = self.api.getstatus(self.date)
+        assert_equals(results, [(dt, y - 1000) for dt, y in batch])
+
+    def test_blank(self):
+        assert self.api.getstatus(self.date) is None
+
+    def test_keepalive(self):
+        self.api.addbatchstatus(self.batch(10))
+        for i in range(5):
+            self.api.getstatus(self.date)
+        self.api.deletestatus(self.date)
+        # Every request, and both systems, on a single connection
+        other = self.connect(1002)
+        other.getstatus(self.date)
+        assert_equals(self.server.connections, 1)
+        assert_equals(self.pool.connects, 1)
+
+        stats = self.pool.stats["/service/r2/getstatus.jsp"]
+        assert_equals(stats.requests, 6)
+        # The "no status" answers
+        assert_equals(stats.errors, 1)
+        assert stats.seconds > 0
+        assert stats.received > 0
+
+    def test_reconnect(self):
+        self.api.getstatus(self.date)
+        self.server.disconnect()
+        self.api.addbatchstatus(self.batch(3))
+        assert_equals(len(self.api.getstatus(self.date)), 3)
+        assert_equals(self.server.connections, 2)
+        assert_equals(
+            self.pool.stats["/service/r2/addbatchstatus.jsp"].reconnects, 1)
+
+    def test_quota(self):
+        self.server.systems["1002"].quota = 5
+        api = self.connect(1002)
+        for i in range(4):
+            api.getstatus(self.date)
+        assert_equals(self.clock.slept, [])
+        # The server said the quota is used up, so wait for the next hour
+        api.getstatus(self.date)
+        assert_equals(len(self.clock.slept), 1)
+        assert_equals(self.clock.now % 3600, 0)
+        assert_equals(self.server.requests["/service/r2/getstatus.jsp"], 5)
+
+    def test_outputs(self):
+        days = [self.date + datetime.timedelta(days=i) for i in range(4)]
+        self.api.addoutput(days[1], 1500)
+        self.api.addbatchoutput([(days[2], 2500)])
+        assert_equals(self.api.getmissing(days[0], days[-1]),
+                      [days[0], days[3]])
+        self.api.addoutput(days[0], 500)
+        self.api.addoutput(days[3], 3500)
+        assert_equals(self.api.getmissing(days[0], days[-1]), [])
+        assert_equals(self.server.systems["1001"].outputs["20140801"], 1500)
+
+    def test_latency(self):
+        self.server.latencies["/service/r2/getstatus.jsp"] = 0.05
+        t0 = time.monotonic()
+        self.api.getstatus(self.date)
+        assert time.monotonic() - t0 >= 0.05
+        self.server.latencies.clear()
+        # Small answers aren't held up by Nagle and delayed ACKs
+        t0 = time.monotonic()
+        for i in range(10):
+            self.api.getstatus(self.date)
+        assert time.monotonic() - t0 < 0.2
+
+    def test_failures(self):
+        self.server.fail("/service/r2/addbatchstatus.jsp", times=2)
+        # Retried with jittered, growing backoff
+        self.api.addbatchstatus(self.batch(3))
+        assert_equals(len(self.api.getstatus(self.date)), 3)
+        assert_equals(self.server.failed["/service/r2/addbatchstatus.jsp"],
+                      2)
+        assert_equals(self.retrier.retries[smadata2.pvoutputorg.SERVER], 2)
+        assert_equals(len(self.clock.slept), 2)
+        assert 0 <= self.clock.slept[0] <= 2.0
+        assert 0 <= self.clock.slept[1] <= 4.0
+
+        # Until the retries run out
+        self.server.fail("/service/r2/addbatchstatus.jsp", times=4)
+        try:
+            self.api.addbatchstatus(self.batch(3))
+            assert False
+        except smadata2.pvoutputorg.HTTPError as e:
+            assert_equals(e.code, 503)
+        assert_equals(self.server.failed["/service/r2/addbatchstatus.jsp"],
+                      6)
+        assert_equals(self.retrier.gave_up, 1)
+
+    def test_client_error(self):
+        # Asking again won't help
+        self.server.fail(code=400, body="Bad request 400: Invalid data")
+        try:
+            self.api.addbatchstatus(self.batch(3))
+            assert False
+        except smadata2.pvoutputorg.HTTPError as e:
+            assert_equals(e.code, 400)
+        assert_equals(self.clock.slept, [])
+
+    def test_retry_after(self):
+        self.server.fail(headers={"Retry-After": "120"})
+        assert self.api.getstatus(self.date) is None
+        assert_equals(self.clock.slept, [120.0])
+
+    def test_rate_limited(self):
+        # Another client used up the quota, and the server didn't say
+        # when it resets, so back off for a good while
+        self.server.fail(code=403,
+                         body="Forbidden 403: Exceeded 300 requests per hour")
+        assert self.api.getstatus(self.date) is None
+        assert_equals(self.retrier.retries[smadata2.pvoutputorg.RATE_LIMITED],
+                      1)
+        assert_equals(len(self.clock.slept), 1)
+        assert 0 <= self.clock.slept[0] <= 300.0
+
+        # Other 403s aren't retried
+        self.server.fail(code=403, body="Forbidden 403: Read only key")
+        try:
+            self.api.getstatus(self.date)
+            assert False
+        except smadata2.pvoutputorg.HTTPError as e:
+            assert_equals(e.code, 403)
+        assert_equals(len(self.clock.slept), 1)
+
+    def test_dropped(self):
+        # The pool retries once on a new connection, in case the old one
+        # was closed while idle, and then the retrier takes over
+        self.server.fail(code=None, times=2)
+        assert self.api.getstatus(self.date) is None
+        assert_equals(self.retrier.retries[smadata2.pvoutputorg.CONNECT], 1)
+
+    def test_circuit(self):
+        other = self.connect(1002)
+        self.server.fail(times=20)
+        # Five failures in a row open the circuit, and stop the retries
+        for n in (4, 5):
+            try:
+                self.api.getstatus(self.date)
+                assert False
+            except smadata2.pvoutputorg.HTTPError:
+                pass
+            assert_equals(self.server.failed["/service/r2/getstatus.jsp"], n)
+
+        # Now requests fail without being sent, even for other systems
+        for api in (self.api, other):
+            try:
+                api.getstatus(self.date)
+                assert False
+            except smadata2.pvoutputorg.CircuitOpen as e:
+                assert_equals(e.wait, 60.0)
+        assert_equals(self.server.failed["/service/r2/getstatus.jsp"], 5)
+        assert_equals(self.retrier.refused, 2)
+
+        # After the cooldown one failure is enough to open it again
+        self.clock.sleep(60)
+        try:
+            self.api.getstatus(self.date)
+            assert False
+        except smadata2.pvoutputorg.HTTPError:
+            pass
+        assert_equals(self.server.failed["/service/r2/getstatus.jsp"], 6)
+
+        # An answer closes it
+        self.server.failures.clear()
+        self.clock.sleep(60)
+        assert self.api.getstatus(self.date) is None
+        self.server.fail(times=3)
+        assert self.api.getstatus(self.date) is None
+        assert "refused by open circuits" in str(self.retrier)
+
+    def test_failure_rate(self):
+        server = smadata2.pvoutputmock.MockServer(failure_rate=0.5, seed=1)
+        server.add_system(1001)
+        failed = 0
+        for i in range(100):
+            code, body, headers = server.handle(
+                "/service/r2/getsystem.jsp",
+                {"X-Pvoutput-Apikey": "MOCKAPIKEY",
+                 "X-Pvoutput-SystemId": "1001"}, {})
+            failed += (code == 503)
+        server.httpd.server_close()
+        assert 30 < failed < 70
+
+    def test_bad_key(self):
+        try:
+            smadata2.pvoutputorg.API(self.server.url, "WRONG", 1001,
+                                     pool=self.pool)
+            assert False
+        except smadata2.pvoutputorg.HTTPError as e:
+            assert_equals(e.code, 401)
+
+    def test_unreachable(self):
+        self.server.stop()
+        self.pool.close()
+        try:
+            self.api.getstatus(self.date)
+            assert False
+        except smadata2.pvoutputorg.NetworkError:
+            pass
+        # So tearDown can stop it again
+        self.server = smadata2.pvoutputmock.MockServer().start()
+
+
+class TestResponseCache(object):
+    FILENAME = "__testdb__pvoutputcache.sqlite"
+
+    def setUp(self):
+        if os.path.exists(self.FILENAME):
+            os.remove(self.FILENAME)
+        self.clock = FakeClock(1000000.0)
+        self.cache = self.open()
+
+    def tearDown(self):
+        self.cache.close()
+        os.remove(self.FILENAME)
+
+    def open(self):
+        return smadata2.pvoutputcache.ResponseCache(self.FILENAME,
+                                                    self.clock)
+
+    def test_ttl(self):
+        assert self.cache.get(1001, "/getsystem", "a=1") is None
+        self.cache.put(1001, "/getsystem", "a=1", "Answer", ttl=60)
+        assert_equals(self.cache.get(1001, "/getsystem", "a=1"), "Answer")
+        assert self.cache.get(1002, "/getsystem", "a=1") is None
+        assert self.cache.get(1001, "/getsystem", "a=2") is None
+        self.clock.now += 60
+        assert self.cache.get(1001, "/getsystem", "a=1") is None
+        assert_equals((self.cache.hits, self.cache.misses), (1, 4))
+
+    def test_invalidate(self):
+        self.cache.put(1001, "/getstatus", "d=20140731", "31st",
+                       first_day="20140731")
+        self.cache.put(1001, "/getstatus", "d=20140801", "1st",
+                       first_day="20140801")
+        self.cache.put(1001, "/getmissing", "df=20140701&dt=20140731",
+                       "July", first_day="20140701", last_day="20140731")
+        self.cache.put(1002, "/getstatus", "d=20140731", "Other",
+                       first_day="20140731")
+        self.cache.invalidate(1001, "20140731")
+        assert self.cache.get(1001, "/getstatus", "d=20140731") is None
+        assert self.cache.get(1001, "/getmissing",
+                              "df=20140701&dt=20140731") is None
+        assert_equals(self.cache.get(1001, "/getstatus", "d=20140801"),
+                      "1st")
+        assert_equals(self.cache.get(1002, "/getstatus", "d=20140731"),
+                      "Other")
+        assert_equals(self.cache.invalidations, 2)
+
+    def test_persistent(self):
+        self.cache.put(1001, "/getsystem", "a=1", "Answer", ttl=60)
+        self.cache.put(1001, "/getsystem", "a=2", "Old", ttl=1)
+        self.cache.close()
+        self.clock.now += 30
+        self.cache = self.open()
+        assert_equals(self.cache.get(1001, "/getsystem", "a=1"), "Answer")
+        assert self.cache.get(1001, "/getsystem", "a=2") is None
+
+
+class TestCachedAPI(object):
+    def setUp(self):
+        if os.path.exists(TestResponseCache.FILENAME):
+            os.remove(TestResponseCache.FILENAME)
+        self.cache = smadata2.pvoutputcache.ResponseCache(
+            TestResponseCache.FILENAME)
+        self.limiter = smadata2.pvoutputorg.RateLimiter()
+        self.server = smadata2.pvoutputmock.MockServer().start()
+        self.server.add_system(1001)
+        self.pool = smadata2.pvoutputorg.ConnectionPool()
+        self.api = self.connect(1001)
+        self.date = datetime.date(2014, 7, 31)
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.stop()
+        self.cache.close()
+        os.remove(TestResponseCache.FILENAME)
+
+    batch = TestMockServer.batch
+
+    def connect(self, sid):
+        return smadata2.pvoutputorg.API(self.server.url, "MOCKAPIKEY", sid,
+                                        pool=self.pool,
+                                        limiter=self.limiter,
+                                        cache=self.cache)
+
+    def test_getsystem_cached(self):
+        self.connect(1001)
+        self.connect(1001)
+        assert_equals(self.server.requests["/service/r2/getsystem.jsp"], 1)
+
+    def test_closed_day(self):
+        self.api.addbatchstatus(self.batch(5))
+        for i in range(3):
+            assert_equals(len(self.api.getstatus(self.date)), 5)
+        assert_equals(self.server.requests["/service/r2/getstatus.jsp"], 1)
+
+        # Uploading to the day means asking again
+        batch = self.batch(6)[5:]
+        self.api.addbatchstatus(batch)
+        assert_equals(len(self.api.getstatus(self.date)), 6)
+        self.api.deletestatus(batch[0][0])
+        assert_equals(len(self.api.getstatus(self.date)), 5)
+        assert_equals(self.server.requests["/service/r2/getstatus.jsp"], 3)
+
+    def test_today(self):
+        today = datetime.date.today()
+        for i in range(2):
+            assert self.api.getstatus(today) is None
+        assert_equals(self.server.requests["/service/r2/getstatus.jsp"], 2)
+
+
 @attr("pvoutput.org")
 class RealAPIChecker(object):
     CONFIGFILE = "smadata2-test-pvoutput.json"
@@ -191,3 +627,26 @@ class TestRealAPI(RealAPIChecker):
 
         res = self.api.getstatus_date_latest(self.date)
         assert_equals(res[0], dt)
+
+
+@attr(**{"pvoutput.org": False})
+class TestMockRealAPI(TestRealAPI):
+    """The live service tests, run against the mock server"""
+
+    def __init__(self):
+        self.date = datetime.date.today() - datetime.timedelta(days=1)
+
+    def delay(self):
+        pass
+
+    def setUp(self):
+        self.server = smadata2.pvoutputmock.MockServer().start()
+        self.server.add_system(1001)
+        self.pool = smadata2.pvoutputorg.ConnectionPool()
+        self.api = smadata2.pvoutputorg.API(
+            self.server.url, "MOCKAPIKEY", 1001, pool=self.pool,
+            limiter=smadata2.pvoutputorg.RateLimiter())
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.stop()
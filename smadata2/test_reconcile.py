@@ -0,0 +1,133 @@
+#! /usr/bin/python3
+
+import datetime
+import dateutil.tz
+
+from nose.tools import assert_equals
+
+import smadata2.check
+import smadata2.datetimeutil
+import smadata2.pvoutputmock
+import smadata2.pvoutputorg
+import smadata2.reconcile
+import smadata2.upload
+from smadata2.db import SAMPLE_INV_FAST
+from smadata2.db.memory import MemoryDatabase
+from smadata2.reconcile import MISSING, EXTRA, MISMATCHED
+
+
+def test_merge_join():
+    mine = [(0, "a"), (300, "b"), (900, "d")]
+    theirs = [(300, "B"), (600, "C"), (900, "D"), (1200, "E")]
+    assert_equals(list(smadata2.reconcile.merge_join(mine, theirs)),
+                  [(0, "a", None), (300, "b", "B"), (600, None, "C"),
+                   (900, "d", "D"), (1200, None, "E")])
+    assert_equals(list(smadata2.reconcile.merge_join([], theirs[:1])),
+                  [(300, None, "B")])
+
+
+def test_diff_day():
+    date = datetime.date(2014, 7, 31)
+    # Flat overnight at either end, which pvoutput.org never sees
+    mine = [(0, 100), (300, 100), (600, 110), (900, 120), (1200, 130),
+            (1500, 140), (1800, 150), (2100, 150)]
+    theirs = [(300, 0), (600, 10), (1000, 15), (1200, 31), (1500, 40)]
+    diff = smadata2.reconcile.diff_day(date, mine, theirs)
+    assert_equals(diff.missing, [(900, 900), (1800, 1800)])
+    assert_equals(diff.extra, [(1000, 1000)])
+    assert_equals(diff.mismatched, [(1200, 1200)])
+    assert_equals(diff.counts[smadata2.reconcile.MATCHED], 3)
+    assert not diff.ok()
+
+    # Nothing on pvoutput.org at all is one long run
+    diff = smadata2.reconcile.diff_day(date, mine, None)
+    assert_equals(diff.missing, [(300, 1800)])
+
+
+class FakeInverter(object):
+    serial = "__TEST__"
+
+
+class FakeSystem(object):
+    name = "Test System"
+    pvoutput_sid = 1000
+
+    def inverters(self):
+        return [FakeInverter()]
+
+    def timezone(self):
+        return dateutil.tz.tzutc()
+
+
+class TestReconcile(object):
+    FIRST = datetime.date(2014, 7, 1)
+    DAYS = 10
+
+    def setUp(self):
+        self.server = smadata2.pvoutputmock.MockServer().start()
+        self.mock = self.server.add_system(FakeSystem.pvoutput_sid)
+        self.pool = smadata2.pvoutputorg.ConnectionPool()
+        self.limiter = smadata2.pvoutputorg.RateLimiter()
+        self.api = smadata2.pvoutputorg.API(self.server.url, "MOCKAPIKEY",
+                                            FakeSystem.pvoutput_sid,
+                                            pool=self.pool,
+                                            limiter=self.limiter)
+        self.sc = FakeSystem()
+        self.db = MemoryDatabase()
+
+        total = 1000
+        for date in self.dates():
+            start, end = smadata2.datetimeutil.day_timestamps(
+                date, self.sc.timezone())
+            data = smadata2.check.generate_linear(start, start + 8*3600,
+                                                  start + 20*3600, end,
+                                                  total, 1)
+            total = data[-1][1]
+            self.db.add_samples("__TEST__", SAMPLE_INV_FAST, data)
+            smadata2.upload.upload_date(self.db, self.sc, date, self.api)
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.stop()
+
+    def dates(self):
+        return [self.FIRST + datetime.timedelta(days=i)
+                for i in range(self.DAYS)]
+
+    def reconcile(self):
+        self.server.requests.clear()
+        diffs = list(smadata2.reconcile.reconcile(self.db, self.sc, self.api,
+                                                  self.dates(), workers=4,
+                                                  ahead=3))
+        # One request per day, and the days come back in order
+        assert_equals(self.server.requests["/service/r2/getstatus.jsp"],
+                      self.DAYS)
+        assert_equals([d.date for d in diffs], self.dates())
+        return dict((d.date, d) for d in diffs if not d.ok())
+
+    def test_clean(self):
+        assert_equals(self.reconcile(), {})
+
+    def test_repair(self):
+        d3, d5, d7 = [smadata2.pvoutputorg.format_date(self.dates()[i])
+                      for i in (3, 5, 7)]
+        del self.mock.statuses[d3]["12:00"]
+        del self.mock.statuses[d3]["12:05"]
+        self.mock.statuses[d5]["13:00"] += 7
+        self.mock.statuses[d7]["12:02"] = self.mock.statuses[d7]["12:00"]
+
+        bad = self.reconcile()
+        assert_equals(sorted(bad), [self.dates()[i] for i in (3, 5, 7)])
+        noon = smadata2.datetimeutil.day_timestamps(
+            self.dates()[3], self.sc.timezone())[0] + 12*3600
+        assert_equals(bad[self.dates()[3]].runs[MISSING],
+                      [(noon, noon + 300)])
+        assert_equals(len(bad[self.dates()[5]].runs[MISMATCHED]), 1)
+        assert_equals(len(bad[self.dates()[7]].runs[EXTRA]), 1)
+
+        sent = [smadata2.reconcile.repair(self.db, self.sc, self.api, d)
+                for d in bad.values()]
+        assert_equals(sorted(sent), [0, 1, 2])
+
+        # Extra statuses on pvoutput.org are left alone
+        assert_equals(sorted(self.reconcile()), [self.dates()[7]])
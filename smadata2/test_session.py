@@ -0,0 +1,148 @@
+#! /usr/bin/python3
+
+from nose.tools import assert_equals, assert_raises
+
+import smadata2.session
+from smadata2.inverter.base import Error
+
+
+class FakeConnection(object):
+    def __init__(self, ic):
+        self.ic = ic
+        self.closed = False
+        self.logons = 1
+        self.broken = False
+
+    def check(self):
+        if self.broken or self.closed:
+            raise Error("Connection lost")
+
+    def logon(self, timeout=900):
+        self.check()
+        self.logons += 1
+
+    def getsignal(self):
+        self.check()
+        return 0.5
+
+    def total_yield(self):
+        self.check()
+        return (0, 1000)
+
+    def close(self):
+        self.closed = True
+
+
+class FakeInverter(object):
+    def __init__(self, serial="__TEST__"):
+        self.serial = serial
+        self.conns = []
+        self.fail = False
+
+    def connect_and_logon(self, timeout=900):
+        if self.fail:
+            raise OSError("Host is down")
+        self.conns.append(FakeConnection(self))
+        return self.conns[-1]
+
+
+class TestSession(object):
+    def setUp(self):
+        self.now = 1000.0
+        self.inv = FakeInverter()
+        self.sessions = smadata2.session.SessionManager(
+            timeout=900, margin=60, probe=120, clock=lambda: self.now)
+
+    def test_reuse(self):
+        s = self.sessions.connect(self.inv)
+        assert_equals(s.total_yield(), (0, 1000))
+        self.now += 60
+        assert self.sessions.connect(self.inv) is s
+        assert_equals(s.total_yield(), (0, 1000))
+        assert_equals(len(self.inv.conns), 1)
+        assert_equals(s.probes, 0)
+
+    def test_relogon(self):
+        s = self.sessions.connect(self.inv)
+        # Keep the connection busy, so it's never probed
+        for i in range(8):
+            self.now += 100
+            s.total_yield()
+        assert_equals(s.logons, 0)
+        # Within the margin of the logon expiring
+        self.now += 50
+        s.total_yield()
+        assert_equals(s.logons, 1)
+        assert_equals(s.expires(), self.now + 900)
+        assert_equals(len(self.inv.conns), 1)
+        assert_equals(self.inv.conns[0].logons, 2)
+
+    def test_probe(self):
+        s = self.sessions.connect(self.inv)
+        self.now += 200
+        s.total_yield()
+        assert_equals(s.probes, 1)
+        assert_equals(len(self.inv.conns), 1)
+
+    def test_probe_reconnect(self):
+        s = self.sessions.connect(self.inv)
+        self.inv.conns[0].broken = True
+        self.now += 200
+        s.total_yield()
+        assert_equals(len(self.inv.conns), 2)
+        assert self.inv.conns[0].closed
+        assert_equals(s.retries, 0)
+
+    def test_failed_relogon(self):
+        s = self.sessions.connect(self.inv)
+        self.inv.conns[0].broken = True
+        self.now += 870
+        s.total_yield()
+        assert_equals(len(self.inv.conns), 2)
+        assert_equals(s.expires(), self.now + 900)
+
+    def test_retry(self):
+        s = self.sessions.connect(self.inv)
+        self.now += 10
+        self.inv.conns[0].broken = True
+        # Not idle long enough to probe, so the call itself fails once
+        assert_equals(s.total_yield(), (0, 1000))
+        assert_equals(s.retries, 1)
+        assert_equals(len(self.inv.conns), 2)
+
+    def test_no_retry_fresh(self):
+        s = self.sessions.get(self.inv)
+        orig = FakeInverter.connect_and_logon
+
+        def broken_conn(timeout=900):
+            conn = orig(self.inv, timeout)
+            conn.broken = True
+            return conn
+        self.inv.connect_and_logon = broken_conn
+        assert_raises(Error, s.total_yield)
+        assert_equals(len(self.inv.conns), 1)
+        assert self.inv not in self.sessions
+
+    def test_connect_fails(self):
+        self.inv.fail = True
+        assert_raises(OSError, self.sessions.connect, self.inv)
+        assert self.inv not in self.sessions
+        self.inv.fail = False
+        self.sessions.connect(self.inv)
+        assert self.inv in self.sessions
+
+    def test_drop(self):
+        self.sessions.connect(self.inv)
+        self.sessions.drop(self.inv)
+        assert self.inv.conns[0].closed
+        assert self.inv not in self.sessions
+        self.sessions.connect(self.inv)
+        assert_equals(len(self.inv.conns), 2)
+
+    def test_close(self):
+        other = FakeInverter("__OTHER__")
+        self.sessions.connect(self.inv)
+        self.sessions.connect(other)
+        self.sessions.close()
+        assert self.inv.conns[0].closed
+        assert other.conns[0].closed
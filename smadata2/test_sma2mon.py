@@ -1,11 +1,45 @@
 #! /usr/bin/python3
 
 import argparse
+import contextlib
+import io
+import os.path
+import shutil
+import tempfile
 
+from nose.tools import assert_equals
+
+import smadata2.db
 import smadata2.sma2mon
+from smadata2.db import SAMPLE_INV_FAST
 
 
 def test_argparser():
     "Test that the function to generate the argparser doesn't crash"
     ap = smadata2.sma2mon.argparser()
     assert isinstance(ap, argparse.ArgumentParser)
+
+
+class ArchiveConfig(object):
+    def __init__(self, archivedir):
+        self.archivedir = archivedir
+        self.hot = smadata2.db.MemoryDatabase()
+
+    def database(self):
+        # Wrapped as config.database() does with database.cache set
+        return smadata2.db.CachedDatabase(smadata2.db.ArchiveDatabase(
+            self.hot, smadata2.db.ColumnArchive(self.archivedir)))
+
+
+def test_archive_cached():
+    tmpdir = tempfile.mkdtemp(prefix="smadata2-test-")
+    try:
+        config = ArchiveConfig(os.path.join(tmpdir, "archive"))
+        # 2014-01-01 00:00 UTC
+        config.hot.add_samples("__TEST__", SAMPLE_INV_FAST,
+                               [(1388534400 + i*300, i) for i in range(10)])
+        with contextlib.redirect_stdout(io.StringIO()):
+            smadata2.sma2mon.archive(config, argparse.Namespace(age=1))
+        assert_equals(config.hot.get_first_sample("__TEST__"), None)
+    finally:
+        shutil.rmtree(tmpdir)
@@ -0,0 +1,37 @@
+#! /usr/bin/python3
+
+import datetime
+import calendar
+
+from nose.tools import assert_equals
+
+import smadata2.sun
+
+
+def check_times(d, lat, lon, rise, set_):
+    times = smadata2.sun.sun_times(d, lat, lon)
+    expected = [calendar.timegm(t) for t in (rise, set_)]
+    for got, want in zip(times, expected):
+        # Published tables are rounded to the minute
+        assert abs(got - want) <= 90, (got, want)
+
+
+def test_sun_times():
+    # London, midsummer
+    yield (check_times, datetime.date(2024, 6, 21), 51.5074, -0.1278,
+           (2024, 6, 21, 3, 43, 0), (2024, 6, 21, 20, 21, 0))
+    # Sydney, midsummer, which starts the previous UTC day
+    yield (check_times, datetime.date(2024, 12, 21), -33.87, 151.21,
+           (2024, 12, 20, 18, 41, 0), (2024, 12, 21, 9, 5, 0))
+    # San Francisco, equinox, which ends the next UTC day
+    yield (check_times, datetime.date(2024, 3, 20), 37.77, -122.42,
+           (2024, 3, 20, 14, 12, 0), (2024, 3, 21, 2, 21, 0))
+
+
+def test_polar():
+    midnight = calendar.timegm((2024, 6, 21, 0, 0, 0))
+    assert_equals(smadata2.sun.sun_times(datetime.date(2024, 6, 21),
+                                         78.2, 15.6),
+                  (midnight, midnight + 24*3600))
+    assert smadata2.sun.sun_times(datetime.date(2024, 12, 21),
+                                  78.2, 15.6) is None
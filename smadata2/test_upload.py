@@ -3,14 +3,22 @@
 import datetime
 import dateutil.tz
 import json
+import threading
+import time
 
 from nose.tools import assert_equals
 
 import smadata2.upload
 import smadata2.check
+import smadata2.config
 import smadata2.db.sqlite
+import smadata2.pvoutputmock
+import smadata2.pvoutputorg
+import smadata2.pvoutputuploader
 from smadata2.db.tests import SQLiteDBChecker
-from smadata2.db import SAMPLE_ADHOC
+from smadata2.db import SAMPLE_ADHOC, SAMPLE_INV_FAST, SAMPLE_INV_DAILY
+from smadata2.db import OUTBOX_FAILED
+from smadata2.db.memory import MemoryDatabase
 
 
 def test_prepare1():
@@ -74,3 +82,419 @@ class TestLoad(SQLiteDBChecker):
             xdt = dtdawn + datetime.timedelta(minutes=5*i)
             assert_equals(dt, xdt)
             assert_equals(y, i + 12345)
+
+
+class FakeSystem(object):
+    def __init__(self, name, sid):
+        self.name = name
+        self.pvoutput_sid = sid
+
+
+class TestUploadAll(object):
+    def setUp(self):
+        self.systems = [FakeSystem("sys%d" % i, 1000 + i) for i in range(4)]
+        self.sent = []
+        self.finished = []
+
+    def prepare(self, system):
+        return [system.name + "-a", system.name + "-b"]
+
+    def send(self, system, work):
+        for batch in work:
+            time.sleep(0.05)
+            self.sent.append(batch)
+        return len(work)
+
+    def finish(self, system, result):
+        self.finished.append((system.name, result,
+                              threading.current_thread()))
+
+    def test_concurrent(self):
+        t0 = time.monotonic()
+        results = smadata2.upload.upload_all(self.systems, self.prepare,
+                                             self.send, self.finish)
+        # Much quicker than doing the systems one after another
+        assert time.monotonic() - t0 < 0.3
+        assert_equals(len(results), 4)
+        assert all(up.error is None for up in results)
+        assert_equals(sorted(self.sent),
+                      sorted(s.name + x for s in self.systems
+                             for x in ("-a", "-b")))
+        # Each system's batches stay in order
+        for s in self.systems:
+            assert (self.sent.index(s.name + "-a")
+                    < self.sent.index(s.name + "-b"))
+        assert_equals(sorted(name for name, r, t in self.finished),
+                      [s.name for s in self.systems])
+        assert all(t is threading.current_thread()
+                   for name, r, t in self.finished)
+
+    def test_shared_sid(self):
+        # Two systems uploading to one pvoutput.org system must not overlap
+        self.systems[1].pvoutput_sid = self.systems[0].pvoutput_sid
+        results = smadata2.upload.upload_all(self.systems, self.prepare,
+                                             self.send, self.finish)
+        assert_equals(len(results), 3)
+        shared = [up for up in results if len(up.systems) == 2][0]
+        assert_equals(shared.results, [2, 2])
+        order = [b for b in self.sent if b[:4] in ("sys0", "sys1")]
+        assert_equals(order, ["sys0-a", "sys0-b", "sys1-a", "sys1-b"])
+
+    def test_no_sid(self):
+        self.systems[2].pvoutput_sid = None
+        results = smadata2.upload.upload_all(self.systems, self.prepare,
+                                             self.send)
+        assert_equals(len(results), 3)
+
+    def test_failure(self):
+        def send(system, work):
+            if system.name == "sys2":
+                raise smadata2.pvoutputorg.Error("Rejected")
+            return self.send(system, work)
+
+        def prepare(system):
+            if system.name == "sys3":
+                raise ValueError("No data")
+            return self.prepare(system)
+
+        reported = []
+        results = smadata2.upload.upload_all(self.systems, prepare, send,
+                                             self.finish, reported.append)
+        assert_equals(reported, results)
+        errors = dict((up.systems[0].name, up.error) for up in results)
+        assert errors["sys0"] is None
+        assert isinstance(errors["sys2"], smadata2.pvoutputorg.Error)
+        assert isinstance(errors["sys3"], ValueError)
+        assert_equals(sorted(name for name, r, t in self.finished),
+                      ["sys0", "sys1"])
+
+    def test_record(self):
+        def send(system, work, progress):
+            for batch in work:
+                progress(batch)
+                if system.name == "sys1":
+                    raise smadata2.pvoutputorg.Error("Rejected")
+            return len(work)
+
+        recorded = []
+
+        def record(system, item):
+            recorded.append((item, threading.current_thread()))
+
+        results = smadata2.upload.upload_all(self.systems, self.prepare,
+                                             send, record=record)
+        errors = dict((up.systems[0].name, up.error) for up in results)
+        assert isinstance(errors["sys1"], smadata2.pvoutputorg.Error)
+        # Progress made before the failure is still recorded, and only
+        # by this thread
+        assert_equals(sorted(item for item, t in recorded),
+                      ["sys0-a", "sys0-b", "sys1-a", "sys2-a", "sys2-b",
+                       "sys3-a", "sys3-b"])
+        assert all(t is threading.current_thread() for item, t in recorded)
+
+
+class TestUploadMock(object):
+    def setUp(self):
+        self.server = smadata2.pvoutputmock.MockServer().start()
+        self.systems = [FakeSystem("sys%d" % i, 1000 + i) for i in range(3)]
+        for s in self.systems:
+            self.server.add_system(s.pvoutput_sid)
+        self.pool = smadata2.pvoutputorg.ConnectionPool()
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.stop()
+
+    def test_upload(self):
+        tz = dateutil.tz.tzutc()
+        date = datetime.date(2014, 7, 31)
+        ts_start, ts_end = smadata2.datetimeutil.day_timestamps(date, tz)
+        data = smadata2.check.generate_linear(ts_start, ts_start + 8*3600,
+                                              ts_start + 20*3600, ts_end,
+                                              1000, 1)
+        output = smadata2.upload.prepare_data_for_date(date, data, tz)
+
+        def send(system, work):
+            api = smadata2.pvoutputorg.API(self.server.url, "MOCKAPIKEY",
+                                           system.pvoutput_sid,
+                                           pool=self.pool)
+            api.addstatus_bulk(work)
+            return api.getstatus(date)
+
+        results = smadata2.upload.upload_all(self.systems,
+                                             lambda s: output, send)
+        for up in results:
+            assert up.error is None
+            assert_equals(len(up.results[0]), len(output))
+
+
+class FakeInverter(object):
+    def __init__(self, serial):
+        self.serial = serial
+
+
+class FlakyAPI(object):
+    """Passes calls to an API, but fails after some number of batches"""
+
+    def __init__(self, api, fail_after):
+        self.api = api
+        self.fail_after = fail_after
+
+    def __getattr__(self, name):
+        return getattr(self.api, name)
+
+    def addbatchstatus(self, batch):
+        if self.fail_after == 0:
+            raise smadata2.pvoutputorg.Error("Service unavailable")
+        self.fail_after -= 1
+        self.api.addbatchstatus(batch)
+
+
+class TestOutbox(SQLiteDBChecker):
+    SID = 1000
+
+    def setUp(self):
+        super(TestOutbox, self).setUp()
+        # A free system, so statuses go 30 to a request
+        self.server = smadata2.pvoutputmock.MockServer().start()
+        self.mock = self.server.add_system(self.SID, donation=False)
+        self.pool = smadata2.pvoutputorg.ConnectionPool()
+        self.limiter = smadata2.pvoutputorg.RateLimiter()
+
+        self.system = FakeSystem("sys0", self.SID)
+        self.system.inverters = lambda: [FakeInverter("TESTSERIAL")]
+        self.system.timezone = dateutil.tz.tzlocal
+
+        start = int(time.time()) // 300 * 300 - 24*3600
+        self.samples = [(start + i*300, 1000 + i) for i in range(250)]
+        self.db.add_samples("TESTSERIAL", SAMPLE_INV_FAST, self.samples)
+        self.db.commit()
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.stop()
+        super(TestOutbox, self).tearDown()
+
+    def uploader(self, fail_after=None):
+        api = smadata2.pvoutputorg.API(self.server.url, "MOCKAPIKEY",
+                                       self.SID, pool=self.pool,
+                                       limiter=self.limiter)
+        if fail_after is not None:
+            api = FlakyAPI(api, fail_after)
+        return smadata2.pvoutputuploader.PVOutputUploader(self.db,
+                                                          self.system, api)
+
+    def uploaded(self):
+        return sum(len(day) for day in self.mock.statuses.values())
+
+    def test_upload(self):
+        self.uploader().upload_unuploaded_statuses()
+        assert_equals(self.uploaded(), 250)
+        assert_equals(self.db.outbox_batches(self.SID), [])
+        assert_equals(self.db.pvoutput_get_last_datetime_uploaded(self.SID),
+                      self.samples[-1][0])
+
+    def test_pipeline(self):
+        # Overnight is flat, and only its last status is kept
+        night = self.samples[-1]
+        self.db.add_samples("TESTSERIAL", SAMPLE_INV_FAST,
+                            [(night[0] + i*300, night[1])
+                             for i in range(1, 20)]
+                            + [(night[0] + 20*300, night[1] + 1)])
+        self.db.commit()
+        uploader = self.uploader()
+        uploader.upload_unuploaded_statuses()
+        assert_equals(self.uploaded(), 252)
+        p = uploader.pipeline
+        assert_equals([p[s] for s in ("read", "trimmed", "complete",
+                                      "queued batches", "unsent", "recent",
+                                      "requests")],
+                      [270, 252, 252, 3, 252, 252, 10])
+
+    def test_flat_rerun(self):
+        uploader = self.uploader()
+        assert_equals(uploader.queue_unuploaded(), 250)
+
+        # A flat run after what's queued isn't started again on each run
+        last = self.samples[-1]
+        self.db.add_samples("TESTSERIAL", SAMPLE_INV_FAST,
+                            [(last[0] + i*300, last[1]) for i in range(1, 4)])
+        self.db.commit()
+        assert_equals(uploader.queue_unuploaded(), 0)
+        assert_equals(uploader.queue_unuploaded(), 0)
+
+        # Once the yield changes, the run's last status is the baseline
+        self.db.add_sample("TESTSERIAL", last[0] + 4*300, SAMPLE_INV_FAST,
+                           last[1] + 1)
+        self.db.commit()
+        assert_equals(uploader.queue_unuploaded(), 2)
+        statuses = self.db.outbox_batches(self.SID)[-1].statuses
+        assert_equals([ts for ts, y in statuses],
+                      [last[0] + 3*300, last[0] + 4*300])
+
+    def test_resume(self):
+        uploader = self.uploader(fail_after=5)
+        try:
+            uploader.upload_unuploaded_statuses()
+            assert False, "Upload should have failed"
+        except smadata2.pvoutputorg.Error:
+            pass
+
+        # The first batch of 100 took 4 requests and is done, the second
+        # got as far as its first request
+        assert_equals(self.uploaded(), 130)
+        assert_equals(self.db.pvoutput_get_last_datetime_uploaded(self.SID),
+                      self.samples[99][0])
+        batches = self.db.outbox_batches(self.SID)
+        assert_equals(len(batches), 2)
+        assert_equals(batches[0].state, OUTBOX_FAILED)
+        assert_equals(batches[0].attempts, 1)
+        assert_equals(batches[0].sent_ts, self.samples[129][0])
+
+        # Statuses already in the outbox aren't queued again
+        assert_equals(uploader.queue_unuploaded(), 0)
+
+        self.uploader().upload_unuploaded_statuses()
+        assert_equals(self.uploaded(), 250)
+        assert_equals(self.db.outbox_batches(self.SID), [])
+        assert_equals(self.db.pvoutput_get_last_datetime_uploaded(self.SID),
+                      self.samples[-1][0])
+        # Nothing was sent twice
+        assert_equals(self.server.requests["/service/r2/addbatchstatus.jsp"],
+                      10)
+
+
+class DailySystem(object):
+    name = "Daily System"
+    pvoutput_sid = 1000
+
+    def __init__(self, serials):
+        self.invs = [FakeInverter(serial) for serial in serials]
+
+    def inverters(self):
+        return self.invs
+
+    def timezone(self):
+        return dateutil.tz.tzutc()
+
+
+class DailyChecker(object):
+    DAY = 24 * 3600
+    # 2014-07-01 00:00 UTC
+    START = 1404172800
+
+    def setUp(self):
+        self.db = MemoryDatabase()
+        self.sc = DailySystem(["INV1", "INV2"])
+
+    def add(self, serial, first, last, per_day):
+        self.db.add_samples(serial, SAMPLE_INV_DAILY,
+                            [(self.START + i*self.DAY, 5000 + i*per_day)
+                             for i in range(first, last)])
+
+
+class TestDailyOutputs(DailyChecker):
+    def test_outputs(self):
+        self.add("INV1", 0, 6, 100)
+        self.add("INV2", 0, 5, 10)
+        outputs = smadata2.upload.daily_outputs(self.db, self.sc)
+        # The last day is only complete for one inverter
+        assert_equals(outputs, [(self.START + i*self.DAY,
+                                 datetime.date(2014, 7, 1 + i), 110)
+                                for i in range(4)])
+        outputs = smadata2.upload.daily_outputs(self.db, self.sc,
+                                                self.START + self.DAY)
+        assert_equals([date.day for ts, date, g in outputs], [3, 4])
+
+    def test_gaps(self):
+        self.add("INV1", 0, 2, 100)
+        self.add("INV1", 3, 5, 100)
+        self.db.add_sample("INV1", self.START + 5*self.DAY, SAMPLE_INV_DAILY,
+                           smadata2.upload.INVALID_YIELD)
+        self.sc = DailySystem(["INV1"])
+        outputs = smadata2.upload.daily_outputs(self.db, self.sc)
+        assert_equals([(date.day, g) for ts, date, g in outputs],
+                      [(1, 100), (4, 100)])
+
+
+class TestUploadDaily(DailyChecker):
+    def setUp(self):
+        super(TestUploadDaily, self).setUp()
+        self.server = smadata2.pvoutputmock.MockServer().start()
+        # A free system, so 30 outputs per request
+        self.mock = self.server.add_system(self.sc.pvoutput_sid,
+                                           donation=False)
+        self.pool = smadata2.pvoutputorg.ConnectionPool()
+        self.api = smadata2.pvoutputorg.API(
+            self.server.url, "MOCKAPIKEY", self.sc.pvoutput_sid,
+            pool=self.pool, limiter=smadata2.pvoutputorg.RateLimiter())
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.stop()
+
+    def upload(self, now=None):
+        if now is None:
+            now = self.START + 100*self.DAY
+        self.server.requests.clear()
+        return smadata2.upload.upload_daily(self.db, self.sc, self.api,
+                                            now=now)
+
+    def test_upload(self):
+        self.add("INV1", 0, 71, 100)
+        self.add("INV2", 0, 71, 10)
+        assert_equals(self.upload(), 70)
+        assert_equals(self.server.requests["/service/r2/addbatchoutput.jsp"],
+                      3)
+        assert_equals(len(self.mock.outputs), 70)
+        assert all(g == 110 for g in self.mock.outputs.values())
+
+        # Only new days go on a rerun
+        assert_equals(self.upload(), 0)
+        assert_equals(sum(self.server.requests.values()), 0)
+        self.add("INV1", 71, 73, 100)
+        self.add("INV2", 71, 73, 10)
+        assert_equals(self.upload(), 2)
+        assert_equals(len(self.mock.outputs), 72)
+
+    def test_late_day(self):
+        self.add("INV1", 0, 6, 100)
+        self.add("INV2", 0, 2, 10)
+        self.add("INV2", 3, 6, 10)
+        # INV2 is missing the 3rd's midnight, so the 2nd and 3rd wait
+        assert_equals(self.upload(), 3)
+        assert_equals(sorted(self.mock.outputs),
+                      ["20140701", "20140704", "20140705"])
+
+        self.add("INV2", 2, 3, 10)
+        assert_equals(self.upload(), 4)
+        assert_equals(sorted(self.mock.outputs),
+                      ["201407%02d" % d for d in range(1, 6)])
+        assert all(g == 110 for g in self.mock.outputs.values())
+        assert_equals(self.upload(), 0)
+
+    def test_forgotten_day(self):
+        self.add("INV1", 0, 6, 100)
+        self.add("INV2", 0, 2, 10)
+        self.add("INV2", 3, 6, 10)
+        # The inverter no longer keeps the missing total, so it can't
+        # hold later days back
+        now = self.START + 400*self.DAY
+        assert_equals(self.upload(now), 3)
+        assert_equals(self.upload(now), 0)
+
+    def test_new_inverter(self):
+        self.add("INV1", 0, 6, 100)
+        self.add("INV2", 3, 6, 10)
+        assert_equals(self.upload(), 2)
+        # Days before the second inverter was installed never complete
+        assert_equals(self.upload(), 0)
+
+    def test_invalid_total(self):
+        self.add("INV1", 0, 6, 100)
+        self.add("INV2", 0, 2, 10)
+        self.add("INV2", 3, 6, 10)
+        self.db.add_sample("INV2", self.START + 2*self.DAY, SAMPLE_INV_DAILY,
+                           smadata2.upload.INVALID_YIELD)
+        assert_equals(self.upload(), 3)
+        assert_equals(self.upload(), 0)
@@ -18,28 +18,40 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
+import collections
+import concurrent.futures
 import datetime
+import queue
+import time
+
 from . import datetimeutil
+from .backfill import DAY, HORIZON
+from .db import SAMPLE_INV_DAILY
+from .db import WATERMARK_INGEST, WATERMARK_PVOUTPUT_DAILY
+
+# What an inverter reports for a daily total it doesn't have
+INVALID_YIELD = 0xffffffff
+
+
+def trim_flat(data):
+    """Drop the non-generating periods from the beginning and end of a day
+
+    The last sample before generation starts and the first one after it
+    stops are kept, so the day's total is unchanged."""
+    lo = 0
+    while lo < len(data) - 1 and data[lo][1] == data[lo + 1][1]:
+        lo += 1
+    hi = len(data)
+    while hi - lo > 1 and data[hi - 1][1] == data[hi - 2][1]:
+        hi -= 1
+    return data[lo:hi]
 
 
 def prepare_data_for_date(date, data, tz):
     """Translate a day's data from the database format to be ready for upload
     to pvoutput.org"""
 
-    # First trim the non-generating periods from the beginning and end
-    while len(data) > 1:
-        if data[0][1] == data[1][1]:
-            # the next data point is the same as the first datapoint:
-            data.pop(0)
-        else:
-            break
-
-    while len(data) > 1:
-        if data[-1][1] == data[-2][1]:
-            # last datapoint == second last datapoint
-            data.pop()
-        else:
-            break
+    data = trim_flat(data)
 
     # Now convert the timestamps to datetime objects
     output = [(datetime.datetime.fromtimestamp(ts, tz), y) for ts, y in data]
@@ -59,8 +71,268 @@ def load_data_for_date(db, sc, date):
     return prepare_data_for_date(date, results, sc.timezone())
 
 
-def upload_date(db, sc, date):
+def upload_date(db, sc, date, api=None):
+    """Upload one day's statuses for a system
+
+    Without a pvoutput.org API object, just show what would be sent."""
     data = load_data_for_date(db, sc, date)
 
-    for ts, y in data:
-        print("%s: %d Wh" % (datetimeutil.format_time(ts), y))
+    if api is None:
+        for dt, y in data:
+            print("%s: %d Wh" % (dt, y))
+    else:
+        api.addstatus_bulk(data)
+
+
+def _generation_by_date(db, sc, since):
+    """Each inverter's daily generation, by date
+
+    Returns:
+       tuple.  ({date: [(serial, day start timestamp, Wh generated)]},
+       {serial: (first daily sample timestamp, [timestamps of invalid
+       daily totals])})
+    """
+    tz = sc.timezone()
+    from_ts = 0 if since is None else since
+    bydate = {}
+    coverage = {}
+    for inv in sc.inverters():
+        upto = db.get_watermark(WATERMARK_INGEST, inv.serial,
+                                SAMPLE_INV_DAILY)
+        if upto is None:
+            continue
+        samples = [(ts, y) for ts, st, y
+                   in db.get_samples(inv.serial, from_ts, upto + 1,
+                                     dense=True)
+                   if st == SAMPLE_INV_DAILY]
+        if not samples:
+            continue
+        coverage[inv.serial] = (samples[0][0],
+                                [ts for ts, y in samples
+                                 if y == INVALID_YIELD])
+        samples = [(ts, y) for ts, y in samples if y != INVALID_YIELD]
+        for (ts0, y0), (ts1, y1) in zip(samples, samples[1:]):
+            # Neighbouring midnights, allowing for daylight saving
+            if since is not None and ts0 <= since:
+                continue
+            if 2 * (ts1 - ts0) > 3 * DAY:
+                continue
+            date = datetime.datetime.fromtimestamp(ts0, tz).date()
+            bydate.setdefault(date, []).append((inv.serial, ts0, y1 - y0))
+    return bydate, coverage
+
+
+def daily_outputs(db, sc, since=None):
+    """Each day's generation for a system, from its daily samples
+
+    The inverters record their total yield at every local midnight, so a
+    day's generation is the difference between its midnight and the
+    next.  Days are only counted once every inverter has both.
+
+    Args:
+       since (int): Only days starting after this timestamp
+    Returns:
+       list.  (day start timestamp, date, Wh generated), oldest first
+    """
+    bydate, coverage = _generation_by_date(db, sc, since)
+    return _split_days(bydate, sc)[0]
+
+
+def _split_days(bydate, sc):
+    """Days every inverter has, as outputs, and the others
+
+    Returns:
+       tuple.  (list of outputs as for daily_outputs(), list of
+       (day start timestamp, serials missing it) for the others)
+    """
+    serials = set(inv.serial for inv in sc.inverters())
+    outputs = []
+    incomplete = []
+    for date, days in sorted(bydate.items()):
+        ts = min(ts for serial, ts, g in days)
+        missing = serials - set(serial for serial, ts0, g in days)
+        if missing:
+            incomplete.append((ts, missing))
+        else:
+            outputs.append((ts, date, sum(g for serial, ts0, g in days)))
+    return outputs, incomplete
+
+
+def _may_complete(ts, missing, coverage, now):
+    """Whether an incomplete day could still be filled in
+
+    Not once the inverters no longer keep daily totals that old, nor if
+    every inverter missing it started recording after it or reported an
+    invalid total for it.
+    """
+    if ts < now - HORIZON[SAMPLE_INV_DAILY]:
+        return False
+    for serial in missing:
+        if serial not in coverage:
+            # Nothing downloaded from it yet
+            return True
+        first, invalid = coverage[serial]
+        if first <= ts and not any(ts <= t <= ts + 3 * DAY // 2
+                                   for t in invalid):
+            return True
+    return False
+
+
+def upload_daily(db, sc, api, report=None, now=None):
+    """Upload a system's daily generation to pvoutput.org
+
+    Outputs go in batches as big as the API allows.  After each batch
+    the system's WATERMARK_PVOUTPUT_DAILY watermark moves past it and is
+    committed, so a rerun only sends days which haven't been sent.  The
+    watermark doesn't pass a day which only some inverters have yet,
+    while the rest might still fill it in, so that day goes once they
+    do.  Days after it are sent again until then, which does no harm.
+
+    Args:
+       report (callable): Called with each batch as it's sent
+       now (int): The current time, by default time.time()
+    Returns:
+       int.  The number of days uploaded
+    """
+    if now is None:
+        now = time.time()
+    since = db.get_watermark(WATERMARK_PVOUTPUT_DAILY, sc.pvoutput_sid,
+                             SAMPLE_INV_DAILY)
+    bydate, coverage = _generation_by_date(db, sc, since)
+    outputs, incomplete = _split_days(bydate, sc)
+    waiting = [ts for ts, missing in incomplete
+               if _may_complete(ts, missing, coverage, now)]
+    batchsize = api.output_batchsize()
+    for i in range(0, len(outputs), batchsize):
+        batch = outputs[i:i + batchsize]
+        api.addbatchoutput([(date, g) for ts, date, g in batch])
+        upto = batch[-1][0]
+        if waiting:
+            upto = min(upto, waiting[0] - 1)
+        if since is None or upto > since:
+            db.advance_watermark(WATERMARK_PVOUTPUT_DAILY, sc.pvoutput_sid,
+                                 SAMPLE_INV_DAILY, upto)
+        db.commit()
+        if report is not None:
+            report(batch)
+    return len(outputs)
+
+
+class SystemUpload(object):
+    """The outcome of uploading for one pvoutput.org system"""
+
+    def __init__(self, sid, systems):
+        self.sid = sid
+        self.systems = systems
+        self.work = []
+        self.results = []
+        self.error = None
+        self.send_time = 0.0
+
+
+def upload_all(systems, prepare, send, finish=None, report=None,
+               workers=8, record=None):
+    """Upload for many pvoutput.org systems at once
+
+    pvoutput.org needs each system's data to arrive in order, so all the
+    work for one system id is sent by a single task, one request after
+    another.  Up to `workers` systems are sent concurrently; the shared
+    rate limiter paces their requests, so how long the whole upload
+    takes depends on the quota rather than on how many systems there
+    are.  As with download_all(), only the calling thread touches the
+    database.
+
+    Args:
+       systems (list): System configurations, those without a pvoutput
+          system id are skipped
+       prepare (callable): prepare(system) returns the work to send for
+          a system, called in this thread before anything is sent
+       send (callable): send(system, work) uploads the work and returns
+          a result, called in a worker thread
+       finish (callable): finish(system, result) records a successful
+          upload, called in this thread
+       report (callable): Called with each SystemUpload as it completes
+       workers (int): Most systems to send concurrently
+       record (callable): record(system, item) saves progress made part
+          way through a send, called in this thread.  When given, send
+          is called as send(system, work, progress), and each
+          progress(item) is passed on to record as soon as possible.
+    Returns:
+       list.  A SystemUpload per system id, in completion order
+    """
+    bysid = collections.OrderedDict()
+    for system in systems:
+        if system.pvoutput_sid is None:
+            continue
+        bysid.setdefault(str(system.pvoutput_sid), []).append(system)
+
+    uploads = []
+    for sid, group in bysid.items():
+        up = SystemUpload(sid, group)
+        try:
+            up.work = [prepare(system) for system in group]
+        except Exception as e:
+            up.error = e
+        uploads.append(up)
+
+    # Progress reports and finished uploads, from the workers
+    events = queue.Queue()
+
+    def run(up):
+        t0 = time.monotonic()
+        try:
+            for system, work in zip(up.systems, up.work):
+                if record is None:
+                    up.results.append(send(system, work))
+                else:
+                    def progress(item, system=system):
+                        events.put((up, system, item))
+                    up.results.append(send(system, work, progress))
+        finally:
+            up.send_time = time.monotonic() - t0
+
+    results = []
+
+    def done(up):
+        # A system which failed part way still gets the work it did
+        # manage to send recorded
+        if finish is not None:
+            for system, result in zip(up.systems, up.results):
+                try:
+                    finish(system, result)
+                except Exception as e:
+                    up.error = e
+                    break
+        results.append(up)
+        if report is not None:
+            report(up)
+
+    todo = []
+    for up in uploads:
+        if up.error is None:
+            todo.append(up)
+        else:
+            done(up)
+
+    if todo:
+        with concurrent.futures.ThreadPoolExecutor(min(workers,
+                                                       len(todo))) as ex:
+            for up in todo:
+                future = ex.submit(run, up)
+                future.add_done_callback(
+                    lambda f, up=up: events.put((up, None, f)))
+            running = len(todo)
+            while running:
+                up, system, item = events.get()
+                if system is None:
+                    if up.error is None:
+                        up.error = item.exception()
+                    done(up)
+                    running -= 1
+                    continue
+                try:
+                    record(system, item)
+                except Exception as e:
+                    if up.error is None:
+                        up.error = e
+    return results